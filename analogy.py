@@ -18,15 +18,20 @@ import category_builder_util as util
 def GetArgumentParser():
   parser = argparse.ArgumentParser(description='Category Builder Analogies')
   parser.add_argument('--squash', default=100.0, type=float, help="Squash for combining scores")
+  parser.add_argument('--analogy_size', default=10, type=int,
+                      help="How many results to compute and print")
+  util.add_builder_arguments(parser)
   parser.add_argument('b', help="The B in A:B::C:?")
   parser.add_argument('c', help="The C in A:B::C:?")
   return parser
 
 if __name__ == "__main__":
   args = GetArgumentParser().parse_args()
+  CB = util.builder_from_args(args)
 
-  CB = util.CategoryBuilder(data_dir=".")
-  
-  items = CB.DoAnalogy(b=args.b, c=args.c, squash=args.squash)
-  for item in items[:10]:
+  items = CB.DoAnalogy(b=args.b, c=args.c, squash=args.squash, k=args.analogy_size)
+  for item in items[:args.analogy_size]:
     print(f"{item[1]:5.3f}\t\t{item[0]}")
+  if args.profile and not args.server:
+    print(CB.profiler.LastTrace().Report())
+  util.close_builder(CB, args)
@@ -0,0 +1,380 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks building and querying the matrices, on synthetic data.
+
+The real inputs are large git-lfs files, so this first writes a pair of inputs in
+the same format, with Zipfian row lengths and item popularity, into --data_dir.
+It then builds each backend, times row lookups and queries, and writes the results
+as JSON to --output, so that runs on different backends and commits can be compared.
+"""
+
+import argparse
+import bz2
+import csv
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from itertools import accumulate
+
+import category_builder_util as util
+
+
+def ZipfWeights(size, exponent):
+  return [1.0 / pow(rank, exponent) for rank in range(1, size + 1)]
+
+def WriteRows(path, rows):
+  """Writes (key, [(entry, weight), ...]) rows as a bz2 CSV, entries by decreasing weight."""
+  with bz2.open(path, 'wt', encoding='utf-8', newline='') as f:
+    writer = csv.writer(f)
+    for key, entries in rows:
+      line = [key]
+      for entry, weight in sorted(entries, key=lambda x: -x[1]):
+        line += [entry, str(weight)]
+      writer.writerow(line)
+
+def ReadKeys(path):
+  with bz2.open(path, 'rt', encoding='utf-8', newline='') as f:
+    return [line[0] for line in csv.reader(f)]
+
+def GenerateSyntheticInputs(data_dir, num_items=20000, num_features=100000, exponent=1.1,
+                            max_row_length=5000, syntactic_fraction=0.5, random_seed=0):
+  """Writes I_TO_F and F_TO_I inputs for a random corpus into data_dir.
+
+  Feature ranks follow a Zipf law: the feature of rank r lists about
+  max_row_length / r^exponent items, themselves picked with Zipfian popularity.
+  Features are syntactic ('S...') with probability syntactic_fraction, and
+  co-occurrence features ('C...') otherwise, each that of one item, listing the
+  items that co-occur with it. As in the real data, I_TO_F holds the syntactic
+  features of each item, and its co-occurrence feature if it has one. Items get
+  co-occurrence features by popularity, so that frequent ones have one.
+  Weights are stored times 100, as integers.
+  """
+  rng = random.Random(random_seed)
+  items = [f'item{i}' for i in range(num_items)]
+  cum_item_weights = list(accumulate(ZipfWeights(num_items, exponent)))
+  f_to_i = []
+  i_to_f = dict((item, []) for item in items)
+  # Items without a co-occurrence feature yet, most popular first.
+  cooc_owners = iter(items)
+  for rank, row_length in enumerate(ZipfWeights(num_features, exponent)):
+    row_length = max(1, min(num_items, int(max_row_length * row_length)))
+    owner = None
+    if rng.random() < syntactic_fraction:
+      feature = f'S{rng.choice(("nsubj", "dobj", "amod", "pobj"))}|item{rng.randrange(num_items)}|{rank}'
+    else:
+      owner = next(cooc_owners, None)
+      if owner is None:
+        continue
+      feature = f'C{owner}'
+    chosen = set(rng.choices(items, cum_weights=cum_item_weights, k=row_length))
+    entries = [(item, rng.randint(100, 2000)) for item in chosen]
+    f_to_i.append((feature, entries))
+    if owner is not None:
+      i_to_f[owner].append((feature, rng.randint(100, 2000)))
+    else:
+      for item, weight in entries:
+        i_to_f[item].append((feature, weight))
+  os.makedirs(data_dir, exist_ok=True)
+  WriteRows(os.path.join(data_dir, util.I_TO_F_INPUT),
+            [(item, entries) for item, entries in i_to_f.items() if entries])
+  WriteRows(os.path.join(data_dir, util.F_TO_I_INPUT), f_to_i)
+  return [item for item, entries in i_to_f.items() if entries]
+
+
+def Percentiles(seconds):
+  """Latency percentiles in milliseconds, and throughput, of a list of timings."""
+  ordered = sorted(seconds)
+  if not ordered:
+    return dict((name, 0.0) for name in ('count', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'mean_ms',
+                                         'queries_per_second'))
+  def At(fraction):
+    return 1000.0 * ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+  return {'count': len(ordered),
+          'p50_ms': At(0.5), 'p90_ms': At(0.9), 'p99_ms': At(0.99), 'max_ms': 1000.0 * ordered[-1],
+          'mean_ms': 1000.0 * sum(ordered) / len(ordered),
+          'queries_per_second': len(ordered) / sum(ordered) if sum(ordered) else 0.0}
+
+def TimeCalls(fn, args_list):
+  timings = []
+  for args in args_list:
+    start = time.perf_counter()
+    fn(*args)
+    timings.append(time.perf_counter() - start)
+  return Percentiles(timings)
+
+def ThreadThroughput(fn, args_list, max_threads):
+  """Calls per second, and speedup over one thread, with the calls spread over 1..max_threads threads.
+
+  Each thread makes every call of its share in turn, all on the same CategoryBuilder.
+  Near-linear speedup means that the calls don't serialize on a shared lock or connection.
+  """
+  from concurrent.futures import ThreadPoolExecutor
+  def CallAll(share):
+    for args in share:
+      fn(*args)
+  stats = {}
+  for threads in range(1, max_threads + 1):
+    shares = [args_list[i::threads] for i in range(threads)]
+    with ThreadPoolExecutor(threads) as executor:
+      start = time.perf_counter()
+      for future in [executor.submit(CallAll, share) for share in shares]:
+        future.result()
+      seconds = time.perf_counter() - start
+    stats[threads] = {'queries_per_second': len(args_list) / seconds if seconds else 0.0}
+    stats[threads]['speedup'] = (stats[threads]['queries_per_second'] /
+                                 (stats[1]['queries_per_second'] or 1.0))
+  return stats
+
+def MeasureAllocations(fn, args_list):
+  """Peak memory allocated by Python during each call, in KB, as traced by tracemalloc."""
+  peaks = []
+  tracemalloc.start()
+  try:
+    for args in args_list:
+      tracemalloc.reset_peak()
+      baseline = tracemalloc.get_traced_memory()[0]
+      fn(*args)
+      peaks.append((tracemalloc.get_traced_memory()[1] - baseline) / 1024.0)
+  finally:
+    tracemalloc.stop()
+  return {'mean_peak_kb': sum(peaks) / len(peaks), 'max_peak_kb': max(peaks)}
+
+def VocabularyBytes(CB):
+  """Bytes held by the csr backend's vocabularies, and what lists and dicts of str would take."""
+  if not hasattr(CB.matrices, 'vocabs'):
+    return None
+  stats = {}
+  for kind, vocab in CB.matrices.vocabs.items():
+    names = vocab.names(range(len(vocab)))
+    # A list of the names, and a dict from name to id.
+    as_objects = (sys.getsizeof(names) + sum(sys.getsizeof(name) for name in names) +
+                  sys.getsizeof(dict.fromkeys(names)) + sum(sys.getsizeof(i) for i in range(len(names))))
+    stats[kind] = {'interned_bytes': vocab.NumBytes(), 'python_objects_bytes': as_objects}
+  return stats
+
+def PeakRssMb():
+  """Peak resident memory of this process and of its waited-for children, in MB."""
+  return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+          'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0}
+
+def DiskMb(path):
+  if os.path.isfile(path):
+    return os.path.getsize(path) / (1024.0 * 1024.0)
+  return sum(os.path.getsize(os.path.join(root, name))
+             for root, _, names in os.walk(path) for name in names) / (1024.0 * 1024.0)
+
+def GitCommit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines=True,
+                                   stderr=subprocess.DEVNULL).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+# Run in a new process by BenchmarkStartup: times importing, opening and a first query.
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import category_builder_util as util
+imported = time.perf_counter()
+CB = util.CategoryBuilder(**json.loads(sys.argv[1]))
+opened = time.perf_counter()
+if CB.warming:
+  CB.warming.join()
+warmed = time.perf_counter()
+CB.ExpandCategory(seeds=json.loads(sys.argv[2]), rho=3.0, n=100, k=100)
+print(json.dumps({'import_seconds': imported - start, 'open_seconds': opened - imported,
+                  'warm_seconds': warmed - opened, 'first_query_seconds': time.perf_counter() - warmed}))
+"""
+
+def BenchmarkStartup(data_dir, backend, seed_lists, runs):
+  """Times new processes from start to their first query, opening the matrices in several ways.
+
+  A hot set is first recorded from seed_lists. Each way is timed runs times, on the
+  first runs seed lists, and the median of each stage is reported. The OS page
+  cache is left as it is, so the matrices' pages are likely to be in memory already.
+  """
+  data_dir = os.path.abspath(data_dir)
+  hot_set = os.path.join(data_dir, 'benchmark_hot_set.json')
+  if os.path.exists(hot_set):
+    os.remove(hot_set)
+  CB = util.CategoryBuilder(data_dir=data_dir, backend=backend, record_hot_set=True)
+  for seeds in seed_lists:
+    CB.ExpandCategory(seeds=seeds, rho=3.0, n=100, k=100)
+  CB.SaveHotSet(hot_set)
+  CB.close()
+  ways = {'checked': {}, 'fast_open': {'fast_open': True},
+          'fast_open_hot_set': {'fast_open': True, 'hot_set': hot_set}}
+  results = {}
+  for way, kwargs in ways.items():
+    kwargs = dict(kwargs, data_dir=data_dir, backend=backend)
+    timings = []
+    for seeds in seed_lists[:runs]:
+      start = time.perf_counter()
+      output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(kwargs),
+                                        json.dumps(seeds)],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines=True)
+      timing = json.loads(output.strip().splitlines()[-1])
+      timing['process_seconds'] = time.perf_counter() - start
+      timings.append(timing)
+    results[way] = dict((stage, sorted(timing[stage] for timing in timings)[len(timings) // 2])
+                        for stage in timings[0])
+  return results
+
+
+def BenchmarkBackendInProcess(*args, **kwargs):
+  """BenchmarkBackend in a new process, so that the peak RSS it reports is that of this backend alone."""
+  import multiprocessing
+  with multiprocessing.get_context('spawn').Pool(1) as pool:
+    return pool.apply(BenchmarkBackend, args, kwargs)
+
+def BenchmarkBackend(data_dir, backend, items, num_queries, jobs, rng, allocations=False, shards=0,
+                     startup_runs=0, threads=0):
+  """Builds backend from scratch in data_dir, then times lookups and queries on it.
+
+  With allocations, the queries are then run again under tracemalloc, to measure
+  the memory they allocate. With threads, row lookups and ExpandCategory are then
+  run from 1 to threads threads at once; see ThreadThroughput. With startup_runs,
+  new processes are then timed up to their first query; see BenchmarkStartup.
+  """
+  results = {}
+  start = time.perf_counter()
+  if backend == 'sqlite':
+    util.create_db(data_dir, jobs=jobs, progress=False, rebuild=True)
+    storage = os.path.join(data_dir, util.SQLITE3_DB)
+  else:
+    import category_builder_csr as csr
+    shutil.rmtree(os.path.join(data_dir, csr.CSR_DIR), ignore_errors=True)
+    csr.create_csr(data_dir)
+    storage = os.path.join(data_dir, csr.CSR_DIR)
+  results['build_seconds'] = time.perf_counter() - start
+  results['disk_mb'] = DiskMb(storage)
+  results['peak_rss_mb_after_build'] = PeakRssMb()
+
+  start = time.perf_counter()
+  CB = util.CategoryBuilder(data_dir=data_dir, backend=backend, shards=shards)
+  results['open_seconds'] = time.perf_counter() - start
+
+  seed_lists = [rng.sample(items, rng.randint(1, 3)) for _ in range(num_queries)]
+  singles = [rng.choice(items) for _ in range(num_queries)]
+  queries = {
+      'get_row_I_TO_F': (CB.matrices.get_row, [('I_TO_F', item) for item in singles]),
+      'ExpandCategory': (lambda seeds: CB.ExpandCategory(seeds=seeds, rho=3.0, n=100, k=100),
+                         [(seeds,) for seeds in seed_lists]),
+      'GetCooccurringItems': (lambda seed: CB.GetCooccurringItems(seed=seed, k=100),
+                              [(seed,) for seed in singles]),
+      'DoAnalogy': (lambda b, c: CB.DoAnalogy(b=b, c=c, squash=100.0, k=10),
+                    [(seeds[0], seed) for seeds, seed in zip(seed_lists, singles)]),
+  }
+  for name, (fn, args_list) in queries.items():
+    results[name] = TimeCalls(fn, args_list)
+  results['peak_rss_mb_after_queries'] = PeakRssMb()
+  if allocations:
+    results['allocations'] = dict((name, MeasureAllocations(fn, args_list))
+                                  for name, (fn, args_list) in queries.items())
+    results['vocabulary_bytes'] = VocabularyBytes(CB)
+  if threads > 0:
+    results['threads'] = dict((name, ThreadThroughput(*queries[name], threads))
+                              for name in ('get_row_I_TO_F', 'ExpandCategory'))
+  CB.close()
+  if startup_runs > 0:
+    results['startup'] = BenchmarkStartup(data_dir, backend, seed_lists, startup_runs)
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Category Builder Benchmark')
+  parser.add_argument('--data_dir', default='benchmark_data',
+                      help="Where to write the synthetic inputs and build the matrices")
+  parser.add_argument('--output', default='benchmark_results.json', help="Where to write the results")
+  parser.add_argument('--backends', default='sqlite', help="Comma-separated backends to benchmark")
+  parser.add_argument('--num_items', default=20000, type=int, help="Distinct items to generate")
+  parser.add_argument('--num_features', default=100000, type=int, help="Distinct features to generate")
+  parser.add_argument('--zipf_exponent', default=1.1, type=float,
+                      help="Exponent of the Zipf laws for row lengths and item popularity")
+  parser.add_argument('--max_row_length', default=5000, type=int,
+                      help="Length of the longest feature row")
+  parser.add_argument('--num_queries', default=200, type=int, help="Queries to time, of each kind")
+  parser.add_argument('--jobs', default=0, type=int, help="Passed to create_db for the sqlite build")
+  parser.add_argument('--shards', default=0, type=int,
+                      help="If > 0, query with the second hop sharded over this many processes")
+  parser.add_argument('--random_seed', default=0, type=int, help="Seed for the data and the queries")
+  parser.add_argument('--allocations', action='store_true',
+                      help="Also measure the memory allocated by each query, with tracemalloc")
+  parser.add_argument('--threads', default=0, type=int,
+                      help="If > 0, also measure row lookup and ExpandCategory throughput "
+                           "from 1 to this many threads sharing one CategoryBuilder")
+  parser.add_argument('--startup_runs', default=5, type=int,
+                      help="Times to start a new process up to its first query, for each way of opening")
+  parser.add_argument('--keep_inputs', action='store_true',
+                      help="Reuse the inputs already in --data_dir instead of generating them")
+  flags = parser.parse_args()
+
+  backends = flags.backends.split(',')
+  for backend in backends:
+    if backend not in util.BACKENDS:
+      parser.error(f"Unknown backend '{backend}', expected one of {util.BACKENDS}")
+
+  params = dict((name, getattr(flags, name)) for name in (
+      'num_items', 'num_features', 'zipf_exponent', 'max_row_length', 'num_queries', 'jobs',
+      'random_seed', 'shards', 'startup_runs', 'threads'))
+  start = time.perf_counter()
+  if flags.keep_inputs:
+    items = ReadKeys(os.path.join(flags.data_dir, util.I_TO_F_INPUT))
+  else:
+    items = GenerateSyntheticInputs(flags.data_dir, num_items=flags.num_items,
+                                    num_features=flags.num_features, exponent=flags.zipf_exponent,
+                                    max_row_length=flags.max_row_length,
+                                    random_seed=flags.random_seed)
+  results = {'commit': GitCommit(), 'params': params,
+             'generate_seconds': time.perf_counter() - start,
+             'input_mb': DiskMb(os.path.join(flags.data_dir, util.I_TO_F_INPUT)) +
+                         DiskMb(os.path.join(flags.data_dir, util.F_TO_I_INPUT)),
+             'backends': {}}
+  for backend in backends:
+    print(f"Benchmarking the {backend} backend")
+    results['backends'][backend] = BenchmarkBackendInProcess(flags.data_dir, backend, items,
+                                                             flags.num_queries, flags.jobs,
+                                                             random.Random(flags.random_seed),
+                                                             allocations=flags.allocations,
+                                                             shards=flags.shards,
+                                                             startup_runs=flags.startup_runs,
+                                                             threads=flags.threads)
+  with open(flags.output, 'w') as f:
+    json.dump(results, f, indent=2)
+  for backend, stats in results['backends'].items():
+    print(f"{backend}: built in {stats['build_seconds']:.1f} s, {stats['disk_mb']:.1f} MB on disk")
+    for query in ('get_row_I_TO_F', 'ExpandCategory', 'GetCooccurringItems', 'DoAnalogy'):
+      print(f"\t{query}: p50 {stats[query]['p50_ms']:.2f} ms, p99 {stats[query]['p99_ms']:.2f} ms, "
+            f"{stats[query]['queries_per_second']:.0f}/s")
+      if 'allocations' in stats:
+        print(f"\t\tallocates {stats['allocations'][query]['mean_peak_kb']:.1f} KB on average")
+    for query, by_threads in stats.get('threads', {}).items():
+      print(f"\t{query} by threads: " + ", ".join(
+          f"{threads}: {thread_stats['queries_per_second']:.0f}/s (x{thread_stats['speedup']:.2f})"
+          for threads, thread_stats in by_threads.items()))
+    for way, startup in stats.get('startup', {}).items():
+      print(f"\tstartup ({way}): import {1000 * startup['import_seconds']:.1f} ms, "
+            f"open {1000 * startup['open_seconds']:.1f} ms, warm {1000 * startup['warm_seconds']:.1f} ms, "
+            f"first query {1000 * startup['first_query_seconds']:.1f} ms, "
+            f"whole process {1000 * startup['process_seconds']:.1f} ms")
+  print(f"Results written to {flags.output}")
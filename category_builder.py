@@ -25,20 +25,24 @@ def GetArgumentParser():
   parser.add_argument('--cutpaste', dest='cutpaste', action='store_true',
                       help='Prints output in a formay easy to cut-paster')
   parser.set_defaults(cutpaste=False)
+  util.add_builder_arguments(parser)
   parser.add_argument('seeds', nargs='+', help="Seeds to expand")
   return parser
 
 
 if __name__ == "__main__":
   args = GetArgumentParser().parse_args()
+  CB = util.builder_from_args(args)
 
-  CB = util.CategoryBuilder(data_dir=".")
-  
   items = CB.ExpandCategory(seeds=args.seeds,
                             rho=args.rho,
-                            n=args.n)
+                            n=args.n,
+                            k=args.expansion_size)
   if args.cutpaste:
     print(', '.join(item[0] for item in items[:args.expansion_size]))
   else:
     for idx, item in enumerate(items[:args.expansion_size]):
         print(f"[{idx}]\t{item[1]:5.3f}\t{item[0]}")
+  if args.profile and not args.server:
+    print(CB.profiler.LastTrace().Report())
+  util.close_builder(CB, args)
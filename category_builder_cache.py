@@ -0,0 +1,150 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent cache of query results, shared by all processes using a data_dir.
+
+Results are kept in a sqlite3 file, compressed, keyed by the query's method and
+normalized parameters, and by the matrices (backend, variant and build) that
+computed them. Results of matrices that have since been rebuilt are dropped when
+the cache is opened. When the results held exceed max_bytes, the least recently
+used ones are evicted. The bytes held are kept as a running total, by triggers,
+so that stores don't sum them.
+"""
+
+import json
+import os.path
+import sqlite3
+import threading
+import time
+
+import category_builder_util as util
+
+RESULT_CACHE_DB = 'cb_result_cache.db'
+
+# Concurrent writers wait up to this long for each other.
+CACHE_TIMEOUT_SECONDS = 10.0
+
+# Eviction goes this far below max_bytes, so that it doesn't run on every store.
+EVICTION_FRACTION = 0.9
+
+
+class ResultCache(object):
+    """The result cache of data_dir for one CategoryBuilder. Safe to share between threads."""
+
+    def __init__(self, data_dir, backend, variant, max_bytes):
+        self.path = os.path.join(data_dir, RESULT_CACHE_DB)
+        self.max_bytes = max_bytes
+        fingerprint = util.matrices_fingerprint(data_dir, backend, variant)
+        self.storage = json.dumps([backend, variant or ''])
+        self.matrices = json.dumps(fingerprint, sort_keys=True)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS RESULTS (query text, storage text, '
+                                    'matrices text, results blob, bytes integer, last_used real, '
+                                    'PRIMARY KEY (query, storage))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS RESULTS_LAST_USED ON RESULTS (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS TOTAL (bytes integer)')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS RESULTS_INSERT AFTER INSERT ON RESULTS '
+                                    'BEGIN update TOTAL set bytes = bytes + new.bytes; END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS RESULTS_DELETE AFTER DELETE ON RESULTS '
+                                    'BEGIN update TOTAL set bytes = bytes - old.bytes; END')
+            if self.connection.execute('select count(*) from TOTAL').fetchone()[0] == 0:
+                self.connection.execute('insert into TOTAL select coalesce(sum(bytes), 0) from RESULTS')
+            self.connection.execute('delete from RESULTS where storage = ? and matrices != ?',
+                                    (self.storage, self.matrices))
+            self.EvictIfFull()
+
+    @property
+    def connection(self):
+        """The calling thread's connection, opened on first use."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=CACHE_TIMEOUT_SECONDS)
+            # Lets readers in other processes go on while one of them writes.
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def close(self):
+        """Closes the connections of all threads."""
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+    @staticmethod
+    def Key(method, **params):
+        return json.dumps([method, params], sort_keys=True)
+
+    def Get(self, key):
+        """The results stored for key by these matrices, or None."""
+        with self.connection:
+            # Another process may still be storing results of the matrices before a rebuild.
+            row = self.connection.execute('select results from RESULTS where query = ? and storage = ? '
+                                          'and matrices = ?', (key, self.storage, self.matrices)).fetchone()
+            if row is not None:
+                self.connection.execute('update RESULTS set last_used = ? where query = ? and storage = ?',
+                                        (time.time(), key, self.storage))
+        with self.lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else util.decode_results(row[0])
+
+    def Put(self, key, results):
+        blob = util.encode_results(results)
+        if len(blob) > self.max_bytes:
+            return
+        with self.connection:
+            # Not 'insert or replace', as rows it replaces don't fire the delete trigger.
+            self.connection.execute('delete from RESULTS where query = ? and storage = ?',
+                                    (key, self.storage))
+            self.connection.execute('insert into RESULTS values (?, ?, ?, ?, ?, ?)',
+                                    (key, self.storage, self.matrices, blob, len(blob), time.time()))
+            self.EvictIfFull()
+
+    def EvictIfFull(self):
+        """Evicts results if those held exceed max_bytes, which another process may have set higher."""
+        total_bytes = self.connection.execute('select bytes from TOTAL').fetchone()[0]
+        if total_bytes > self.max_bytes:
+            self.Evict(total_bytes - int(EVICTION_FRACTION * self.max_bytes))
+
+    def Evict(self, bytes_to_free):
+        """Deletes the least recently used results until bytes_to_free are freed."""
+        freed = 0
+        evicted = []
+        for query, storage, size in self.connection.execute(
+                'select query, storage, bytes from RESULTS order by last_used'):
+            if freed >= bytes_to_free:
+                break
+            evicted.append((query, storage))
+            freed += size
+        self.connection.executemany('delete from RESULTS where query = ? and storage = ?', evicted)
+        with self.lock:
+            self.evictions += len(evicted)
+
+    def Stats(self):
+        """Hits, misses and evictions of this process, and the bytes of results held by all."""
+        stored_bytes = self.connection.execute('select bytes from TOTAL').fetchone()[0]
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'bytes': stored_bytes, 'max_bytes': self.max_bytes}
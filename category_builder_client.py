@@ -0,0 +1,111 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A client for category_builder_server.py, with the same methods as CategoryBuilder."""
+
+import json
+import urllib.error
+import urllib.request
+
+
+class CategoryBuilderClient(object):
+
+  def __init__(self, url='http://127.0.0.1:8080', timeout=600):
+    self.url = url.rstrip('/')
+    self.timeout = timeout
+
+  def Call(self, method, **kwargs):
+    request = urllib.request.Request(f'{self.url}/{method}',
+                                     data=json.dumps(kwargs).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+      with urllib.request.urlopen(request, timeout=self.timeout) as response:
+        return json.load(response)['result']
+    except urllib.error.HTTPError as e:
+      raise RuntimeError(f'{method} failed: {json.load(e).get("error")}') from None
+
+  def Stats(self):
+    with urllib.request.urlopen(f'{self.url}/stats', timeout=self.timeout) as response:
+      return json.load(response)
+
+  def GetItemsGivenWeightedContexts(self, wtd_contexts, k=None):
+    return ToPairs(self.Call('GetItemsGivenWeightedContexts', wtd_contexts=wtd_contexts, k=k))
+
+  def ExpandCategory(self, seeds, rho, n, k=None):
+    return ToPairs(self.Call('ExpandCategory', seeds=seeds, rho=rho, n=n, k=k))
+
+  def ExpandCategoryBatch(self, seed_lists, rho, n, k=None):
+    return [ToPairs(x) for x in self.Call('ExpandCategoryBatch', seed_lists=seed_lists,
+                                          rho=rho, n=n, k=k)]
+
+  def GetCooccurringItems(self, seed, k=None):
+    return ToPairs(self.Call('GetCooccurringItems', seed=seed, k=k))
+
+  def GetCooccurringItemsBatch(self, seeds, k=None):
+    return [ToPairs(x) for x in self.Call('GetCooccurringItemsBatch', seeds=seeds, k=k)]
+
+  def DoAnalogy(self, b, c, squash, semantic_n=100, k=None):
+    return ToPairs(self.Call('DoAnalogy', b=b, c=c, squash=squash, semantic_n=semantic_n, k=k))
+
+  def DoAnalogyBatch(self, b_c_pairs, squash, semantic_n=100, k=None):
+    return [ToPairs(x) for x in self.Call('DoAnalogyBatch', b_c_pairs=b_c_pairs, squash=squash,
+                                          semantic_n=semantic_n, k=k)]
+
+  def ExpandCategoryPage(self, seeds, rho, n, page_size=20):
+    return ToPage(self.Call('ExpandCategoryPage', seeds=seeds, rho=rho, n=n, page_size=page_size))
+
+  def GetCooccurringItemsPage(self, seed, page_size=20):
+    return ToPage(self.Call('GetCooccurringItemsPage', seed=seed, page_size=page_size))
+
+  def DoAnalogyPage(self, b, c, squash, semantic_n=100, page_size=20):
+    return ToPage(self.Call('DoAnalogyPage', b=b, c=c, squash=squash, semantic_n=semantic_n,
+                            page_size=page_size))
+
+  def NextPage(self, page_token, page_size=20):
+    return ToPage(self.Call('NextPage', page_token=page_token, page_size=page_size))
+
+  def NormalizeSeeds(self, seeds):
+    return self.Call('NormalizeSeeds', seeds=seeds)
+
+  def CompleteItems(self, prefix, k=10):
+    return self.Call('CompleteItems', prefix=prefix, k=k)
+
+  def CompleteFeatures(self, prefix, k=10):
+    return self.Call('CompleteFeatures', prefix=prefix, k=k)
+
+  def SuggestItems(self, item, k=10, max_distance=None):
+    return ToPairs(self.Call('SuggestItems', item=item, k=k, max_distance=max_distance))
+
+  def GetSyntacticFeaturesForItem(self, item):
+    return self.Call('GetSyntacticFeaturesForItem', item=item)
+
+  def GetContextualFeaturesForItem(self, item):
+    return self.Call('GetContextualFeaturesForItem', item=item)
+
+  def GetItemsForFeature(self, feature):
+    return self.Call('GetItemsForFeature', feature=feature)
+
+  def RowCacheStats(self):
+    return self.Stats()['row_cache']
+
+  def ResultCacheStats(self):
+    return self.Stats()['result_cache']
+
+
+def ToPairs(result):
+  """JSON turns (item, score) tuples into lists; this turns them back."""
+  return [tuple(x) for x in result]
+
+def ToPage(result):
+  return dict(result, results=ToPairs(result['results']))
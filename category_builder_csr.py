@@ -0,0 +1,613 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Memory-mapped CSR storage for the Category Builder matrices.
+
+The sqlite3 tables keep each row as CSV text, which has to be parsed on every
+lookup. Here items and features are interned to integer ids (see
+category_builder_vocab.py), and each table is stored as three flat arrays
+(offsets, indices, weights), so that looking up a row returns zero-copy slices
+of memory-mapped files. Queries work on ids, and only decode names for results.
+"""
+
+import bz2
+import csv
+import json
+import mmap
+import os.path
+import shutil
+import time
+from array import array
+
+import numpy as np
+
+import category_builder_util as util
+from category_builder_vocab import Vocabulary, write_vocabulary
+
+# Directory, inside data_dir, holding the CSR files.
+CSR_DIR = 'cb_csr'
+META_FILE = 'meta.json'
+
+# Bumped when the layout changes; create_csr rebuilds directories of another version.
+CSR_VERSION = 5
+
+# Build options of a csr variant (see parse_variant), and their defaults: how the
+# weights are stored, and how many entries each F_TO_I and I_TO_F row keeps (0 for all).
+VARIANT_DEFAULTS = {'weights': 'int32', 'f_to_i_top_k': 0, 'i_to_f_top_k': 0}
+WEIGHT_DTYPES = {'int32': np.int32, 'uint16': np.uint16, 'uint8': np.uint8}
+
+# The stored weights are integers; this is what get_row divides them by.
+WEIGHT_DIVISOR = 100
+
+# Use a dense accumulator (one slot per entry in the vocabulary) once a
+# multiplication touches at least this fraction of the vocabulary.
+DENSE_ACCUMULATOR_FRACTION = 0.05
+
+# For each table, the vocabulary of its keys and that of its entries.
+TABLES = {
+    'I_TO_F': ('items', 'features'),
+    'F_TO_I': ('features', 'items'),
+    'I_TO_F_C': ('items', 'features'),
+    'I_TO_F_SYN': ('items', 'features'),
+    'I_TO_F_COOC': ('items', 'features'),
+}
+
+
+def parse_variant(spec):
+    """Parses build options such as 'weights=uint8,f_to_i_top_k=500' into a full dict of them."""
+    options = dict(VARIANT_DEFAULTS)
+    for part in filter(None, (spec or '').split(',')):
+        name, _, value = part.partition('=')
+        name = name.strip()
+        if name not in VARIANT_DEFAULTS:
+            raise ValueError(f"Unknown csr variant option '{name}', expected one of {list(VARIANT_DEFAULTS)}")
+        if name == 'weights':
+            if value not in WEIGHT_DTYPES:
+                raise ValueError(f"Unknown weight type '{value}', expected one of {list(WEIGHT_DTYPES)}")
+            options[name] = value
+        else:
+            options[name] = int(value)
+    return options
+
+
+def variant_dir_name(spec):
+    """CSR_DIR for the default build options, and a name spelling out the options otherwise."""
+    options = parse_variant(spec)
+    if options == VARIANT_DEFAULTS:
+        return CSR_DIR
+    return (f"{CSR_DIR}-{options['weights']}-f{options['f_to_i_top_k']}"
+            f"-i{options['i_to_f_top_k']}")
+
+
+def read_bz2_rows(infile):
+    """Yields (key, [(entry, int weight), ...]) for each line of a bz2 CSV input.
+
+      As in get_row, a repeated entry keeps its first position and last weight.
+    """
+    with bz2.BZ2File(infile) as f:
+        for line in csv.reader(map((lambda x: x.decode('utf-8')), f)):
+            if len(line) % 2 == 0:
+                print(f'Malformed line: >>{line}<<')
+            row = dict(zip(line[1::2], map(int, line[2::2])))
+            yield line[0], list(row.items())
+
+
+def _intern(vocab, name):
+    idx = vocab.get(name)
+    if idx is None:
+        idx = vocab[name] = len(vocab)
+    return idx
+
+
+def _load_rows_into_tmp(infile, tmp_prefix, key_vocab, entry_vocab, expected_size):
+    """Writes rows with provisional (first seen) ids. Returns (keys, lengths)."""
+    keys = array('i')
+    lengths = array('q')
+    seen_keys = set()
+    with open(tmp_prefix + '.indices', 'wb') as indices_file, \
+         open(tmp_prefix + '.weights', 'wb') as weights_file, \
+         util.progress_bar(expected_size) as bar:
+        for key, row in read_bz2_rows(infile):
+            key_id = _intern(key_vocab, key)
+            bar()
+            # get_row only ever sees the first row for a key.
+            if key_id in seen_keys:
+                continue
+            seen_keys.add(key_id)
+            keys.append(key_id)
+            lengths.append(len(row))
+            array('i', (_intern(entry_vocab, e) for e, _ in row)).tofile(indices_file)
+            array('i', (wt for _, wt in row)).tofile(weights_file)
+    return keys, lengths
+
+
+def _sorted_vocab(vocab):
+    """Returns (sorted names, map from provisional id to id in sorted order)."""
+    names = sorted(vocab)
+    remap = np.empty(len(names), dtype=np.int32)
+    for new_id, name in enumerate(names):
+        remap[vocab[name]] = new_id
+    return names, remap
+
+
+def _write_table(out_dir, table_name, tmp_prefix, keys, lengths, key_remap, entry_remap):
+    """Reorders rows by final key id and writes offsets/indices/weights."""
+    num_keys = len(key_remap)
+    final_keys = key_remap[np.frombuffer(keys, dtype=np.int32)]
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    tmp_starts = np.concatenate(([0], np.cumsum(lengths)))
+
+    counts = np.zeros(num_keys, dtype=np.int64)
+    counts[final_keys] = lengths
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    np.save(os.path.join(out_dir, f'{table_name}.offsets.npy'), offsets)
+
+    total = int(offsets[-1])
+    tmp_indices = np.memmap(tmp_prefix + '.indices', dtype=np.int32, mode='r')
+    tmp_weights = np.memmap(tmp_prefix + '.weights', dtype=np.int32, mode='r')
+    indices = np.lib.format.open_memmap(os.path.join(out_dir, f'{table_name}.indices.npy'),
+                                        mode='w+', dtype=np.int32, shape=(total,))
+    weights = np.lib.format.open_memmap(os.path.join(out_dir, f'{table_name}.weights.npy'),
+                                        mode='w+', dtype=np.int32, shape=(total,))
+    for row_num in np.argsort(final_keys, kind='stable'):
+        start, end = tmp_starts[row_num], tmp_starts[row_num + 1]
+        out_start = offsets[final_keys[row_num]]
+        out_end = out_start + (end - start)
+        indices[out_start:out_end] = entry_remap[tmp_indices[start:end]]
+        weights[out_start:out_end] = tmp_weights[start:end]
+    indices.flush()
+    weights.flush()
+    del tmp_indices, tmp_weights
+    os.remove(tmp_prefix + '.indices')
+    os.remove(tmp_prefix + '.weights')
+
+
+def _write_c_relations_as_i_to_f(out_dir, item_names, feature_names):
+    """The CSR version of add_c_relations_as_i_to_f: transposes non-syntactic F_TO_I rows."""
+    offsets = np.load(os.path.join(out_dir, 'F_TO_I.offsets.npy'))
+    indices = np.load(os.path.join(out_dir, 'F_TO_I.indices.npy'), mmap_mode='r')
+    weights = np.load(os.path.join(out_dir, 'F_TO_I.weights.npy'), mmap_mode='r')
+
+    is_syntactic = np.fromiter((f.startswith('S') for f in feature_names), dtype=bool,
+                               count=len(feature_names))
+    row_features = np.repeat(np.arange(len(feature_names), dtype=np.int32), np.diff(offsets))
+    keep = ~is_syntactic[row_features]
+    c_items = indices[keep]
+    c_features = row_features[keep]
+    c_weights = weights[keep]
+    # Sorted by item, then by decreasing weight (as add_c_relations_as_i_to_f does).
+    order = np.lexsort((c_features, -c_weights.astype(np.int64), c_items))
+
+    counts = np.bincount(c_items, minlength=len(item_names))
+    np.save(os.path.join(out_dir, 'I_TO_F_C.offsets.npy'),
+            np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+    np.save(os.path.join(out_dir, 'I_TO_F_C.indices.npy'), c_features[order])
+    np.save(os.path.join(out_dir, 'I_TO_F_C.weights.npy'), c_weights[order])
+
+
+def _write_i_to_f_split(out_dir, features):
+    """The CSR version of split_i_to_f: a table per feature type, each a range of feature ids."""
+    offsets = np.load(os.path.join(out_dir, 'I_TO_F.offsets.npy'))
+    indices = np.load(os.path.join(out_dir, 'I_TO_F.indices.npy'), mmap_mode='r')
+    weights = np.load(os.path.join(out_dir, 'I_TO_F.weights.npy'), mmap_mode='r')
+    row_items = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    for prefix, table_name in util.I_TO_F_SPLITS.items():
+        lo, hi = features.prefix_range(prefix)
+        keep = (indices >= lo) & (indices < hi)
+        counts = np.bincount(row_items[keep], minlength=len(offsets) - 1)
+        np.save(os.path.join(out_dir, f'{table_name}.offsets.npy'),
+                np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+        np.save(os.path.join(out_dir, f'{table_name}.indices.npy'), indices[keep])
+        np.save(os.path.join(out_dir, f'{table_name}.weights.npy'), weights[keep])
+
+
+def _prune_table(out_dir, table_name, top_k, exempt=None):
+    """Keeps the top_k entries of each row by weight (ties in row order), in their row order.
+
+      Entries whose ids are in range(*exempt), if given, are all kept, and don't count towards top_k.
+    """
+    offsets = np.load(os.path.join(out_dir, f'{table_name}.offsets.npy'))
+    lengths = np.diff(offsets)
+    if top_k <= 0 or lengths.max(initial=0) <= top_k:
+        return
+    indices = np.load(os.path.join(out_dir, f'{table_name}.indices.npy'))
+    weights = np.load(os.path.join(out_dir, f'{table_name}.weights.npy'))
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    is_exempt = np.zeros(len(indices), dtype=bool)
+    if exempt is not None:
+        is_exempt = (indices >= exempt[0]) & (indices < exempt[1])
+    # Within each row, the entries that count come first, by decreasing weight.
+    order = np.lexsort((np.arange(len(weights)), -weights.astype(np.int64), is_exempt, rows))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - offsets[rows[order]]
+    keep = (rank < top_k) | is_exempt
+    counts = np.bincount(rows[keep], minlength=len(lengths))
+    np.save(os.path.join(out_dir, f'{table_name}.offsets.npy'),
+            np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+    np.save(os.path.join(out_dir, f'{table_name}.indices.npy'), indices[keep])
+    np.save(os.path.join(out_dir, f'{table_name}.weights.npy'), weights[keep])
+
+
+def _quantize_weights(out_dir, table_name, weight_type):
+    """Stores a table's weights as weight_type.
+
+      Weights that all fit are stored as they are. Otherwise each is replaced by the
+      code of the nearest of up to 2^bits levels, taken at evenly spaced quantiles, and
+      the levels (already divided by WEIGHT_DIVISOR) are saved as the table's codebook.
+    """
+    path = os.path.join(out_dir, f'{table_name}.weights.npy')
+    weights = np.load(path)
+    dtype = WEIGHT_DTYPES[weight_type]
+    info = np.iinfo(dtype)
+    if not len(weights) or (weights.min() >= info.min and weights.max() <= info.max):
+        np.save(path, weights.astype(dtype))
+        return
+    levels = np.unique(np.quantile(weights, np.linspace(0.0, 1.0, info.max + 1)))
+    codes = np.searchsorted((levels[1:] + levels[:-1]) / 2.0, weights)
+    np.save(path, codes.astype(dtype))
+    np.save(os.path.join(out_dir, f'{table_name}.codebook.npy'), levels / WEIGHT_DIVISOR)
+
+
+def create_csr(data_dir, verbose=False, variant=None):
+    """Converts the pair of CSV inputs to memory-mapped CSR matrices.
+
+      This is a no-op if the CSR directory is complete. variant (see parse_variant)
+      selects smaller, lossy builds, each written to a directory of its own.
+    """
+    options = parse_variant(variant)
+    out_dir = os.path.join(data_dir, variant_dir_name(variant))
+    i_to_f_input = os.path.join(data_dir, util.I_TO_F_INPUT)
+    f_to_i_input = os.path.join(data_dir, util.F_TO_I_INPUT)
+
+    if verbose:
+        print(f"Checking if we need to produce '{out_dir}' from '{i_to_f_input}' and '{f_to_i_input}")
+
+    meta_path = os.path.join(out_dir, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get('version') == CSR_VERSION:
+                return
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    items, features = {}, {}
+    print("INITIALIZING CSR MATRICES. ONLY DONE ONCE, WILL TAKE A FEW MINUTES.")
+    print(f"Reading matrix 1 of 2: item-to-feature matrix.")
+    i_to_f = _load_rows_into_tmp(i_to_f_input, os.path.join(out_dir, 'I_TO_F'),
+                                 items, features, expected_size=192049)
+    print(f"Reading matrix 2 of 2: feature-to-item matrix.")
+    f_to_i = _load_rows_into_tmp(f_to_i_input, os.path.join(out_dir, 'F_TO_I'),
+                                 features, items, expected_size=1148327)
+
+    print(f"Interning {len(items)} items and {len(features)} features.")
+    item_names, item_remap = _sorted_vocab(items)
+    feature_names, feature_remap = _sorted_vocab(features)
+    del items, features
+    for kind, names in (('items', item_names), ('features', feature_names)):
+        write_vocabulary(os.path.join(out_dir, kind), names)
+
+    print(f"Writing table 1 of 3: item-to-feature matrix.")
+    _write_table(out_dir, 'I_TO_F', os.path.join(out_dir, 'I_TO_F'), *i_to_f,
+                 key_remap=item_remap, entry_remap=feature_remap)
+    # Only syntactic features are pruned: an item's co-occurrence feature is all
+    # GetCooccurringItems has, and would be cut from the rows of frequent items.
+    _prune_table(out_dir, 'I_TO_F', options['i_to_f_top_k'],
+                 exempt=Vocabulary(os.path.join(out_dir, 'features')).prefix_range('C'))
+    print(f"Writing table 2 of 3: feature-to-item matrix.")
+    _write_table(out_dir, 'F_TO_I', os.path.join(out_dir, 'F_TO_I'), *f_to_i,
+                 key_remap=feature_remap, entry_remap=item_remap)
+    _prune_table(out_dir, 'F_TO_I', options['f_to_i_top_k'])
+
+    print(f"Writing table 3 of 3: item-to-feature matrix (contextual).")
+    _write_c_relations_as_i_to_f(out_dir, item_names, feature_names)
+    print(f"Splitting item-to-feature matrix by feature type.")
+    _write_i_to_f_split(out_dir, Vocabulary(os.path.join(out_dir, 'features')))
+    if options['weights'] != VARIANT_DEFAULTS['weights']:
+        print(f"Storing weights as {options['weights']}.")
+        for table_name in TABLES:
+            _quantize_weights(out_dir, table_name, options['weights'])
+
+    # Written last: its presence marks the directory as complete.
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump({'version': CSR_VERSION,
+                   'variant': options,
+                   'num_items': len(item_names),
+                   'num_features': len(feature_names),
+                   'weight_divisor': WEIGHT_DIVISOR}, f)
+
+
+def top_k_order(scores, k=None):
+    """Positions of the k largest scores (all if k is None), in decreasing order.
+
+      Ties are in order of position, as a stable sort would leave them, including
+      which of the scores tied with the k-th make it: argpartition alone would pick
+      among those arbitrarily. So the first k are the first k of all, whatever k.
+    """
+    if k is None or k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    negated = -scores
+    threshold = np.partition(negated, k - 1)[k - 1]
+    above = np.flatnonzero(negated < threshold)
+    tied = np.flatnonzero(negated == threshold)[:k - len(above)]
+    candidates = np.sort(np.concatenate([above, tied]))
+    return candidates[np.argsort(negated[candidates], kind='stable')]
+
+
+class RankedIds(util.LazilyRanked):
+    """A MatrixMultiply result, kept as entry ids and decoded only when read.
+
+      It reads as a list of (name, score) pairs, by decreasing score. When it is
+      fed to another multiplication, or merged with another one, the ids are used
+      directly. Given ranked=False, ids and scores are in no particular order,
+      and are sorted only as far as they are read, as util.RankedResults are
+      (with top_k_order).
+    """
+
+    def __init__(self, vocab, kind, ids, scores, ranked=True):
+        self.vocab = vocab
+        self.kind = kind
+        # The ranked_ids and ranked_scores read so far are sorted, and the
+        # unranked (ids, scores) kept until all of them are.
+        self.unranked = None if ranked else (ids, scores)
+        self.ranked_ids, self.ranked_scores = (ids, scores) if ranked else (ids[:0], scores[:0])
+
+    @property
+    def ids(self):
+        self.rank(len(self))
+        return self.ranked_ids
+
+    @property
+    def scores(self):
+        self.rank(len(self))
+        return self.ranked_scores
+
+    def rank(self, count):
+        """Makes sure the first count entries are ranked."""
+        if self.unranked is None or count <= len(self.ranked_ids):
+            return
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        ids, scores = self.unranked
+        count = max(count, 2 * len(self.ranked_ids), util.RANK_BLOCK)
+        if count >= len(ids) // 2:
+            count = len(ids)
+        order = top_k_order(scores, count)
+        self.ranked_ids, self.ranked_scores = ids[order], scores[order]
+        if count == len(ids):
+            self.unranked = None
+        if trace:
+            trace.Lap('sort', lap)
+
+    def __len__(self):
+        return len(self.ranked_ids) if self.unranked is None else len(self.unranked[0])
+
+    def __getitem__(self, idx):
+        count, idx = util.ranked_prefix(idx, len(self))
+        self.rank(count)
+        if not isinstance(idx, slice):
+            return self.vocab[int(self.ranked_ids[idx])], float(self.ranked_scores[idx])
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        decoded = list(zip(self.vocab.names(self.ranked_ids[idx].tolist()),
+                           self.ranked_scores[idx].tolist()))
+        if trace:
+            trace.Lap('decode', lap)
+        return decoded
+
+    def __iter__(self):
+        yield from self[:util.RANK_BLOCK]
+        yield from self[util.RANK_BLOCK:]
+
+
+class CsrMatrices(object):
+    """Read-only access to the matrices written by create_csr."""
+
+    def __init__(self, csr_dir, shared=None):
+        # With shared, a category_builder_shared.SharedFiles holding the files of
+        # csr_dir, they are read from it instead of being memory-mapped.
+        self.shared = shared
+        if shared is None:
+            with open(os.path.join(csr_dir, META_FILE)) as f:
+                self.meta = json.load(f)
+            map_file = None
+        else:
+            self.meta = json.loads(shared.view(META_FILE).tobytes())
+            map_file = lambda path: shared.bytes(os.path.basename(path))
+        self.weight_divisor = self.meta['weight_divisor']
+        self.vocabs = dict((kind, Vocabulary(os.path.join(csr_dir, kind), map_file=map_file))
+                           for kind in ('items', 'features'))
+        # Quantized tables map their stored weights through a codebook.
+        self.codebooks = {}
+        self.prefix_ranges = {}
+        self.tables = {}
+        for table_name in TABLES:
+            self.tables[table_name] = tuple(
+                self.load_array(csr_dir, f'{table_name}.{part}.npy')
+                for part in ('offsets', 'indices', 'weights'))
+            codebook_name = f'{table_name}.codebook.npy'
+            if self.has_file(csr_dir, codebook_name):
+                self.codebooks[table_name] = self.load_array(csr_dir, codebook_name, mmap_mode=None)
+
+    def has_file(self, csr_dir, file_name):
+        if self.shared is None:
+            return os.path.exists(os.path.join(csr_dir, file_name))
+        return file_name in self.shared
+
+    def load_array(self, csr_dir, file_name, mmap_mode='r'):
+        if self.shared is None:
+            return np.load(os.path.join(csr_dir, file_name), mmap_mode=mmap_mode)
+        return self.shared.array(file_name)
+
+    def key_id(self, table_name, key):
+        """Returns the id of key in the table's key vocabulary, or -1."""
+        return self.vocabs[TABLES[table_name][0]].id(key)
+
+    def get_row_ids(self, table_name, key_id):
+        """Returns (entry ids, integer weights) for the row, as zero-copy slices."""
+        offsets, indices, weights = self.tables[table_name]
+        if key_id < 0:
+            return indices[:0], weights[:0]
+        start, end = offsets[key_id], offsets[key_id + 1]
+        return indices[start:end], weights[start:end]
+
+    def weight_values(self, table_name, weights):
+        """The weights of a table's row, as stored, turned into the floats get_row returns."""
+        codebook = self.codebooks.get(table_name)
+        if codebook is not None:
+            return codebook[weights]
+        return weights / self.weight_divisor
+
+    def get_row(self, table_name, key):
+        """Same as category_builder_util.get_row: a dict from entry to weight."""
+        entry_ids, weights = self.get_row_ids(table_name, self.key_id(table_name, key))
+        return dict(zip(self.vocabs[TABLES[table_name][1]].names(entry_ids.tolist()),
+                        self.weight_values(table_name, weights).tolist()))
+
+    def Keys(self, table_name):
+        """The keys of a table's non-empty rows, sorted."""
+        offsets = self.tables[table_name][0]
+        return self.vocabs[TABLES[table_name][0]].names(np.flatnonzero(np.diff(offsets)).tolist())
+
+    def Warm(self, table_name, keys):
+        """Reads a value from each page of the rows for keys, so that their pages are in memory."""
+        offsets, indices, weights = self.tables[table_name]
+        for key in keys:
+            key_id = self.key_id(table_name, key)
+            if key_id < 0:
+                continue
+            start, end = offsets[key_id], offsets[key_id + 1]
+            for values in (indices, weights):
+                values[start:end:max(1, mmap.PAGESIZE // values.itemsize)].sum()
+
+    def Batch(self):
+        # Rows are memory-mapped, so there is nothing to fetch ahead of a batch.
+        return self
+
+    def prefetch(self, table_name, keys):
+        pass
+
+    def prefix_range(self, kind, prefix):
+        """Names in a vocabulary are sorted, so those starting with prefix are a range of ids."""
+        if (kind, prefix) not in self.prefix_ranges:
+            self.prefix_ranges[(kind, prefix)] = self.vocabs[kind].prefix_range(prefix)
+        return self.prefix_ranges[(kind, prefix)]
+
+    def multiply_ids(self, table_name, key_ids, key_weights, rho=0.0, prefix=None):
+        """Sums the weighted rows for key_ids, on integer ids.
+
+          Like MatrixMultiply, an entry's total is scaled by pow(fraction, rho), where
+          fraction is the share of keys whose row has it. Returns (entry ids, scores),
+          with entry ids in increasing order.
+        """
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        entry_range = None
+        if prefix is not None:
+            entry_range = self.prefix_range(TABLES[table_name][1], prefix)
+        parts_idx, parts_wt = [], []
+        for key_id, key_weight in zip(key_ids, key_weights):
+            entry_ids, weights = self.get_row_ids(table_name, key_id)
+            if entry_range is not None:
+                keep = (entry_ids >= entry_range[0]) & (entry_ids < entry_range[1])
+                entry_ids, weights = entry_ids[keep], weights[keep]
+            parts_idx.append(entry_ids)
+            parts_wt.append(key_weight * self.weight_values(table_name, weights))
+        all_idx = np.concatenate(parts_idx) if parts_idx else np.empty(0, dtype=np.int32)
+        if trace:
+            lap = trace.Lap('fetch', lap)
+            trace.rows_fetched[table_name] += len(key_ids)
+            trace.postings[table_name] += len(all_idx)
+        if not len(all_idx):
+            return all_idx, np.empty(0)
+        all_wt = np.concatenate(parts_wt)
+
+        num_entries = len(self.vocabs[TABLES[table_name][1]])
+        if len(all_idx) >= DENSE_ACCUMULATOR_FRACTION * num_entries:
+            counts = np.bincount(all_idx, minlength=num_entries)
+            entries = np.flatnonzero(counts)
+            scores = np.bincount(all_idx, weights=all_wt, minlength=num_entries)[entries]
+            counts = counts[entries]
+        else:
+            entries, inverse = np.unique(all_idx, return_inverse=True)
+            scores = np.bincount(inverse, weights=all_wt, minlength=len(entries))
+            counts = np.bincount(inverse, minlength=len(entries))
+        if trace:
+            lap = trace.Lap('accumulate', lap)
+            trace.accumulated[table_name] += len(entries)
+
+        if rho:
+            # Now we penalize contexts not seen with all items.
+            scores *= np.power(counts / len(key_weights), rho)
+        if trace:
+            trace.Lap('penalty', lap)
+        return entries, scores
+
+    def MatrixMultiply(self, table_name, wtd_seeds, rho=0.0, prefix=None, k=None):
+        """The vectorized equivalent of category_builder_util.MatrixMultiply, as RankedIds.
+
+          wtd_seeds may be RankedIds of the table's keys, whose ids are then used as is.
+        """
+        key_kind, entry_kind = TABLES[table_name]
+        if isinstance(wtd_seeds, RankedIds) and wtd_seeds.kind == key_kind:
+            key_ids, key_weights = wtd_seeds.ids, wtd_seeds.scores
+        else:
+            key_vocab = self.vocabs[key_kind]
+            key_ids = [key_vocab.id(s) for s, _ in wtd_seeds]
+            key_weights = [wt for _, wt in wtd_seeds]
+        entries, scores = self.multiply_ids(table_name, key_ids, key_weights, rho=rho, prefix=prefix)
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        if k is None:
+            # All of them are wanted, but only the first ones may be read.
+            return RankedIds(self.vocabs[entry_kind], entry_kind, entries, scores, ranked=False)
+        # Entries come in id order, which is name order, so ties are broken by name.
+        order = top_k_order(scores, k)
+        if trace:
+            trace.Lap('sort', lap)
+        return RankedIds(self.vocabs[entry_kind], entry_kind, entries[order], scores[order])
+
+    def MergeScores(self, a_scores, b_scores, squash=100.0, k=None):
+        """The vectorized equivalent of category_builder_util.MergeScores, on RankedIds."""
+        if not (isinstance(a_scores, RankedIds) and isinstance(b_scores, RankedIds)
+                and a_scores.kind == b_scores.kind):
+            return util.MergeScores(a_scores, b_scores, squash=squash, k=k)
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        # Totals are kept in id order, so that ties are broken by name.
+        a_order = np.argsort(a_scores.ids)
+        a_sorted = a_scores.ids[a_order]
+        a_values = a_scores.scores[a_order]
+        total = squash * a_values / (squash - 1.0 + a_values)
+        pos = np.minimum(np.searchsorted(a_sorted, b_scores.ids), max(len(a_sorted) - 1, 0))
+        if len(a_sorted):
+            in_a = a_sorted[pos] == b_scores.ids
+            b_values = b_scores.scores[in_a]
+            total[pos[in_a]] += squash * b_values / (squash - 1.0 + b_values)
+        if k is None:
+            merged = RankedIds(a_scores.vocab, a_scores.kind, a_sorted, total, ranked=False)
+        else:
+            order = top_k_order(total, k)
+            merged = RankedIds(a_scores.vocab, a_scores.kind, a_sorted[order], total[order])
+        if trace:
+            trace.Lap('merge', lap)
+        return merged
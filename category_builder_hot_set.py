@@ -0,0 +1,109 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hot sets: the rows that queries read most, recorded from real traffic.
+
+A new process given a hot set reads its rows, hottest first, while it waits for
+its first queries, so that their index and row pages are in memory by the time
+queries need them (and, with a row cache, the decoded rows too). The file is
+JSON, holding how often each row of each table was read. Saving adds to the
+counts already there, so many short-lived processes can each record their share.
+Saves take turns, holding a lock on a file next to it.
+"""
+
+import json
+import os
+import threading
+from collections import Counter, defaultdict
+
+# Rows of each table read by warm.
+HOT_SET_ROWS = 10000
+
+# Rows of each table kept in the file: the most read ones.
+SAVED_ROWS = 100000
+
+
+class RecordingMatrices(object):
+    """Wraps the matrices of a CategoryBuilder, counting the rows its queries read."""
+
+    def __init__(self, matrices, counts=None, lock=None):
+        self.matrices = matrices
+        self.counts = defaultdict(Counter) if counts is None else counts
+        self.lock = lock or threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.matrices, name)
+
+    def record(self, table_name, keys):
+        with self.lock:
+            self.counts[table_name].update(keys)
+
+    def get_row(self, table_name, key):
+        self.record(table_name, [key])
+        return self.matrices.get_row(table_name, key)
+
+    def Batch(self):
+        # Rows prefetched for a batch are counted as its queries multiply them.
+        return RecordingMatrices(self.matrices.Batch(), self.counts, self.lock)
+
+    def MatrixMultiply(self, table_name, wtd_seeds, rho=0.0, prefix=None, k=None):
+        self.record(table_name, [s for s, _ in wtd_seeds])
+        return self.matrices.MatrixMultiply(table_name, wtd_seeds, rho=rho, prefix=prefix, k=k)
+
+    def Save(self, path):
+        """Adds the counts recorded since the last save to those in path."""
+        with self.lock:
+            counts, self.counts = self.counts, defaultdict(Counter)
+        save_hot_set(path, counts)
+
+
+def read_counts(path):
+    counts = defaultdict(Counter)
+    if os.path.exists(path):
+        with open(path) as f:
+            for table_name, table_counts in json.load(f).items():
+                counts[table_name].update(table_counts)
+    return counts
+
+
+def save_hot_set(path, counts):
+    """Adds counts, a dict from table name to a Counter of keys, to the hot set in path."""
+    import fcntl
+    import tempfile
+    # Other processes, such as the server's workers, may be saving to path too. The lock
+    # is on a file of its own, as path is replaced rather than written.
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        total = read_counts(path)
+        for table_name, table_counts in counts.items():
+            total[table_name].update(table_counts)
+        saved = dict((table_name, dict(table_counts.most_common(SAVED_ROWS)))
+                     for table_name, table_counts in total.items())
+        # Written next to path and renamed over it, so that readers never see half of it.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, path)
+
+
+def read_hot_set(path, rows=HOT_SET_ROWS):
+    """A dict from table name to its most read rows' keys in path, hottest first."""
+    return dict((table_name, [key for key, _ in table_counts.most_common(rows)])
+                for table_name, table_counts in read_counts(path).items())
+
+
+def warm(matrices, hot_set):
+    """Reads the rows of hot_set, as returned by read_hot_set, with matrices.Warm."""
+    for table_name, keys in hot_set.items():
+        matrices.Warm(table_name, keys)
@@ -0,0 +1,189 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Precomputed single-seed expansions and co-occurring items.
+
+With a single seed, rho does not matter, so the top_k items of
+ExpandCategory([item], n=n) and of GetCooccurringItems(item) can be computed once
+per item, offline, and then looked up instead of multiplied. DoAnalogy needs one
+of each, and is answered from the index whenever the lists it holds suffice.
+
+The index is a sqlite3 file with one compressed row of results per kind and item.
+It records the matrices it was computed from, and is ignored once they change.
+"""
+
+import contextlib
+import io
+import json
+import os.path
+import sqlite3
+import threading
+import time
+
+import category_builder_util as util
+
+INDEX_DB = 'cb_single_seed.db'
+
+# Items per task handed to a worker. Results are committed a task at a time.
+CHUNK_ITEMS = 200
+
+# The CategoryBuilder of each worker process, set by init_worker.
+worker_CB = None
+
+
+def init_worker(data_dir, backend, variant):
+    global worker_CB
+    worker_CB = util.CategoryBuilder(data_dir=data_dir, backend=backend, variant=variant,
+                                     use_index=False)
+
+
+def compute_chunk(task):
+    """Returns (kind, item, encoded results) for each item of a task."""
+    kind, items, n, top_k = task
+    rows = []
+    # Items without contexts are reported by the queries; the index simply leaves them out.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for item in items:
+            if kind == SingleSeedIndex.EXPANSION:
+                results = worker_CB.ExpandCategory(seeds=[item], rho=1, n=n, k=top_k)
+            else:
+                results = worker_CB.GetCooccurringItems(seed=item, k=top_k)
+            if results:
+                rows.append((kind, item, util.encode_results(results)))
+    return rows
+
+
+def build_index(data_dir, backend='sqlite', variant=None, n=100, top_k=500, jobs=1, progress=True):
+    """Computes the index for every item with syntactic or co-occurrence features.
+
+      Tasks are spread over jobs processes, and the results of each are committed as
+      it completes, so running this again after an interruption resumes the work.
+      An index computed with other parameters or from other matrices is started over.
+    """
+    import multiprocessing
+    util.BuildMatrices(data_dir, backend, variant=variant)
+    params = json.dumps({'n': n, 'top_k': top_k,
+                         'matrices': util.matrices_fingerprint(data_dir, backend, variant)},
+                        sort_keys=True)
+    connection = sqlite3.connect(os.path.join(data_dir, INDEX_DB))
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS META (params text)')
+    cursor.execute('CREATE TABLE IF NOT EXISTS RESULTS '
+                   '(kind text, item text, results blob, PRIMARY KEY (kind, item))')
+    stored = [row[0] for row in cursor.execute('select params from META')]
+    if stored != [params]:
+        if stored:
+            print("The index was computed with other parameters or matrices, starting over.")
+        cursor.execute('delete from META')
+        cursor.execute('delete from RESULTS')
+        cursor.execute('insert into META values (?)', (params,))
+        connection.commit()
+
+    init_worker(data_dir, backend, variant)
+    try:
+        tasks = []
+        for kind, table_name in ((SingleSeedIndex.EXPANSION, 'I_TO_F_SYN'),
+                                 (SingleSeedIndex.COOCCURRENCE, 'I_TO_F_COOC')):
+            # Items left out for lack of contexts are computed again on resuming, quickly.
+            done = set(row[0] for row in
+                       cursor.execute('select item from RESULTS where kind = ?', (kind,)))
+            items = [item for item in worker_CB.matrices.Keys(table_name) if item not in done]
+            tasks += [(kind, items[start:start + CHUNK_ITEMS], n, top_k)
+                      for start in range(0, len(items), CHUNK_ITEMS)]
+        print(f"Computing {len(tasks)} tasks of up to {CHUNK_ITEMS} items each.")
+
+        with contextlib.ExitStack() as stack:
+            if jobs > 1:
+                pool = stack.enter_context(multiprocessing.Pool(
+                    jobs, initializer=init_worker, initargs=(data_dir, backend, variant)))
+                results = pool.imap_unordered(compute_chunk, tasks)
+            else:
+                results = map(compute_chunk, tasks)
+            bar = stack.enter_context(util.progress_bar(len(tasks), progress))
+            for rows in results:
+                cursor.executemany('insert into RESULTS values (?, ?, ?)', rows)
+                connection.commit()
+                bar()
+    finally:
+        # The workers' CategoryBuilders go with their processes; this one, opened here
+        # to list the items, is closed.
+        worker_CB.close()
+        connection.close()
+
+
+class SingleSeedIndex(object):
+    """Read access to the index written by build_index. Safe to share between threads."""
+
+    # The kinds of results held.
+    EXPANSION = 'expansion'
+    COOCCURRENCE = 'cooccurrence'
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        params = json.loads(self.cursor.execute('select params from META').fetchone()[0])
+        self.n = params['n']
+        self.top_k = params['top_k']
+        self.matrices = params['matrices']
+
+    @staticmethod
+    def Open(data_dir, backend, variant=None):
+        """The index in data_dir, or None if there is none for the current matrices of backend."""
+        index_path = os.path.join(data_dir, INDEX_DB)
+        if not os.path.exists(index_path):
+            return None
+        index = SingleSeedIndex(index_path)
+        if index.matrices != util.matrices_fingerprint(data_dir, backend, variant):
+            print(f"Not using {index_path}: it was computed from other matrices.")
+            index.close()
+            return None
+        return index
+
+    @property
+    def cursor(self):
+        """The calling thread's cursor, as in SqliteMatrices."""
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            connection = util.connect_read_only(self.index_path)
+            with self.connections_lock:
+                self.connections.append(connection)
+            cursor = self.local.cursor = connection.cursor()
+        return cursor
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def Get(self, kind, item):
+        """Returns the stored results for item, and whether they are all of them.
+
+          Results are cut at top_k, so fewer than top_k are complete. Both are None
+          and False if the item is not in the index.
+        """
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        row = self.cursor.execute('select results from RESULTS where kind = ? and item = ?',
+                                  (kind, item)).fetchone()
+        if row is None:
+            return None, False
+        results = util.decode_results(row[0])
+        if trace:
+            trace.Lap('index', lap)
+        return results, len(results) < self.top_k
@@ -0,0 +1,107 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Results read a page at a time, with page tokens to read on from where a page ended.
+
+A query's results are ranked lazily (see category_builder_util.RankedResults),
+so its first page only sorts as much as it shows. The results are then kept by
+a cursor, which the page token of the next page names, and later pages go on
+reading them without running the query again. Only the most recently used
+cursors are kept, in each process. A page token also holds the query and where
+its page starts, so if its cursor is gone (evicted, or made by another process,
+such as another server worker), the query is run again, or read from the result
+cache, and skipped to there.
+"""
+
+import base64
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# The queries that can be read a page at a time, by CategoryBuilder method.
+PAGED_METHODS = frozenset(['ExpandCategory', 'GetCooccurringItems', 'DoAnalogy'])
+
+# Cursors kept per process. Each holds every result of its query, unsorted past what was read.
+MAX_CURSORS = 64
+
+
+def encode_page_token(cursor, method, params, offset):
+    fields = {'cursor': cursor, 'method': method, 'params': params, 'offset': offset}
+    return base64.urlsafe_b64encode(json.dumps(fields, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_page_token(page_token):
+    """The (cursor, method, params, offset) of a page token from encode_page_token."""
+    try:
+        fields = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+        cursor, method, params, offset = (fields['cursor'], fields['method'], fields['params'],
+                                          int(fields['offset']))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError(f'Invalid page token {page_token!r}') from None
+    if method not in PAGED_METHODS or not isinstance(params, dict) or offset < 0:
+        raise ValueError(f'Invalid page token {page_token!r}')
+    return cursor, method, params, offset
+
+
+class Cursor(object):
+    """The results of a query being read a page at a time. Reading ranks them, so reads take turns."""
+
+    def __init__(self, results):
+        self.results = results
+        self.lock = threading.Lock()
+
+
+class PageCursors(object):
+    """The cursors of recent paged queries, evicting the least recently used past max_cursors.
+
+      query(method, params) runs a query of PAGED_METHODS, returning its results.
+    """
+
+    def __init__(self, query, max_cursors=MAX_CURSORS):
+        self.query = query
+        self.max_cursors = max_cursors
+        self.cursors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def Page(self, method, params, page_size, page_token=None):
+        """The first page of the query, or with page_token the page after the one it came with.
+
+          Returns {'results': [...], 'next_page_token': ...}, the token being None after the last page.
+        """
+        if page_size < 1:
+            raise ValueError(f'page_size must be at least 1, not {page_size}')
+        cursor, offset = None, 0
+        if page_token is not None:
+            cursor, method, params, offset = decode_page_token(page_token)
+        with self.lock:
+            entry = self.cursors.get(cursor)
+            if entry is not None:
+                self.cursors.move_to_end(cursor)
+        if entry is None:
+            entry = Cursor(self.query(method, params))
+            cursor = os.urandom(8).hex()
+            with self.lock:
+                self.cursors[cursor] = entry
+                while len(self.cursors) > self.max_cursors:
+                    self.cursors.popitem(last=False)
+        with entry.lock:
+            results = list(entry.results[offset:offset + page_size])
+            more = offset + page_size < len(entry.results)
+        if not more:
+            with self.lock:
+                self.cursors.pop(cursor, None)
+            return {'results': results, 'next_page_token': None}
+        return {'results': results,
+                'next_page_token': encode_page_token(cursor, method, params, offset + page_size)}
@@ -0,0 +1,289 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serves a warm CategoryBuilder over local HTTP/JSON.
+
+Each CategoryBuilder method in METHODS is available as POST /<method>, taking
+its keyword arguments as a JSON object and returning {"result": ...}.
+GET /stats returns a latency histogram for each method, and row cache statistics
+(and, with --profile, where the time of each method went).
+See category_builder_client.py for a client.
+"""
+
+import argparse
+import bisect
+import inspect
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import category_builder_pages as cb_pages
+import category_builder_util as util
+
+METHODS = frozenset([
+    'ExpandCategory', 'ExpandCategoryBatch', 'ExpandCategoryPage',
+    'GetCooccurringItems', 'GetCooccurringItemsBatch', 'GetCooccurringItemsPage',
+    'DoAnalogy', 'DoAnalogyBatch', 'DoAnalogyPage', 'NextPage',
+    'GetItemsGivenWeightedContexts',
+    'GetSyntacticFeaturesForItem', 'GetContextualFeaturesForItem', 'GetItemsForFeature',
+    'NormalizeSeeds', 'CompleteItems', 'CompleteFeatures', 'SuggestItems',
+])
+
+
+def IsText(value):
+  return isinstance(value, str)
+
+def IsNumber(value):
+  return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def IsCount(value):
+  return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def IsTexts(value):
+  return isinstance(value, list) and all(map(IsText, value))
+
+# What each argument of METHODS must be, and how to say so.
+ARGUMENTS = {
+    'seeds': (IsTexts, 'a list of strings'),
+    'seed': (IsText, 'a string'), 'b': (IsText, 'a string'), 'c': (IsText, 'a string'),
+    'item': (IsText, 'a string'), 'feature': (IsText, 'a string'), 'prefix': (IsText, 'a string'),
+    'page_token': (IsText, 'a string'),
+    'rho': (IsNumber, 'a number'), 'squash': (IsNumber, 'a number'),
+    'n': (IsCount, 'a non-negative integer'), 'semantic_n': (IsCount, 'a non-negative integer'),
+    'k': (lambda value: value is None or IsCount(value), 'null or a non-negative integer'),
+    'max_distance': (lambda value: value is None or IsCount(value), 'null or a non-negative integer'),
+    'page_size': (lambda value: IsCount(value) and value > 0, 'a positive integer'),
+    'seed_lists': (lambda value: isinstance(value, list) and all(map(IsTexts, value)),
+                   'a list of lists of strings'),
+    'b_c_pairs': (lambda value: isinstance(value, list) and
+                  all(IsTexts(pair) and len(pair) == 2 for pair in value),
+                  'a list of [b, c] pairs of strings'),
+    'wtd_contexts': (lambda value: isinstance(value, list) and
+                     all(isinstance(pair, list) and len(pair) == 2 and IsText(pair[0]) and
+                         IsNumber(pair[1]) for pair in value),
+                     'a list of [context, weight] pairs'),
+}
+
+
+def CheckArguments(CB, method, kwargs):
+  """Raises ValueError, answered with a 400, unless method can be called with kwargs.
+
+    A page token is checked to be one the server made, for a query with valid arguments.
+  """
+  try:
+    inspect.signature(getattr(CB, method)).bind(**kwargs)
+  except TypeError as e:
+    raise ValueError(f'{method}: {e}') from None
+  for name, value in kwargs.items():
+    check, expected = ARGUMENTS[name]
+    if not check(value):
+      raise ValueError(f'{method}: {name} must be {expected}, not {value!r}')
+  if 'page_token' in kwargs:
+    _, paged_method, params, _ = cb_pages.decode_page_token(kwargs['page_token'])
+    CheckArguments(CB, paged_method, params)
+
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram(object):
+  """Counts request latencies into LATENCY_BUCKETS_MS (plus one overflow bucket)."""
+
+  def __init__(self):
+    self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    self.total_seconds = 0.0
+
+  def Record(self, seconds):
+    self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, 1000.0 * seconds)] += 1
+    self.total_seconds += seconds
+
+  def Stats(self):
+    count = sum(self.counts)
+    labels = [f'<={ms}ms' for ms in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}ms']
+    return {'count': count,
+            'mean_ms': 1000.0 * self.total_seconds / count if count else 0.0,
+            'buckets': dict(zip(labels, self.counts))}
+
+
+class CategoryBuilderServer(ThreadingHTTPServer):
+  """Answers requests with one CategoryBuilder, kept open for the life of the server.
+
+    Connections are handled by a thread each, and queries run concurrently on a
+    pool of query_threads threads sharing the CategoryBuilder, which is opened on
+    data_dir with builder_kwargs.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, address, data_dir, query_threads=4, listener=None, **builder_kwargs):
+    # With listener, a listening socket shared by forked workers, connections are
+    # accepted from it instead of a socket of this server's own.
+    super().__init__(address, CategoryBuilderRequestHandler, bind_and_activate=listener is None)
+    if listener is not None:
+      self.socket.close()
+      self.socket = listener
+      self.server_address = listener.getsockname()
+    self.executor = ThreadPoolExecutor(max_workers=query_threads)
+    self.CB = util.CategoryBuilder(data_dir=data_dir, **builder_kwargs)
+    self.histograms = defaultdict(LatencyHistogram)
+    self.histograms_lock = threading.Lock()
+
+  def Call(self, method, kwargs):
+    start = time.time()
+    result = self.executor.submit(getattr(self.CB, method), **kwargs).result()
+    with self.histograms_lock:
+      self.histograms[method].Record(time.time() - start)
+    return result
+
+  def Stats(self):
+    with self.histograms_lock:
+      latency = dict((method, histogram.Stats()) for method, histogram in self.histograms.items())
+    stats = {'latency': latency, 'row_cache': self.CB.RowCacheStats(),
+             'result_cache': self.CB.ResultCacheStats()}
+    if self.CB.profiler:
+      stats['profile'] = self.CB.profiler.Stats()
+    return stats
+
+  def server_close(self):
+    super().server_close()
+    self.executor.shutdown()
+
+
+class CategoryBuilderRequestHandler(BaseHTTPRequestHandler):
+
+  def SendJson(self, status, body):
+    # Lazily ranked results are sent as the lists they read as.
+    payload = json.dumps(body, default=list).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def do_GET(self):
+    if self.path == '/stats':
+      self.SendJson(200, self.server.Stats())
+    else:
+      self.SendJson(404, {'error': f'Unknown path {self.path}'})
+
+  def do_POST(self):
+    method = self.path.lstrip('/')
+    if method not in METHODS:
+      self.SendJson(404, {'error': f'Unknown method {method}'})
+      return
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      kwargs = json.loads(self.rfile.read(length) or b'{}')
+      if not isinstance(kwargs, dict):
+        raise ValueError('Expected a JSON object of keyword arguments')
+      CheckArguments(self.server.CB, method, kwargs)
+    except ValueError as e:
+      self.SendJson(400, {'error': str(e)})
+      return
+    # The arguments are valid, so anything raised now is the server's fault.
+    try:
+      result = self.server.Call(method, kwargs)
+    except Exception as e:
+      self.SendJson(500, {'error': f'{type(e).__name__}: {e}'})
+      return
+    self.SendJson(200, {'result': result})
+
+  def log_message(self, format, *args):
+    pass
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Category Builder Server')
+  parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+  parser.add_argument('--port', default=8080, type=int, help="Port to listen on")
+  parser.add_argument('--threads', default=os.cpu_count() or 4, type=int,
+                      help="How many queries to run concurrently")
+  parser.add_argument('--workers', default=1, type=int,
+                      help="Processes answering queries (csr only). With more than one, the matrices are "
+                           "loaded once into shared memory for all of them")
+  # The profile is printed on exit, and its totals are in GET /stats meanwhile.
+  util.add_builder_arguments(parser, [name for name in util.BUILDER_ARGUMENTS if name != 'server'])
+  args = parser.parse_args()
+  if args.workers > 1 and args.backend != 'csr':
+    parser.error("--workers needs --backend=csr")
+
+  shared_block = None
+  shared_memory = args.shared_memory or None
+  if args.workers > 1 and not shared_memory:
+    import category_builder_shared
+    shared_block = category_builder_shared.create_shared_files('.', variant=args.variant)
+    shared_memory = shared_block.name
+
+  def MakeServer(listener=None):
+    return CategoryBuilderServer((args.host, args.port), data_dir=".", query_threads=args.threads,
+                                 listener=listener,
+                                 **dict(util.builder_kwargs(args), shared_memory=shared_memory))
+
+  def Serve(server):
+    # Being stopped with SIGTERM is handled as an interrupt.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+      if server.CB.profiler:
+        print(server.CB.profiler.Report())
+      util.close_builder(server.CB, args)
+
+  if args.workers <= 1:
+    server = MakeServer()
+    print(f"Serving Category Builder on http://{args.host}:{server.server_address[1]}")
+    Serve(server)
+  else:
+    # The workers are forked after the matrices are in shared memory, and all
+    # accept connections from the same socket.
+    listener = socket.create_server((args.host, args.port))
+    print(f"Serving Category Builder on http://{args.host}:{listener.getsockname()[1]} "
+          f"with {args.workers} workers", flush=True)
+    pids = []
+    for _ in range(args.workers):
+      pid = os.fork()
+      if pid == 0:
+        try:
+          Serve(MakeServer(listener))
+        except BaseException:
+          traceback.print_exc()
+        finally:
+          os._exit(0)
+      pids.append(pid)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+      for pid in pids:
+        os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      for pid in pids:
+        try:
+          os.kill(pid, signal.SIGTERM)
+          os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+          pass
+      if shared_block is not None:
+        category_builder_shared.unlink_shared_files(shared_block)
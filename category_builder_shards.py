@@ -0,0 +1,148 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scatter-gather of the second hop of queries over local worker processes.
+
+The F_TO_I rows are split into shards by feature, and each shard is always
+multiplied by the same worker process, so its pages stay in that worker's
+caches. A worker sums the weighted rows of its share of a query's contexts, and
+the coordinator adds up the partial scores of all shards before taking the top k.
+The partial scores are sent whole: an item's total spans shards, so the top k of
+each shard would not be enough to find the overall top k.
+"""
+
+import multiprocessing
+import os
+import time
+import zlib
+from collections import defaultdict
+
+import category_builder_util as util
+
+# The table whose multiplications are sharded.
+SHARDED_TABLE = 'F_TO_I'
+
+# Multiplications with fewer seeds run in the coordinator, where they cost less
+# than the round trip to the workers.
+MIN_SHARDED_SEEDS = 32
+
+# The matrices of each worker process, set by init_shard.
+shard_matrices = None
+
+
+def init_shard(data_dir, backend, variant, shared_memory):
+    global shard_matrices
+    # The coordinator has already built them.
+    shard_matrices = util.OpenMatrices(data_dir, backend, variant=variant, build=False,
+                                       shared_memory=shared_memory)
+
+
+def multiply_shard(table_name, seeds):
+    """The unsorted MatrixMultiply of seeds with rho=0, in a worker.
+
+      For sqlite, seeds and the result are lists of (name, weight). For csr, they are
+      (ids, weights) arrays, as taken and returned by CsrMatrices.multiply_ids.
+    """
+    if isinstance(shard_matrices, util.SqliteMatrices):
+        scores = defaultdict(float)
+        for s, seed_wt in seeds:
+            for entry, wt in shard_matrices.get_row(table_name, s).items():
+                scores[entry] += seed_wt * wt
+        return list(scores.items())
+    key_ids, key_weights = seeds
+    return shard_matrices.multiply_ids(table_name, key_ids, key_weights)
+
+
+def shard_of_name(name, shards):
+    # crc32 rather than hash(), which differs between processes.
+    return zlib.crc32(name.encode('utf-8')) % shards
+
+
+class ShardedMatrices(object):
+    """Wraps the matrices of a CategoryBuilder, running large F_TO_I multiplications on shards.
+
+      Everything else, including multiplications of other tables, goes to the wrapped
+      matrices. Each of the shards worker processes opens the matrices of its own.
+    """
+
+    def __init__(self, matrices, data_dir, backend, variant=None, shards=None, shared_memory=None):
+        self.matrices = matrices
+        self.shards = shards or os.cpu_count() or 1
+        self.pools = [multiprocessing.Pool(1, initializer=init_shard,
+                                           initargs=(data_dir, backend, variant, shared_memory))
+                      for _ in range(self.shards)]
+
+    def __getattr__(self, name):
+        return getattr(self.matrices, name)
+
+    def close(self):
+        for pool in self.pools:
+            pool.terminate()
+        getattr(self.matrices, 'close', lambda: None)()
+
+    def scatter(self, table_name, parts):
+        """Sends the seeds of each shard in parts, a dict, to its worker, and returns the partial results."""
+        pending = [self.pools[shard].apply_async(multiply_shard, (table_name, seeds))
+                   for shard, seeds in parts.items()]
+        return [result.get() for result in pending]
+
+    def MatrixMultiply(self, table_name, wtd_seeds, rho=0.0, prefix=None, k=None):
+        if table_name != SHARDED_TABLE or rho or prefix or len(wtd_seeds) < MIN_SHARDED_SEEDS:
+            return self.matrices.MatrixMultiply(table_name, wtd_seeds, rho=rho, prefix=prefix, k=k)
+        trace = util.active_trace()
+        if trace:
+            lap = time.time()
+        if isinstance(self.matrices, util.SqliteMatrices):
+            merged = self.sqlite_multiply(table_name, wtd_seeds, k)
+        else:
+            merged = self.csr_multiply(table_name, wtd_seeds, k)
+        if trace:
+            trace.Lap('shards', lap)
+            trace.rows_fetched[table_name] += len(wtd_seeds)
+        return merged
+
+    def sqlite_multiply(self, table_name, wtd_seeds, k):
+        parts = defaultdict(list)
+        for s, seed_wt in wtd_seeds:
+            parts[shard_of_name(s, self.shards)].append((s, seed_wt))
+        total_score = defaultdict(float)
+        for partial in self.scatter(table_name, parts):
+            for entry, score in partial:
+                total_score[entry] += score
+        return util.TopK(total_score.items(), k)
+
+    def csr_multiply(self, table_name, wtd_seeds, k):
+        import numpy as np
+        import category_builder_csr as csr
+        key_kind, entry_kind = csr.TABLES[table_name]
+        if isinstance(wtd_seeds, csr.RankedIds) and wtd_seeds.kind == key_kind:
+            key_ids, key_weights = wtd_seeds.ids, wtd_seeds.scores
+        else:
+            key_vocab = self.matrices.vocabs[key_kind]
+            key_ids = np.array([key_vocab.id(s) for s, _ in wtd_seeds], dtype=np.int64)
+            key_weights = np.array([wt for _, wt in wtd_seeds], dtype=np.float64)
+        shard_ids = key_ids % self.shards
+        parts = {}
+        for shard in np.unique(shard_ids).tolist():
+            parts[shard] = (key_ids[shard_ids == shard], key_weights[shard_ids == shard])
+        partials = self.scatter(table_name, parts)
+        entries = np.concatenate([entries for entries, _ in partials] or [np.empty(0, dtype=np.int64)])
+        scores = np.concatenate([scores for _, scores in partials] or [np.empty(0)])
+        entries, inverse = np.unique(entries, return_inverse=True)
+        scores = np.bincount(inverse, weights=scores, minlength=len(entries))
+        if k is None:
+            return csr.RankedIds(self.matrices.vocabs[entry_kind], entry_kind, entries, scores, ranked=False)
+        # np.unique leaves entries in id order, so ties are broken by name, as unsharded.
+        order = csr.top_k_order(scores, k)
+        return csr.RankedIds(self.matrices.vocabs[entry_kind], entry_kind, entries[order], scores[order])
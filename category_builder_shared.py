@@ -0,0 +1,193 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The csr matrices held in shared memory, loaded once for all processes on a host.
+
+create_shared_files copies every file of a csr build (see category_builder_csr)
+into one block of shared memory: the flat offsets, indices and weights arrays of
+each table, and the vocabularies. Processes then attach to the block by name, or
+are forked from one that did, and CsrMatrices reads it in place, so they all use
+the same physical pages and the memory taken does not grow with their number.
+Unlike the memory-mapped files, the block is all in memory from the start, and
+stays there until it is unlinked.
+
+Run as a script, this creates a block, prints its name, and holds it until stopped.
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import category_builder_csr as csr
+import category_builder_util as util
+from category_builder_vocab import STRINGS_SUFFIX
+
+# A block starts with the length of its table of contents, in this many bytes,
+# followed by the table of contents itself, as JSON.
+HEADER_BYTES = 8
+
+# Files start at multiples of this many bytes in a block, so arrays are aligned.
+FILE_ALIGNMENT = 64
+
+
+def aligned(offset):
+    return -(-offset // FILE_ALIGNMENT) * FILE_ALIGNMENT
+
+
+def create_shared_files(data_dir, variant=None, name=None):
+    """Builds the csr matrices if needed, and copies their files into a new block, returned.
+
+      The block is named name, or gets a random name. Whoever creates it unlinks it
+      when it is no longer needed, with unlink_shared_files.
+    """
+    util.BuildMatrices(data_dir, 'csr', variant=variant)
+    csr_dir = os.path.join(data_dir, csr.variant_dir_name(variant))
+    files = {}
+    offset = 0
+    for file_name in sorted(os.listdir(csr_dir)):
+        path = os.path.join(csr_dir, file_name)
+        if file_name.endswith('.npy'):
+            array = np.load(path, mmap_mode='r')
+            files[file_name] = {'offset': offset, 'bytes': array.nbytes,
+                                'dtype': array.dtype.str, 'shape': list(array.shape)}
+        else:
+            files[file_name] = {'offset': offset, 'bytes': os.path.getsize(path)}
+        offset = aligned(offset + files[file_name]['bytes'])
+    contents = json.dumps({'matrices': util.matrices_fingerprint(data_dir, 'csr', variant),
+                           'files': files}).encode('utf-8')
+    start = aligned(HEADER_BYTES + len(contents))
+    block = shared_memory.SharedMemory(name=name, create=True, size=max(1, start + offset))
+    block.buf[:HEADER_BYTES] = len(contents).to_bytes(HEADER_BYTES, 'little')
+    block.buf[HEADER_BYTES:HEADER_BYTES + len(contents)] = contents
+    for file_name, entry in files.items():
+        path = os.path.join(csr_dir, file_name)
+        view = block.buf[start + entry['offset']:start + entry['offset'] + entry['bytes']]
+        if 'dtype' in entry:
+            array = np.load(path, mmap_mode='r')
+            np.frombuffer(view, dtype=array.dtype).reshape(array.shape)[...] = array
+        else:
+            with open(path, 'rb') as f:
+                f.readinto(view)
+        view.release()
+    return block
+
+
+def unlink_shared_files(block):
+    block.close()
+    if sys.version_info < (3, 13):
+        # Processes forked from this one share its resource tracker, so attaching may have
+        # unregistered the block there, and unlink expects it registered.
+        resource_tracker.register(tracker_name(block), 'shared_memory')
+    block.unlink()
+
+
+class ByteSlices(object):
+    """A memoryview whose slices are bytes, as those of the mmap a Vocabulary usually reads."""
+
+    def __init__(self, view):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view)
+
+    def __getitem__(self, idx):
+        return self.view[idx].tobytes()
+
+
+class AttachedBlock(shared_memory.SharedMemory):
+    """A block that arrays may still view when it is collected.
+
+      Its buffer keeps the mapping alive, until the last view of it goes.
+    """
+
+    def __del__(self):
+        pass
+
+
+def map_block(name):
+    """Attaches to the block name.
+
+      Only its creator unlinks it. Before Python 3.13, attaching registers the block
+      with the resource tracker, to be unlinked when the process exits, so that is undone.
+    """
+    if sys.version_info >= (3, 13):
+        return AttachedBlock(name, track=False)
+    block = AttachedBlock(name)
+    resource_tracker.unregister(tracker_name(block), 'shared_memory')
+    return block
+
+
+def tracker_name(block):
+    """The name the resource tracker knows block by."""
+    return block.name if os.name == 'nt' else '/' + block.name
+
+
+class SharedFiles(object):
+    """Read access to the files of a block written by create_shared_files."""
+
+    def __init__(self, name):
+        self.block = map_block(name).buf
+        contents_bytes = int.from_bytes(self.block[:HEADER_BYTES], 'little')
+        contents = json.loads(self.block[HEADER_BYTES:HEADER_BYTES + contents_bytes].tobytes())
+        self.matrices = contents['matrices']
+        self.files = contents['files']
+        self.start = aligned(HEADER_BYTES + contents_bytes)
+
+    def __contains__(self, file_name):
+        return file_name in self.files
+
+    def view(self, file_name):
+        entry = self.files[file_name]
+        return self.block[self.start + entry['offset']:self.start + entry['offset'] + entry['bytes']]
+
+    def array(self, file_name):
+        entry = self.files[file_name]
+        return np.frombuffer(self.view(file_name), dtype=entry['dtype']).reshape(entry['shape'])
+
+    def bytes(self, file_name):
+        if file_name.endswith(STRINGS_SUFFIX):
+            return ByteSlices(self.view(file_name))
+        return self.view(file_name)
+
+
+def open_shared_matrices(name, data_dir, variant=None):
+    """CsrMatrices reading the block name, which must hold the current csr matrices of data_dir."""
+    shared = SharedFiles(name)
+    if shared.matrices != util.matrices_fingerprint(data_dir, 'csr', variant):
+        raise ValueError(f"Shared memory '{name}' holds other matrices than the csr "
+                         f"matrices of '{data_dir}' (variant '{variant or ''}')")
+    return csr.CsrMatrices(os.path.join(data_dir, csr.variant_dir_name(variant)), shared=shared)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Holds the csr matrices in shared memory')
+    util.add_builder_arguments(parser, ('variant',))
+    parser.add_argument('--name', default=None, help="Name of the block, random by default")
+    args = parser.parse_args()
+
+    block = create_shared_files('.', variant=args.variant, name=args.name)
+    print(f"Holding the csr matrices in shared memory '{block.name}' ({block.size / 2**20:.1f} MB). "
+          f"Pass --shared_memory={block.name} to attach.", flush=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        unlink_shared_files(block)
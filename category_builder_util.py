@@ -11,15 +11,28 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import bz2
+
+# Only what opening and querying the matrices needs is imported here, so that
+# short-lived processes start fast; building imports the rest where it is used.
+import collections
+import contextlib
 import csv
+import functools
+import heapq
 import io
 import itertools
+import json
+import os
 import os.path
+import pathlib
 import sqlite3
-from collections import defaultdict
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
 
-from alive_progress import alive_bar
+import category_builder_vocab as vocab
 
 # Filenames for input paths
 I_TO_F_INPUT = 'candidate_release-i-to-f.csv.bz2'
@@ -28,20 +41,111 @@ F_TO_I_INPUT = 'candidate_release-f-to-i.csv.bz2'
 # Sqlite3 database filename.
 SQLITE3_DB = 'cb.db'
 
+# Lines per chunk handed to each parser process when loading in parallel.
+PARALLEL_CHUNK_LINES = 2000
+
+# Rows per executemany when writing I_TO_F_C.
+INSERT_BATCH_ROWS = 10000
+
+# Approximate memory the I_TO_F_C transpose may use for postings before spilling
+# a sorted run to disk, and the estimated size of one posting held in memory.
+TRANSPOSE_MEMORY_BYTES = 512 * 1024 * 1024
+TRANSPOSE_RECORD_BYTES = 200
+# Postings per pickled block in a spilled run.
+TRANSPOSE_BLOCK_RECORDS = 10000
+
+# Applied while loading in parallel: the database is written from scratch, and
+# is only renamed into place once complete, so there is nothing to journal.
+LOAD_PRAGMAS = ('PRAGMA journal_mode = OFF',
+                'PRAGMA synchronous = OFF',
+                'PRAGMA locking_mode = EXCLUSIVE',
+                'PRAGMA temp_store = MEMORY',
+                'PRAGMA cache_size = -1000000')
+
+# Each thread's read-only sqlite3 connection maps up to this much of the
+# database into memory, and keeps a page cache of this many KiB.
+SQLITE_MMAP_BYTES = 8 * 1024 * 1024 * 1024
+SQLITE_CACHE_KB = 64 * 1024
+
+# Storage backends CategoryBuilder can read the matrices from.
+BACKENDS = ('sqlite', 'csr')
+
+# How many keys get_rows puts in a single "IN (...)" (sqlite allows at least 999 parameters).
+SQLITE_MAX_IN_KEYS = 900
+
+# The tables I_TO_F is split into, by the first letter of their features: its
+# syntactic features, and the (at most one) co-occurrence feature of each item.
+I_TO_F_SPLITS = {'S': 'I_TO_F_SYN', 'C': 'I_TO_F_COOC'}
+
+# Vocabulary indexes of the matrices' keys, in a subdirectory per storage, with
+# the fingerprint of the matrices they were built from.
+VOCAB_INDEX_DIR = 'cb_vocab'
+META_FILE = 'meta.json'
+
+# Lazily ranked results are sorted at least this many at a time; see RankedResults.
+RANK_BLOCK = 64
+
+# Results per page of the paged queries, by default; see category_builder_pages.
+PAGE_SIZE = 20
+
+# The column each table is keyed on.
+KEY_FIELDS = {'I_TO_F': 'item', 'F_TO_I': 'feature', 'I_TO_F_C': 'item',
+              'I_TO_F_SYN': 'item', 'I_TO_F_COOC': 'item'}
+# The column holding each table's rows.
+VALUE_FIELDS = {'I_TO_F': 'features', 'F_TO_I': 'items', 'I_TO_F_C': 'features',
+                'I_TO_F_SYN': 'features', 'I_TO_F_COOC': 'features'}
+
+
+@contextlib.contextmanager
+def progress_bar(expected_size, enabled=True):
+    """An alive_bar, or a bar that does nothing if progress is not wanted."""
+    if enabled:
+        from alive_progress import alive_bar
+        with alive_bar(expected_size) as bar:
+            yield bar
+    else:
+        yield lambda *args, **kwargs: None
+
+
+class StageTimer(object):
+    """Records how long each stage of a build takes."""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - start))
 
-def process_bz2file_into_db(infile, table_name, cursor, connection, expected_size):
+    def Report(self):
+        print("Time taken by each stage:")
+        for name, seconds in self.stages:
+            print(f"\t{seconds:8.1f}s\t{name}")
+        print(f"\t{sum(seconds for _, seconds in self.stages):8.1f}s\tTotal")
+
+
+def reserialize_line(line):
+    """Splits a parsed CSV line into its key and the rest, as stored in the tables."""
+    if len(line) % 2 == 0:
+        print(f'Malformed line: >>{line}<<')
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(line[1:])
+    return line[0], output.getvalue().strip()
+
+
+def process_bz2file_into_db(infile, table_name, cursor, connection, expected_size, progress=True):
+    import bz2
     with bz2.BZ2File(infile) as f:
         csv_reader = csv.reader(map((lambda x: x.decode('utf-8')), f))
         line_num = 0
-        with alive_bar(expected_size) as bar:
+        with progress_bar(expected_size, progress) as bar:
             for line in csv_reader:
-                if len(line) % 2 == 0:
-                    print(f'Malformed line: >>{line}<<')
-                output = io.StringIO()
-                writer = csv.writer(output)
-                writer.writerow(line[1:])
-                key, rest = line[0], output.getvalue()
-                cursor.execute(f"insert into {table_name} values (?, ?)", (key, rest.strip()))
+                cursor.execute(f"insert into {table_name} values (?, ?)", reserialize_line(line))
                 line_num += 1
                 if line_num % 100 == 0:
                     connection.commit()
@@ -49,65 +153,398 @@ def process_bz2file_into_db(infile, table_name, cursor, connection, expected_siz
     connection.commit()
 
 
-def add_c_relations_as_i_to_f(data_dir):
-    """The CB paper was optimized for size. For CBC, we need the map available from i_to_f as well."""
-    connection = sqlite3.connect(os.path.join(data_dir, SQLITE3_DB))
+def read_record_chunks(infile, chunk_size=PARALLEL_CHUNK_LINES):
+    """Yields lists of CSV records from a bz2 file, as text. Quoted newlines stay in one record."""
+    import bz2
+    with bz2.BZ2File(infile) as f:
+        chunk = []
+        pending = ''
+        for raw_line in f:
+            record = pending + raw_line.decode('utf-8')
+            # Escaped quotes come in pairs, so an odd count means a field spans lines.
+            if record.count('"') % 2:
+                pending = record
+                continue
+            pending = ''
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if pending:
+            chunk.append(pending)
+        if chunk:
+            yield chunk
+
+
+def reserialize_records(records):
+    return [reserialize_line(line) for line in csv.reader(records)]
+
+
+def queue_reserialized_rows(pool, jobs, infile, table_name, rows_queue):
+    """Decompresses infile in this thread, parses it in pool, and queues rows in file order.
+
+      Puts (table_name, rows, None) for each chunk, then (table_name, None, error).
+    """
+    error = None
+    try:
+        pending = collections.deque()
+        for chunk in read_record_chunks(infile):
+            pending.append(pool.apply_async(reserialize_records, (chunk,)))
+            # Keeps a bounded number of chunks in flight.
+            if len(pending) >= 2 * jobs:
+                rows_queue.put((table_name, pending.popleft().get(), None))
+        while pending:
+            rows_queue.put((table_name, pending.popleft().get(), None))
+    except Exception as e:
+        error = e
+    rows_queue.put((table_name, None, error))
+
+
+def load_bz2files_in_parallel(inputs, connection, jobs, progress=True):
+    """Loads several (infile, table_name, expected_size) in parallel.
+
+      Each input is decompressed by its own thread, and its lines are parsed by a
+      pool of jobs processes. This thread inserts rows, in input order, with executemany.
+    """
+    import multiprocessing
+    import queue
+    rows_queue = queue.Queue(maxsize=4 * jobs)
+    with multiprocessing.Pool(jobs) as pool, \
+         progress_bar(sum(expected_size for _, _, expected_size in inputs), progress) as bar:
+        readers = [threading.Thread(target=queue_reserialized_rows,
+                                    args=(pool, jobs, infile, table_name, rows_queue),
+                                    daemon=True)
+                   for infile, table_name, _ in inputs]
+        for reader in readers:
+            reader.start()
+        remaining = len(readers)
+        while remaining:
+            table_name, rows, error = rows_queue.get()
+            if error is not None:
+                raise error
+            if rows is None:
+                remaining -= 1
+                continue
+            connection.executemany(f"insert into {table_name} values (?, ?)", rows)
+            bar(len(rows))
+        for reader in readers:
+            reader.join()
+    connection.commit()
+
+
+def spill_sorted_run(records, tmp_dir):
+    """Sorts records and writes them to a temporary file, in pickled blocks. Returns its path."""
+    import pickle
+    import tempfile
+    records.sort()
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.run', delete=False) as f:
+        for start in range(0, len(records), TRANSPOSE_BLOCK_RECORDS):
+            pickle.dump(records[start:start + TRANSPOSE_BLOCK_RECORDS], f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        return f.name
+
+
+def read_sorted_run(path):
+    import pickle
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block
+
+
+def add_c_relations_as_i_to_f(data_dir, db_path=None, progress=True, pragmas=(),
+                              max_memory_bytes=TRANSPOSE_MEMORY_BYTES, tmp_dir=None):
+    """The CB paper was optimized for size. For CBC, we need the map available from i_to_f as well.
+
+      This transposes the contextual rows of F_TO_I. Postings are collected as
+      (item, -weight, line, feature) records in sorted runs of about max_memory_bytes,
+      spilled to tmp_dir (by default, data_dir), then merged. Items keep the order in
+      which they are first seen, and each item's features are sorted by decreasing
+      weight, ties in input order.
+    """
+    import bz2
+    import tempfile
+    connection = sqlite3.connect(db_path or os.path.join(data_dir, SQLITE3_DB))
     cursor = connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
 
     f_to_i_input = os.path.join(data_dir, F_TO_I_INPUT)
-    item_to_features = defaultdict(list)
-    with bz2.BZ2File(f_to_i_input) as f:
-        csv_reader = csv.reader(map((lambda x: x.decode('utf-8')), f))
-        line_num = 0
-        with alive_bar(1148327) as bar:
-            for line in csv_reader:
-                line_num += 1
-                if len(line) % 2 == 0:
-                    print(f'Malformed line: >>{line}<<')
-                feature = line[0]
-                if feature.startswith("S"):
+    max_run_records = max(1, max_memory_bytes // TRANSPOSE_RECORD_BYTES)
+    item_order = {}
+    with tempfile.TemporaryDirectory(dir=tmp_dir or data_dir) as run_dir:
+        runs = []
+        records = []
+        with bz2.BZ2File(f_to_i_input) as f:
+            csv_reader = csv.reader(map((lambda x: x.decode('utf-8')), f))
+            line_num = 0
+            with progress_bar(1148327, progress) as bar:
+                for line in csv_reader:
+                    line_num += 1
+                    if len(line) % 2 == 0:
+                        print(f'Malformed line: >>{line}<<')
+                    feature = line[0]
+                    if feature.startswith("S"):
+                        bar()
+                        continue
+                    iterators = [iter(line[1:])] * 2
+                    grouped = [(p[0], int(p[1]))
+                               for p in itertools.zip_longest(*iterators)]
+
+                    item_dict = dict(grouped)
+                    for item, wt in item_dict.items():
+                        item_idx = item_order.setdefault(item, len(item_order))
+                        records.append((item_idx, -int(wt), line_num, feature))
+                    if len(records) >= max_run_records:
+                        runs.append(spill_sorted_run(records, run_dir))
+                        records = []
                     bar()
-                    continue
-                iterators = [iter(line[1:])] * 2
-                grouped = [(p[0], int(p[1]))
-                           for p in itertools.zip_longest(*iterators)]
+        if records:
+            runs.append(spill_sorted_run(records, run_dir))
+            records = []
+        items = list(item_order)
+        del item_order
+
+        cursor.execute(f'CREATE TABLE I_TO_F_C (item text, features text)')
+        connection.commit()
 
-                item_dict = dict(grouped)
-                for item, wt in item_dict.items():
-                    item_to_features[item].append((feature, int(wt)))
+        rows = []
+        merged = heapq.merge(*(read_sorted_run(run) for run in runs))
+        with progress_bar(len(items), progress) as bar:
+            for item_idx, features_sorted in itertools.groupby(merged, key=lambda x: x[0]):
+                row_to_write = []
+                for _, neg_wt, _, f in features_sorted:
+                    row_to_write.append(f)
+                    row_to_write.append(str(-neg_wt))
+                output = io.StringIO()
+                writer = csv.writer(output)
+                writer.writerow(row_to_write)
+                key, rest = items[item_idx], output.getvalue()
+                rows.append((key, rest.strip()))
+                if len(rows) >= INSERT_BATCH_ROWS:
+                    cursor.executemany(f"insert into I_TO_F_C values (?, ?)", rows)
+                    rows = []
                 bar()
-    cursor.execute(f'CREATE TABLE I_TO_F_C (item text, features text)')
+        cursor.executemany(f"insert into I_TO_F_C values (?, ?)", rows)
+        connection.commit()
+
+    print(f"Creating indices.")
+    cursor.execute(f'CREATE INDEX I_TO_F_C_IDX ON I_TO_F_C (item)')
+    connection.commit()
+    connection.close()
+
+
+def has_table(cursor, table_name):
+    cursor.execute("select 1 from sqlite_master where type='table' and name=?", (table_name,))
+    return bool(cursor.fetchall())
+
+
+def serialize_pieces(pieces):
+    """The inverse of csv-parsing a stored row: its fields as one CSV line."""
+    output = io.StringIO()
+    csv.writer(output).writerow(pieces)
+    return output.getvalue().strip()
+
+
+def encode_results(results):
+    """A list of (name, score) results as compressed CSV, for storing."""
+    # repr keeps every digit, so results read back are the ones computed.
+    pieces = [field for name, score in results for field in (name, repr(score))]
+    return zlib.compress(serialize_pieces(pieces).encode('utf-8'))
+
+
+def decode_results(blob):
+    pieces = next(csv.reader([zlib.decompress(blob).decode('utf-8')]), [])
+    return [(pieces[i], float(pieces[i + 1])) for i in range(0, len(pieces), 2)]
+
+
+def split_by_feature_type(pieces):
+    """Splits the (feature, weight) fields of an I_TO_F row by the tables in I_TO_F_SPLITS."""
+    split = defaultdict(list)
+    for feature, wt in itertools.zip_longest(*[iter(pieces)] * 2):
+        split[feature[:1]] += [feature, wt]
+    return dict((table_name, split[prefix]) for prefix, table_name in I_TO_F_SPLITS.items())
+
+
+def split_i_to_f(db_path, progress=True, pragmas=()):
+    """Writes the features of each I_TO_F row to the table in I_TO_F_SPLITS for their type.
+
+      Queries then read just the features they need, instead of filtering whole
+      rows by prefix. Features keep their order, and rows left empty are not written.
+      The tables are filled under temporary names, and only get theirs, together,
+      once complete, so a split that is interrupted leaves no tables behind.
+    """
+    connection = sqlite3.connect(db_path)
+    cursor = connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(pragma)
+    for table_name in I_TO_F_SPLITS.values():
+        cursor.execute(f'DROP TABLE IF EXISTS {table_name}_TMP')
+        cursor.execute(f'CREATE TABLE {table_name}_TMP (item text, features text)')
     connection.commit()
 
-    lines_num = 0
-    with alive_bar(len(item_to_features)) as bar:
-        for item, features in item_to_features.items():
-            features_sorted = sorted(features,
-                                     key=lambda x: -x[1])
-            row_to_write = []
-            for f, wt in features_sorted:
-                row_to_write.append(f)
-                row_to_write.append(str(wt))
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerow(row_to_write)
-            key, rest = item, output.getvalue()
-            cursor.execute(f"insert into I_TO_F_C values (?, ?)", (key, rest.strip()))
-            line_num += 1
-            if line_num % 100 == 0:
-                connection.commit()
+    rows = defaultdict(list)
+    seen = set()
+    with progress_bar(192049, progress) as bar:
+        for item, features in connection.execute('select item, features from I_TO_F order by rowid'):
             bar()
+            # As with get_row, only the first row for an item counts.
+            if item in seen:
+                continue
+            seen.add(item)
+            split = split_by_feature_type(next(csv.reader([features])))
+            for table_name, pieces in split.items():
+                if pieces:
+                    rows[table_name].append((item, serialize_pieces(pieces)))
+                    if len(rows[table_name]) >= INSERT_BATCH_ROWS:
+                        cursor.executemany(f"insert into {table_name}_TMP values (?, ?)",
+                                           rows[table_name])
+                        rows[table_name] = []
+    for table_name, table_rows in rows.items():
+        cursor.executemany(f"insert into {table_name}_TMP values (?, ?)", table_rows)
+    for table_name in I_TO_F_SPLITS.values():
+        cursor.execute(f'CREATE INDEX {table_name}_IDX ON {table_name}_TMP (item)')
     connection.commit()
 
-    print(f"Creating indices.")
-    cursor.execute(f'CREATE INDEX I_TO_F_C_IDX ON I_TO_F_C (item)')
+    # Both tables appear at once: databases having them are taken as split.
+    cursor.execute('BEGIN')
+    for table_name in I_TO_F_SPLITS.values():
+        cursor.execute(f'ALTER TABLE {table_name}_TMP RENAME TO {table_name}')
+    connection.commit()
+    connection.close()
+
+
+def is_split(db_path):
+    """Whether the database at db_path has the tables of I_TO_F_SPLITS; see split_i_to_f."""
+    connection = sqlite3.connect(db_path)
+    split = all(has_table(connection.cursor(), table_name) for table_name in I_TO_F_SPLITS.values())
+    connection.close()
+    return split
+
+
+def read_raw_row(cursor, table_name, key):
+    """Returns (rowid, {entry: weight as stored}) for the row get_row would read, or (None, {})."""
+    cursor.execute(f"select rowid, * from {table_name} where {KEY_FIELDS[table_name]}=? "
+                   "order by rowid limit 1", (key,))
+    results = cursor.fetchall()
+    if not results:
+        return None, {}
+    pieces = next(csv.reader([results[0][2]]))
+    return results[0][0], dict(itertools.zip_longest(*[iter(pieces)] * 2))
+
+
+def write_raw_row(cursor, table_name, rowid, key, row):
+    """Writes {entry: weight} as the row with rowid (a new row if None), by decreasing weight.
+
+      Ties keep their order in row.
+    """
+    pieces = []
+    for entry, wt in sorted(row.items(), key=lambda x: -float(x[1])):
+        pieces += [entry, wt]
+    if rowid is None:
+        cursor.execute(f"insert into {table_name} values (?, ?)", (key, serialize_pieces(pieces)))
+    else:
+        cursor.execute(f"update {table_name} set {VALUE_FIELDS[table_name]}=? where rowid=?",
+                       (serialize_pieces(pieces), rowid))
+
+
+def merge_weights(old_wt, new_wt, mode):
+    if mode == 'add' and old_wt is not None:
+        return str(int(old_wt) + int(new_wt))
+    return new_wt
+
+
+# How merge_delta combines the weight of an entry already in a row with its weight in the delta.
+DELTA_MODES = ('add', 'replace')
+
+
+def merge_delta(data_dir, delta_dir, mode='add', progress=True):
+    """Merges new counts into an existing database, in time proportional to their size.
+
+      delta_dir holds either or both of the input files (same names and format), with
+      rows for new or changed keys. Each delta entry is added to the stored weight of
+      the same entry ('add'), or replaces it ('replace'); new entries and keys are
+      inserted. Merged rows are re-sorted by decreasing weight. I_TO_F_C is updated for
+      the contextual F_TO_I rows of the delta, and the I_TO_F splits for its I_TO_F rows.
+      Everything is written in one transaction. As when rows are read, only the first
+      line for a key counts, and only the first weight for an entry within it.
+
+      Whatever was computed from the database is then stale, and rebuilt in full: the
+      vocabulary index by the next BuildMatrices, the single-seed index by build_index,
+      and cached results are dropped.
+    """
+    import bz2
+    if mode not in DELTA_MODES:
+        raise ValueError(f"Unknown delta mode '{mode}', expected one of {DELTA_MODES}")
+    db_path = os.path.join(data_dir, SQLITE3_DB)
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"No database to merge into at '{db_path}'; run create_db first")
+    # Adds the I_TO_F splits to a database built before them.
+    create_db(data_dir, progress=progress)
+
+    connection = sqlite3.connect(db_path)
+    cursor = connection.cursor()
+    touched_items = set()
+    c_updates = defaultdict(dict)
+    for input_name, table_name in ((I_TO_F_INPUT, 'I_TO_F'), (F_TO_I_INPUT, 'F_TO_I')):
+        delta_input = os.path.join(delta_dir, input_name)
+        if not os.path.exists(delta_input):
+            continue
+        print(f"Merging {delta_input} into {table_name}.")
+        merged_keys = set()
+        with bz2.BZ2File(delta_input) as f, progress_bar(None, progress) as bar:
+            for line in csv.reader(map((lambda x: x.decode('utf-8')), f)):
+                if len(line) % 2 == 0:
+                    print(f'Malformed line: >>{line}<<')
+                key = line[0]
+                bar()
+                if key in merged_keys:
+                    continue
+                merged_keys.add(key)
+                rowid, row = read_raw_row(cursor, table_name, key)
+                delta_row = {}
+                for entry, wt in itertools.zip_longest(*[iter(line[1:])] * 2):
+                    delta_row.setdefault(entry, wt)
+                for entry, wt in delta_row.items():
+                    row[entry] = merge_weights(row.get(entry), wt, mode)
+                    if table_name == 'F_TO_I' and not key.startswith('S'):
+                        c_updates[entry][key] = row[entry]
+                write_raw_row(cursor, table_name, rowid, key, row)
+                if table_name == 'I_TO_F':
+                    touched_items.add(key)
+
+    print(f"Updating I_TO_F_C for {len(c_updates)} items.")
+    for item, features in c_updates.items():
+        rowid, row = read_raw_row(cursor, 'I_TO_F_C', item)
+        row.update(features)
+        write_raw_row(cursor, 'I_TO_F_C', rowid, item, row)
+
+    print(f"Updating the I_TO_F splits for {len(touched_items)} items.")
+    for item in touched_items:
+        _, row = read_raw_row(cursor, 'I_TO_F', item)
+        pieces = [x for pair in row.items() for x in pair]
+        for table_name, split_pieces in split_by_feature_type(pieces).items():
+            cursor.execute(f"delete from {table_name} where item=?", (item,))
+            if split_pieces:
+                cursor.execute(f"insert into {table_name} values (?, ?)",
+                               (item, serialize_pieces(split_pieces)))
     connection.commit()
+    connection.close()
 
 
-def create_db(data_dir, verbose=False):
+def create_db(data_dir, verbose=False, jobs=0, progress=True, rebuild=False,
+              transpose_memory_bytes=TRANSPOSE_MEMORY_BYTES):
     """Convert a pair of CSV files to a sqlite3 database.
 
-      This is a no-op if outfile exists.
+      This is a no-op if outfile exists, unless rebuild is set. (A database built
+      before I_TO_F was split by feature type only gets the split tables added.)
+
+      If jobs > 0, the inputs are decompressed concurrently and parsed by that many
+      processes, and rows are bulk-inserted with journaling off. The database is then
+      written under a temporary name and only renamed to outfile once complete.
     """
     db_path = os.path.join(data_dir, SQLITE3_DB)
     i_to_f_input = os.path.join(data_dir, I_TO_F_INPUT)
@@ -117,9 +554,20 @@ def create_db(data_dir, verbose=False):
         print(f"Checking if we need to produce '{db_path}' from '{i_to_f_input}' and '{f_to_i_input}")
 
     if os.path.exists(db_path):
-        return
+        if not rebuild:
+            if not is_split(db_path):
+                print(f"Splitting I_TO_F by feature type.")
+                split_i_to_f(db_path, progress=progress)
+            return
+        # With jobs, the old database is only replaced once the new one is complete.
+        if jobs <= 0:
+            os.remove(db_path)
 
-    connection = sqlite3.connect(db_path)
+    build_path = db_path + '.tmp' if jobs > 0 else db_path
+    if jobs > 0 and os.path.exists(build_path):
+        os.remove(build_path)
+    timer = StageTimer()
+    connection = sqlite3.connect(build_path)
     cursor = connection.cursor()
 
     cursor.execute(f'CREATE TABLE I_TO_F (item text, features text)')
@@ -127,33 +575,241 @@ def create_db(data_dir, verbose=False):
     connection.commit()
 
     print("INITIALIZING. ONLY DONE ONCE, WILL TAKE A FEW MINUTES.")
-    print(f"Creating table 1 of 3: item-to-feature matrix.")
-    process_bz2file_into_db(i_to_f_input, 'I_TO_F', cursor, connection, expected_size=192049)
-    print(f"Creating table 2 of 3: feature-to-item matrix.")
-    process_bz2file_into_db(f_to_i_input, 'F_TO_I', cursor, connection, expected_size=1148327)
+    if jobs > 0:
+        for pragma in LOAD_PRAGMAS:
+            cursor.execute(pragma)
+        print(f"Creating tables 1 and 2 of 3: item-to-feature and feature-to-item matrices.")
+        with timer.stage('Tables 1 and 2: I_TO_F and F_TO_I'):
+            load_bz2files_in_parallel([(i_to_f_input, 'I_TO_F', 192049),
+                                       (f_to_i_input, 'F_TO_I', 1148327)],
+                                      connection, jobs=jobs, progress=progress)
+    else:
+        print(f"Creating table 1 of 3: item-to-feature matrix.")
+        with timer.stage('Table 1: I_TO_F'):
+            process_bz2file_into_db(i_to_f_input, 'I_TO_F', cursor, connection,
+                                    expected_size=192049, progress=progress)
+        print(f"Creating table 2 of 3: feature-to-item matrix.")
+        with timer.stage('Table 2: F_TO_I'):
+            process_bz2file_into_db(f_to_i_input, 'F_TO_I', cursor, connection,
+                                    expected_size=1148327, progress=progress)
 
     print(f"Creating indices.")
-    cursor.execute(f'CREATE INDEX I_TO_F_IDX ON I_TO_F (item)')
-    cursor.execute(f'CREATE INDEX F_TO_I_IDX ON F_TO_I (feature)')
-    connection.commit()
+    with timer.stage('Indices on I_TO_F and F_TO_I'):
+        cursor.execute(f'CREATE INDEX I_TO_F_IDX ON I_TO_F (item)')
+        cursor.execute(f'CREATE INDEX F_TO_I_IDX ON F_TO_I (feature)')
+        connection.commit()
+    connection.close()
 
     print(f"Creating table 3 of 3: item-to-feature matrix (contextual).")
-    add_c_relations_as_i_to_f(data_dir=data_dir)
+    with timer.stage('Table 3: I_TO_F_C'):
+        add_c_relations_as_i_to_f(data_dir=data_dir, db_path=build_path, progress=progress,
+                                  pragmas=LOAD_PRAGMAS if jobs > 0 else (),
+                                  max_memory_bytes=transpose_memory_bytes)
+
+    print(f"Splitting I_TO_F by feature type.")
+    with timer.stage('I_TO_F_SYN and I_TO_F_COOC'):
+        split_i_to_f(build_path, progress=progress, pragmas=LOAD_PRAGMAS if jobs > 0 else ())
+
+    if build_path != db_path:
+        os.replace(build_path, db_path)
+    timer.Report()
+
+
+# The QueryTrace being recorded by each thread, if any.
+TRACE_LOCAL = threading.local()
+
+
+def active_trace():
+    """The QueryTrace of the calling thread's current query, or None if not profiling."""
+    return getattr(TRACE_LOCAL, 'trace', None)
+
+
+class QueryTrace(object):
+    """Where the time of one query went.
+
+      Stages are 'select' and 'parse' (sqlite rows), 'fetch' (CSR rows), 'filter',
+      'accumulate', 'penalty', 'sort', 'decode' (CSR ids to strings) and 'merge'
+      (MergeScores). Counters are kept per table. Results returned lazily ranked
+      are sorted and decoded as they are read, which for most methods is after
+      the query returns, so that is not part of their trace (it is for the *Page
+      methods, which read the page themselves).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = defaultdict(float)
+        self.rows_fetched = defaultdict(int)
+        self.postings = defaultdict(int)
+        self.accumulated = defaultdict(int)
+        self.start = time.time()
+        self.total_seconds = 0.0
+
+    def Lap(self, stage, since):
+        """Adds the time since `since` to stage, and returns the current time."""
+        now = time.time()
+        self.seconds[stage] += now - since
+        return now
+
+    def Add(self, other):
+        """Adds in other, the trace of a part of this query that ran in another thread."""
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] += seconds
+        for counts, other_counts in ((self.rows_fetched, other.rows_fetched),
+                                     (self.postings, other.postings),
+                                     (self.accumulated, other.accumulated)):
+            for table_name, count in other_counts.items():
+                counts[table_name] += count
+
+    def Finish(self):
+        self.total_seconds = time.time() - self.start
+
+    def Report(self):
+        lines = [f"Profile of {self.name}: {1000.0 * self.total_seconds:.2f} ms"]
+        for stage, seconds in sorted(self.seconds.items(), key=lambda x: -x[1]):
+            lines.append(f"\t{1000.0 * seconds:9.2f} ms\t{stage}")
+        for table_name in sorted(set(self.rows_fetched) | set(self.postings)):
+            lines.append(f"\t{table_name}: {self.rows_fetched[table_name]} rows fetched, "
+                         f"{self.postings[table_name]} postings touched, "
+                         f"{self.accumulated[table_name]} distinct keys accumulated")
+        return '\n'.join(lines)
+
+
+class Profiler(object):
+    """Records a QueryTrace for each query, and aggregates them by query type."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.queries = defaultdict(int)
+        self.total_seconds = defaultdict(float)
+        self.stage_seconds = defaultdict(lambda: defaultdict(float))
+        self.rows_fetched = defaultdict(lambda: defaultdict(int))
+        self.postings = defaultdict(lambda: defaultdict(int))
+
+    @contextlib.contextmanager
+    def Trace(self, name):
+        """Traces the calling thread's query, unless it is part of one already traced."""
+        if active_trace() is not None:
+            yield active_trace()
+            return
+        trace = TRACE_LOCAL.trace = QueryTrace(name)
+        try:
+            yield trace
+        finally:
+            TRACE_LOCAL.trace = None
+            trace.Finish()
+            self.local.last_trace = trace
+            self.Record(trace)
+
+    def LastTrace(self):
+        """The calling thread's most recent QueryTrace."""
+        return getattr(self.local, 'last_trace', None)
+
+    def Record(self, trace):
+        with self.lock:
+            self.queries[trace.name] += 1
+            self.total_seconds[trace.name] += trace.total_seconds
+            for stage, seconds in trace.seconds.items():
+                self.stage_seconds[trace.name][stage] += seconds
+            for table_name, count in trace.rows_fetched.items():
+                self.rows_fetched[trace.name][table_name] += count
+            for table_name, count in trace.postings.items():
+                self.postings[trace.name][table_name] += count
+
+    def Stats(self):
+        with self.lock:
+            return dict((name, {'queries': count,
+                                'total_seconds': self.total_seconds[name],
+                                'stage_seconds': dict(self.stage_seconds[name]),
+                                'rows_fetched': dict(self.rows_fetched[name]),
+                                'postings': dict(self.postings[name])})
+                        for name, count in self.queries.items())
+
+    def Report(self):
+        lines = []
+        for name, stats in sorted(self.Stats().items()):
+            count = stats['queries']
+            lines.append(f"{name}: {count} queries, "
+                         f"{1000.0 * stats['total_seconds'] / count:.2f} ms on average")
+            for stage, seconds in sorted(stats['stage_seconds'].items(), key=lambda x: -x[1]):
+                lines.append(f"\t{1000.0 * seconds / count:9.2f} ms\t{stage}")
+            for table_name in sorted(stats['postings']):
+                lines.append(f"\t{table_name}: {stats['rows_fetched'].get(table_name, 0) / count:.1f} rows "
+                             f"and {stats['postings'][table_name] / count:.0f} postings per query")
+        return '\n'.join(lines)
+
+
+def call_in_trace(trace, fn):
+    """Calls fn in this thread, recording into trace (which no other thread may update meanwhile)."""
+    TRACE_LOCAL.trace = trace
+    try:
+        return fn()
+    finally:
+        TRACE_LOCAL.trace = None
+
+
+def Traced(method):
+    """Makes a CategoryBuilder method record a QueryTrace when the builder has a profiler."""
+    @functools.wraps(method)
+    def traced(self, *args, **kwargs):
+        if self.profiler is None:
+            return method(self, *args, **kwargs)
+        with self.profiler.Trace(method.__name__):
+            return method(self, *args, **kwargs)
+    return traced
+
+
+def parse_row(row_string):
+    pieces = next(csv.reader([row_string]))
+    iterators = [iter(pieces)] * 2
+    grouped = [(p[0], float(p[1]) / 100)
+               for p in itertools.zip_longest(*iterators)]
+    return dict(grouped)
 
 
 def get_row(cursor, table_name, field_name, key):
+    trace = active_trace()
+    if trace:
+        start = time.time()
     cursor.execute(f"select * from {table_name} where {field_name}=?""", (key,))
     results = cursor.fetchall()
+    if trace:
+        start = trace.Lap('select', start)
+        trace.rows_fetched[table_name] += 1
     if results:
         row_string = results[0][1]
     else:
         return dict()
+    row = parse_row(row_string)
+    if trace:
+        trace.Lap('parse', start)
+    return row
 
-    pieces = next(csv.reader([row_string]))
-    iterators = [iter(pieces)] * 2
-    grouped = [(p[0], float(p[1]) / 100)
-               for p in itertools.zip_longest(*iterators)]
-    return dict(grouped)
+
+def get_rows(cursor, table_name, field_name, keys):
+    """Like get_row for many keys, with one SELECT per SQLITE_MAX_IN_KEYS keys."""
+    trace = active_trace()
+    keys = list(keys)
+    rows = dict((key, dict()) for key in keys)
+    found = set()
+    for start in range(0, len(keys), SQLITE_MAX_IN_KEYS):
+        if trace:
+            lap = time.time()
+        chunk = keys[start:start + SQLITE_MAX_IN_KEYS]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f"select * from {table_name} where {field_name} in ({placeholders})", chunk)
+        results = cursor.fetchall()
+        if trace:
+            lap = trace.Lap('select', lap)
+            trace.rows_fetched[table_name] += len(results)
+        for key, row_string in results:
+            # As with get_row, only the first row for a key counts.
+            if key not in found:
+                found.add(key)
+                rows[key] = parse_row(row_string)
+        if trace:
+            trace.Lap('parse', lap)
+    return rows
 
 
 def restrict_to_syntactic(looked_up_row):
@@ -164,91 +820,1002 @@ def restrict_to_cooc(looked_up_row):
     return dict(p for p in looked_up_row.items() if p[0][0] == 'C')
 
 
-def MatrixMultiply(cursor, table_name, field_name, wtd_seeds, rho=0.0, filterfn=None):
-    each_seed_fraction = 1.0 / len(wtd_seeds)
-    context_fraction = defaultdict(float)
-    context_weight = defaultdict(float)
+def by_rank(pair):
+    """Sort key of (key, score) pairs: by decreasing score, then by key, so ties go the same way everywhere."""
+    return -pair[1], pair[0]
+
+
+def rank_all(scores):
+    """The (key, score) pairs sorted by by_rank, as a new list. Keys must be distinct."""
+    # Two stable sorts, as comparing by_rank tuples is several times slower.
+    ranked = sorted(scores, key=lambda x: x[0])
+    ranked.sort(key=lambda x: x[1], reverse=True)
+    return ranked
+
+
+def TopK(scores, k=None):
+    """(key, score) pairs in by_rank order: the first k as a list if k is given, else RankedResults."""
+    if k is None:
+        return RankedResults(scores)
+    # Same result as rank_all(...)[:k], without sorting everything.
+    return heapq.nsmallest(k, scores, key=by_rank)
+
+
+def ranked_prefix(idx, length):
+    """How many of length ranked results reading [idx] needs ranked, and idx with no negative positions."""
+    if isinstance(idx, slice):
+        start, stop, step = idx.indices(length)
+        if step < 0:
+            # indices() gives -1 for "before the first", which slicing would read as the last.
+            return length, slice(start, stop if stop >= 0 else None, step) if start >= 0 else slice(0, 0)
+        return max(start, stop), slice(start, stop, step)
+    position = idx + length if idx < 0 else idx
+    if not 0 <= position < length:
+        raise IndexError('ranked results index out of range')
+    return position + 1, position
+
+
+class LazilyRanked(object):
+    """Lazily ranked results compare equal to, and print as, the list they read as."""
+
+    __hash__ = None
+
+    def __eq__(self, other):
+        if isinstance(other, LazilyRanked):
+            other = other[:]
+        if not isinstance(other, list):
+            return NotImplemented
+        return self[:] == other
+
+    def __repr__(self):
+        return repr(self[:])
+
+
+class RankedResults(LazilyRanked):
+    """(key, score) pairs by decreasing score, sorted only as far as they are read.
+
+      It reads as the list rank_all(scores) would: it can be iterated, indexed,
+      sliced and measured. Reading past what is ranked so far ranks more with TopK:
+      at least RANK_BLOCK pairs, and twice as many as before, so a page of a long
+      result costs one pass over it rather than a sort. Iterating past the first
+      block sorts the rest, as iterating is mostly reading all of it. Reads change
+      it, so threads sharing one must take turns.
+    """
+
+    def __init__(self, scores):
+        # Set to None once all of them are ranked.
+        self.scores = list(scores)
+        self.ranked = []
+
+    def rank(self, count):
+        """Makes sure the first count pairs are in self.ranked."""
+        if self.scores is None or count <= len(self.ranked):
+            return
+        trace = active_trace()
+        if trace:
+            lap = time.time()
+        count = max(count, 2 * len(self.ranked), RANK_BLOCK)
+        if count >= len(self.scores) // 2:
+            self.ranked = rank_all(self.scores)
+            self.scores = None
+        else:
+            self.ranked = TopK(self.scores, count)
+        if trace:
+            trace.Lap('sort', lap)
+
+    def __len__(self):
+        return len(self.ranked) if self.scores is None else len(self.scores)
+
+    def __getitem__(self, idx):
+        count, idx = ranked_prefix(idx, len(self))
+        self.rank(count)
+        return self.ranked[idx]
+
+    def __iter__(self):
+        self.rank(RANK_BLOCK)
+        yield from self.ranked[:RANK_BLOCK]
+        self.rank(len(self))
+        yield from self.ranked[RANK_BLOCK:]
+
+
+def MatrixMultiply(matrices, table_name, wtd_seeds, rho=0.0, filterfn=None, k=None):
+    trace = active_trace()
+    wtd_rows = []
     for s, seed_wt in wtd_seeds:
-        unfiltered_row = get_row(cursor, table_name, field_name, s)
+        unfiltered_row = matrices.get_row(table_name, s)
+        if trace:
+            lap = time.time()
         if filterfn:
             contexts_for_s = filterfn(unfiltered_row)
         else:
             contexts_for_s = unfiltered_row
+        wtd_rows.append((seed_wt, contexts_for_s))
+        if trace:
+            trace.Lap('filter', lap)
+
+    if trace:
+        lap = time.time()
+    each_seed_fraction = 1.0 / len(wtd_seeds)
+    context_fraction = defaultdict(float)
+    context_weight = defaultdict(float)
+    for seed_wt, contexts_for_s in wtd_rows:
         for c, wt in contexts_for_s.items():
             context_fraction[c] += each_seed_fraction
             context_weight[c] += seed_wt * wt
+    if trace:
+        lap = trace.Lap('accumulate', lap)
+        trace.postings[table_name] += sum(len(row) for _, row in wtd_rows)
+        trace.accumulated[table_name] += len(context_weight)
 
     # Now we penalize contexts not seen with all items.
     for context, fraction in context_fraction.items():
         context_weight[context] *= pow(fraction, rho)
-    sorted_contexts = sorted(context_weight.items(), reverse=True,
-                             key=lambda x: x[1])
+    if trace:
+        lap = trace.Lap('penalty', lap)
+    sorted_contexts = TopK(context_weight.items(), k)
+    if trace:
+        trace.Lap('sort', lap)
     return sorted_contexts
 
 
-def MergeScores(a_scores, b_scores, squash=100.0):
-    total_score = defaultdict(float)
-    for k, v in a_scores:
-        total_score[k] += 1.0 * squash * v / (squash - 1.0 + v)
-    for k, v in b_scores:
-        if k not in total_score:
-            continue
-        total_score[k] += 1.0 * squash * v / (squash - 1.0 + v)
-    return sorted(total_score.items(), reverse=True,
-                  key=lambda x: x[1])
+# Row filters for the feature prefixes CategoryBuilder restricts to.
+PREFIX_FILTERS = {'S': restrict_to_syntactic, 'C': restrict_to_cooc}
+
+
+def MergeScores(a_scores, b_scores, squash=100.0, k=None):
+    """Squashed a scores, plus squashed b scores of the items also in a, sorted.
+
+      a_scores must be sorted by decreasing score, as MatrixMultiply returns them.
+    """
+    trace = active_trace()
+    if trace:
+        lap = time.time()
+    if k is None:
+        total_score = defaultdict(float)
+        for key, v in a_scores:
+            total_score[key] += 1.0 * squash * v / (squash - 1.0 + v)
+        for key, v in b_scores:
+            if key not in total_score:
+                continue
+            total_score[key] += 1.0 * squash * v / (squash - 1.0 + v)
+        merged = TopK(total_score.items(), k)
+    else:
+        merged = MergeTopK(a_scores, b_scores, squash, k)
+    if trace:
+        trace.Lap('merge', lap)
+    return merged
+
+
+def MergeTopK(a_scores, b_scores, squash, k):
+    """The first k of MergeScores, without scoring all of a_scores.
+
+      Going down a, an item not in b scores its squashed a score, so only the
+      first k of those can make the top k. Past them, the rest of a only matters
+      while an item's squashed a score plus the largest squashed b score could
+      still reach the k-th best so far (reaching it is enough, as ties go by key).
+      a_scores must be in TopK order, ties by key.
+    """
+    if k <= 0:
+        return []
+    b_totals = dict((key, 1.0 * squash * v / (squash - 1.0 + v)) for key, v in b_scores)
+    b_max = max(b_totals.values(), default=0.0)
+    # The k best totals so far, worst first, and every item scored.
+    kth_best = []
+    scored = []
+    a_only = 0
+    for key, v in a_scores:
+        a_total = 1.0 * squash * v / (squash - 1.0 + v)
+        if len(kth_best) == k and a_total + b_max < kth_best[0]:
+            break
+        b_total = b_totals.get(key)
+        if b_total is None:
+            if a_only == k:
+                continue
+            a_only += 1
+            total = a_total
+        else:
+            total = a_total + b_total
+        scored.append((key, total))
+        if len(kth_best) < k:
+            heapq.heappush(kth_best, total)
+        elif total > kth_best[0]:
+            heapq.heapreplace(kth_best, total)
+    return TopK(scored, k)
+
+
+def MergeTruncatedScores(a_scores, a_complete, b_scores, b_complete, squash=100.0, k=None):
+    """MergeScores of sorted lists that may hold only the top of their scores.
+
+      An item missing from a list that is not complete may still have scored up to
+      its last entry. Returns None if such items could change the first k merged.
+    """
+    def squashed(v):
+        return squash * v / (squash - 1.0 + v)
+    if k == 0:
+        return []
+    merged = MergeScores(a_scores, b_scores, squash=squash)
+    if k is None or k >= len(merged):
+        return merged if a_complete and b_complete else None
+    b_keys = set(key for key, _ in b_scores)
+    # What an item's merged score may lack if its b score was cut off.
+    b_missing = 0.0 if b_complete else squashed(b_scores[-1][1])
+    if b_missing and any(key not in b_keys for key, _ in merged[:k]):
+        return None
+    upper_bounds = [score + (0.0 if key in b_keys else b_missing) for key, score in merged[k:]]
+    if not a_complete:
+        upper_bounds.append(squashed(a_scores[-1][1]) + (squashed(b_scores[0][1]) if b_scores else 0.0))
+    if upper_bounds and max(upper_bounds) >= merged[k - 1][1]:
+        return None
+    return merged[:k]
+
+
+def EstimateRowBytes(row):
+    """Approximate memory held by a decoded row: the dict, its keys and its float values."""
+    return (sys.getsizeof(row) + sum(sys.getsizeof(k) for k in row)
+            + len(row) * sys.getsizeof(0.0))
+
+
+class RowCache(object):
+    """Least-recently-used cache of decoded rows, bounded by their estimated size in bytes.
+
+      Cached rows are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.rows = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.rows.move_to_end(key)
+            return row[0]
+
+    def put(self, key, row):
+        size = EstimateRowBytes(row)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.rows:
+                return
+            self.rows[key] = (row, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.rows.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def Stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': 1.0 * self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions,
+                    'rows': len(self.rows),
+                    'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
+
+
+def connect_read_only(db_path, mmap_bytes=SQLITE_MMAP_BYTES, cache_kb=SQLITE_CACHE_KB):
+    connection = sqlite3.connect(pathlib.Path(db_path).absolute().as_uri() + '?mode=ro',
+                                 uri=True, check_same_thread=False)
+    connection.execute(f'PRAGMA mmap_size = {int(mmap_bytes)}')
+    connection.execute(f'PRAGMA cache_size = {-int(cache_kb)}')
+    return connection
+
+
+class SqliteMatrices(object):
+    """Rows read from the sqlite3 tables written by create_db.
+
+      Safe to share between threads: each thread gets its own read-only connection,
+      opened with the given mmap_size and cache_size. If row_cache_bytes is positive,
+      each table keeps a RowCache of that size, shared by all threads.
+    """
+
+    def __init__(self, data_dir, row_cache_bytes=0, mmap_bytes=SQLITE_MMAP_BYTES,
+                 cache_kb=SQLITE_CACHE_KB):
+        self.db_path = os.path.join(data_dir, SQLITE3_DB)
+        self.mmap_bytes = mmap_bytes
+        self.cache_kb = cache_kb
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.row_caches = {}
+        if row_cache_bytes > 0:
+            self.row_caches = dict((table_name, RowCache(row_cache_bytes))
+                                   for table_name in KEY_FIELDS)
+
+    @property
+    def cursor(self):
+        """The calling thread's cursor, on a connection opened for it on first use."""
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            connection = connect_read_only(self.db_path, self.mmap_bytes, self.cache_kb)
+            with self.connections_lock:
+                self.connections.append(connection)
+            cursor = self.local.cursor = connection.cursor()
+        return cursor
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def get_row(self, table_name, key):
+        cache = self.row_caches.get(table_name)
+        if cache is None:
+            return get_row(self.cursor, table_name, KEY_FIELDS[table_name], key)
+        row = cache.get(key)
+        if row is None:
+            row = get_row(self.cursor, table_name, KEY_FIELDS[table_name], key)
+            cache.put(key, row)
+        return row
+
+    def get_rows(self, table_name, keys):
+        """Returns a dict from each of keys to its row, fetching those not cached in bulk."""
+        cache = self.row_caches.get(table_name)
+        rows = {}
+        missing = []
+        for key in set(keys):
+            row = cache.get(key) if cache is not None else None
+            if row is None:
+                missing.append(key)
+            else:
+                rows[key] = row
+        fetched = get_rows(self.cursor, table_name, KEY_FIELDS[table_name], missing)
+        if cache is not None:
+            for key, row in fetched.items():
+                cache.put(key, row)
+        rows.update(fetched)
+        return rows
+
+    def Keys(self, table_name):
+        """The distinct keys of a table's rows, sorted."""
+        key_field = KEY_FIELDS[table_name]
+        return [row[0] for row in self.cursor.execute(
+            f'select distinct {key_field} from {table_name} order by {key_field}')]
+
+    def Warm(self, table_name, keys):
+        """Reads the rows for keys, so that their index and row pages are in memory.
+
+          With a row cache, the rows are decoded into it, the first of keys last.
+        """
+        for start in reversed(range(0, len(keys), SQLITE_MAX_IN_KEYS)):
+            chunk = keys[start:start + SQLITE_MAX_IN_KEYS]
+            if table_name in self.row_caches:
+                self.get_rows(table_name, chunk)
+                continue
+            placeholders = ', '.join('?' * len(chunk))
+            self.cursor.execute(f"select length({VALUE_FIELDS[table_name]}) from {table_name} "
+                                f"where {KEY_FIELDS[table_name]} in ({placeholders})", chunk).fetchall()
+
+    def Batch(self):
+        return PrefetchedMatrices(self)
+
+    def MergeScores(self, a_scores, b_scores, squash=100.0, k=None):
+        return MergeScores(a_scores, b_scores, squash=squash, k=k)
+
+    def MatrixMultiply(self, table_name, wtd_seeds, rho=0.0, prefix=None, k=None):
+        return MatrixMultiply(self, table_name, wtd_seeds, rho=rho,
+                              filterfn=PREFIX_FILTERS.get(prefix), k=k)
+
+
+class PrefetchedMatrices(object):
+    """A view of SqliteMatrices for a batch of queries: rows are fetched in bulk up front.
+
+      Rows needed but not prefetched are read through as usual.
+    """
+
+    def __init__(self, matrices):
+        self.matrices = matrices
+        self.rows = defaultdict(dict)
+
+    def prefetch(self, table_name, keys):
+        needed = set(keys).difference(self.rows[table_name])
+        if needed:
+            self.rows[table_name].update(self.matrices.get_rows(table_name, needed))
+
+    def get_row(self, table_name, key):
+        row = self.rows[table_name].get(key)
+        if row is None:
+            row = self.matrices.get_row(table_name, key)
+        return row
+
+    def MatrixMultiply(self, table_name, wtd_seeds, rho=0.0, prefix=None, k=None):
+        return MatrixMultiply(self, table_name, wtd_seeds, rho=rho,
+                              filterfn=PREFIX_FILTERS.get(prefix), k=k)
+
+
+def BuildMatrices(data_dir, backend, variant=None):
+    """Builds the storage for backend, and its vocabulary index, unless they already exist.
+
+      variant selects build options of the csr backend; see category_builder_csr.parse_variant.
+    """
+    if variant and backend != 'csr':
+        raise ValueError(f"Variants are only available for the csr backend, not '{backend}'")
+    if backend == 'sqlite':
+        db_path = os.path.join(data_dir, SQLITE3_DB)
+        # Splitting an older database rewrites it, which makes everything computed from it
+        # stale, so it is left to initialize.py rather than done by whatever opens it.
+        if os.path.exists(db_path) and not is_split(db_path):
+            raise RuntimeError(f"'{db_path}' was built before I_TO_F was split by feature type; "
+                               f"run initialize.py to split it")
+        create_db(data_dir, verbose=False)
+    elif backend == 'csr':
+        import category_builder_csr as csr
+        csr.create_csr(data_dir, verbose=False, variant=variant)
+    else:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    build_vocabulary_index(data_dir, backend, variant=variant)
+
+
+def vocabulary_index_dir(data_dir, backend, variant=None):
+    """Where the vocabulary index of backend's matrices is kept: a directory for each storage."""
+    if backend == 'sqlite':
+        return os.path.join(data_dir, VOCAB_INDEX_DIR, backend)
+    import category_builder_csr as csr
+    return os.path.join(data_dir, VOCAB_INDEX_DIR, csr.variant_dir_name(variant))
+
+
+def build_vocabulary_index(data_dir, backend, variant=None):
+    """Writes the item and feature keys of the matrices as a VocabularyIndex, unless it is current.
+
+      The matrices' fingerprint is kept with it, so it is rebuilt after a rebuild or delta merge.
+    """
+    import shutil
+    import tempfile
+    index_dir = vocabulary_index_dir(data_dir, backend, variant)
+    meta_path = os.path.join(index_dir, META_FILE)
+    fingerprint = matrices_fingerprint(data_dir, backend, variant)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == fingerprint:
+                return
+    print("Building the vocabulary index...")
+    if backend == 'sqlite':
+        matrices = SqliteMatrices(data_dir, mmap_bytes=0)
+    else:
+        import category_builder_csr as csr
+        matrices = csr.CsrMatrices(os.path.join(data_dir, csr.variant_dir_name(variant)))
+    os.makedirs(os.path.dirname(index_dir), exist_ok=True)
+    # Written next to its final place, and renamed into it once complete.
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(index_dir))
+    try:
+        vocab.write_vocabulary_index(tmp_dir, matrices.Keys('I_TO_F'), matrices.Keys('F_TO_I'))
+    finally:
+        getattr(matrices, 'close', lambda: None)()
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(fingerprint, f)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.rename(tmp_dir, index_dir)
+
+
+def OpenMatrices(data_dir, backend, row_cache_bytes=0, sqlite_mmap_bytes=SQLITE_MMAP_BYTES,
+                 sqlite_cache_kb=SQLITE_CACHE_KB, variant=None, build=True, shared_memory=None):
+    """Builds the storage for backend if needed, and returns its rows.
+
+      Only the sqlite backend decodes rows, so row_cache_bytes applies to it alone.
+      If build is False, nothing is checked or built: the storage and its vocabulary
+      index must already exist. With shared_memory, the name of a block made by
+      category_builder_shared, the csr backend reads its matrices from the block.
+    """
+    if shared_memory and backend != 'csr':
+        raise ValueError(f"Shared memory is only available for the csr backend, not '{backend}'")
+    if build:
+        BuildMatrices(data_dir, backend, variant=variant)
+    else:
+        for path in (matrices_path(data_dir, backend, variant),
+                     os.path.join(vocabulary_index_dir(data_dir, backend, variant), META_FILE)):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"'{path}' is missing: open the {backend} matrices "
+                                        f"once without fast open to build them")
+    if backend == 'sqlite':
+        return SqliteMatrices(data_dir, row_cache_bytes=row_cache_bytes,
+                              mmap_bytes=sqlite_mmap_bytes, cache_kb=sqlite_cache_kb)
+    if shared_memory:
+        import category_builder_shared
+        return category_builder_shared.open_shared_matrices(shared_memory, data_dir, variant=variant)
+    import category_builder_csr as csr
+    return csr.CsrMatrices(os.path.join(data_dir, csr.variant_dir_name(variant)))
+
+
+def matrices_path(data_dir, backend, variant=None):
+    """The main file of backend's matrices, written last when they are built."""
+    if backend == 'sqlite':
+        return os.path.join(data_dir, SQLITE3_DB)
+    import category_builder_csr as csr
+    return os.path.join(data_dir, csr.variant_dir_name(variant), csr.META_FILE)
+
+
+def matrices_fingerprint(data_dir, backend, variant=None):
+    """Identifies the built matrices of backend by the size and mtime of their main file.
+
+      Results computed from them are stale once it changes.
+    """
+    stat = os.stat(matrices_path(data_dir, backend, variant))
+    return {'backend': backend, 'variant': variant or '', 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
 
 
 class CategoryBuilder(object):
-    def __init__(self, data_dir):
+    """Set expansion and analogies. One instance may be shared by several threads."""
+
+    def __init__(self, data_dir, backend='sqlite', row_cache_bytes=0,
+                 sqlite_mmap_bytes=SQLITE_MMAP_BYTES, sqlite_cache_kb=SQLITE_CACHE_KB,
+                 profile=False, variant=None, use_index=True, shards=0, result_cache_bytes=0,
+                 fast_open=False, hot_set=None, record_hot_set=False, shared_memory=None):
         self.data_dir = data_dir
-        create_db(data_dir, verbose=False)
-        self.connection = sqlite3.connect(os.path.join(data_dir, SQLITE3_DB))
-        self.cursor = self.connection.cursor()
+        self.backend = backend
+        self.variant = variant
+        # If set, each query records a QueryTrace; see Profiler.
+        self.profiler = Profiler() if profile else None
+        # Runs the co-occurrence half of analogies while the calling thread expands.
+        # Started on first use, as short-lived processes may never need it.
+        self.branch_executor = None
+        self.branch_executor_lock = threading.Lock()
+        # The results of queries being read a page at a time; see category_builder_pages.
+        self.page_cursors = None
+        self.page_cursors_lock = threading.Lock()
+        # With fast_open, the matrices are opened as they are, without checking that
+        # they are built and current.
+        self.matrices = OpenMatrices(data_dir, backend, row_cache_bytes=row_cache_bytes,
+                                     sqlite_mmap_bytes=sqlite_mmap_bytes,
+                                     sqlite_cache_kb=sqlite_cache_kb, variant=variant,
+                                     build=not fast_open, shared_memory=shared_memory)
+        # Built along with the matrices; see build_vocabulary_index.
+        self.vocabulary = vocab.VocabularyIndex(vocabulary_index_dir(data_dir, backend, variant))
+        if shards > 0:
+            # The second hop of large queries then runs over this many worker processes.
+            import category_builder_shards
+            self.matrices = category_builder_shards.ShardedMatrices(self.matrices, data_dir, backend,
+                                                                    variant=variant, shards=shards,
+                                                                    shared_memory=shared_memory)
+        # Precomputed single-seed results, if there are any for these matrices;
+        # see category_builder_index.
+        self.index = None
+        if use_index:
+            import category_builder_index as cb_index
+            self.index = cb_index.SingleSeedIndex.Open(data_dir, backend, variant=variant)
+        # If set, results of ExpandCategory and DoAnalogy are kept on disk for any process
+        # to reuse; see category_builder_cache.
+        self.result_cache = None
+        if result_cache_bytes > 0:
+            import category_builder_cache
+            self.result_cache = category_builder_cache.ResultCache(data_dir, backend, variant,
+                                                                   result_cache_bytes)
+        # The rows of the hot_set file are read in the background, ahead of the first
+        # queries, and with record_hot_set the rows queries read are counted, for
+        # SaveHotSet; see category_builder_hot_set.
+        self.warming = None
+        if hot_set or record_hot_set:
+            import category_builder_hot_set as cb_hot_set
+        if hot_set:
+            self.warming = threading.Thread(target=cb_hot_set.warm,
+                                            args=(self.matrices, cb_hot_set.read_hot_set(hot_set)),
+                                            daemon=True)
+            self.warming.start()
+        if record_hot_set:
+            self.matrices = cb_hot_set.RecordingMatrices(self.matrices)
+
+    def _Cached(self, method, compute, **params):
+        """The result cache's results for method with params, else compute() stored there."""
+        if self.result_cache is None:
+            return compute()
+        key = self.result_cache.Key(method, **params)
+        results = self.result_cache.Get(key)
+        if results is None:
+            results = compute()
+            self.result_cache.Put(key, results)
+        return results
+
+    def _Listed(self, results, k):
+        """results as a list if k is given, as then there are few; else as they are, lazily ranked."""
+        return results if k is None else results[:]
+
+    def _Indexed(self, kind, item, k):
+        """The first k results for item from the index, or None if it can't tell them."""
+        results, complete = self.index.Get(kind, item)
+        if results is None or not (complete or (k is not None and k <= len(results))):
+            return None
+        return results[:k]
+
+    def _KnownItem(self, item):
+        """item if it is in the vocabulary, else its normalized form if that is, else None."""
+        if self.vocabulary.items.id(item) >= 0:
+            return item
+        normalized = vocab.normalize_name(item)
+        if normalized != item and self.vocabulary.items.id(normalized) >= 0:
+            return normalized
+        return None
+
+    def _CacheName(self, name):
+        """The item a query resolves name to, or name normalized if it is unknown, to key the result cache."""
+        return self._KnownItem(name) or vocab.normalize_name(name)
+
+    def _KnownSeeds(self, seeds):
+        """seeds with each one normalized if needed, or None if none of them is a known item.
+
+          Unknown seeds are kept, as they still count towards the fraction penalized by rho.
+        """
+        known_seeds = [self._KnownItem(seed) for seed in seeds]
+        if all(seed is None for seed in known_seeds):
+            return None
+        return [known or seed for known, seed in zip(known_seeds, seeds)]
+
+    def _ReportUnknown(self, seeds):
+        """Says that seeds, a list or a single seed, had no contexts, with suggestions for unknown items."""
+        print(f"Did not find any contexts for {seeds if isinstance(seeds, list) else repr(seeds)}")
+        for seed in (seeds if isinstance(seeds, list) else [seeds]):
+            if self._KnownItem(seed) is None:
+                suggestions = self.vocabulary.item_ngrams.suggest(vocab.normalize_name(seed), limit=5)
+                if suggestions:
+                    print(f"\t'{seed}' is not a known item. Did you mean: "
+                          f"{', '.join(name for name, _ in suggestions)}?")
+
+    def _Concurrently(self, first, second):
+        """Returns (first(), second()), running second in another thread meanwhile.
+
+          Both backends give each thread a connection of its own, or none at all.
+        """
+        with self.branch_executor_lock:
+            if self.branch_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.branch_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+        # The other thread records into a trace of its own, added to the query's once done,
+        # as traces are not safe to update from two threads.
+        trace = active_trace()
+        branch_trace = QueryTrace(trace.name) if trace else None
+        future = self.branch_executor.submit(call_in_trace, branch_trace, second)
+        results = first(), future.result()
+        if trace:
+            trace.Add(branch_trace)
+        return results
+
+    def _Page(self, method, params, page_size, page_token=None):
+        """A page of the results of method with params; see category_builder_pages.PageCursors.Page."""
+        with self.page_cursors_lock:
+            if self.page_cursors is None:
+                import category_builder_pages as cb_pages
+                self.page_cursors = cb_pages.PageCursors(
+                    lambda method, params: getattr(self, method)(**params))
+        return self.page_cursors.Page(method, params, page_size, page_token=page_token)
+
+    def RowCacheStats(self):
+        """Hits, misses, evictions and bytes held by each table's row cache."""
+        return dict((table_name, cache.Stats())
+                    for table_name, cache in getattr(self.matrices, 'row_caches', {}).items())
 
-    def GetItemsGivenWeightedContexts(self, wtd_contexts):
-        return MatrixMultiply(self.cursor, 'F_TO_I', 'feature', wtd_contexts, 0.0)
+    def ResultCacheStats(self):
+        return self.result_cache.Stats() if self.result_cache else {}
 
-    def ExpandCategory(self, seeds, rho, n):
-        sorted_contexts = MatrixMultiply(self.cursor, 'I_TO_F', 'item',
-                                         wtd_seeds=[(x, 1) for x in seeds],
-                                         rho=rho,
-                                         filterfn=restrict_to_syntactic)
+    def SaveHotSet(self, path):
+        """Adds the rows read since the last save to the hot set at path. Needs record_hot_set."""
+        self.matrices.Save(path)
+
+    def close(self):
+        """Releases everything opened: threads, the shards' worker processes and connections.
+
+          Waits for the hot set to be read, if it still is. No queries can be made after.
+        """
+        if self.warming is not None:
+            self.warming.join()
+        if self.branch_executor is not None:
+            self.branch_executor.shutdown()
+        getattr(self.matrices, 'close', lambda: None)()
+        if self.index is not None:
+            self.index.close()
+        if self.result_cache is not None:
+            self.result_cache.close()
+
+    @Traced
+    def GetItemsGivenWeightedContexts(self, wtd_contexts, k=None):
+        return self.matrices.MatrixMultiply('F_TO_I', wtd_contexts, 0.0, k=k)[:]
+
+    @Traced
+    def ExpandCategory(self, seeds, rho, n, k=None):
+        """Returns the expansion, by decreasing score. If k is given, only its first k items.
+
+          With k, it is a list of (item, score). Without, it reads as one (and compares
+          equal to one), but is sorted only as far as it is read.
+        """
+        # Neither the order of seeds nor how they are written changes the expansion.
+        return self._Cached('ExpandCategory',
+                            lambda: self._Listed(self._ExpandCategory(seeds, rho, n, k=k), k),
+                            seeds=sorted(self._CacheName(seed) for seed in seeds), rho=float(rho),
+                            n=n, k=k)
+
+    @Traced
+    def ExpandCategoryPage(self, seeds, rho, n, page_size=PAGE_SIZE):
+        """The first page_size items of ExpandCategory, and a page token for NextPage (None if that is all)."""
+        return self._Page('ExpandCategory', dict(seeds=seeds, rho=rho, n=n), page_size)
+
+    def _ExpandCategory(self, seeds, rho, n, k=None):
+        known_seeds = self._KnownSeeds(seeds)
+        if known_seeds is None:
+            self._ReportUnknown(seeds)
+            return []
+        seeds = known_seeds
+        # With a single seed rho does not matter, so the index may have the answer.
+        if len(seeds) == 1 and self.index is not None and n == self.index.n:
+            indexed = self._Indexed(self.index.EXPANSION, seeds[0], k)
+            if indexed is not None:
+                return indexed
+        # Results are kept as the backend returns them (for csr, as ids) until the caller lists them.
+        sorted_contexts = self.matrices.MatrixMultiply('I_TO_F_SYN',
+                                                       wtd_seeds=[(x, 1) for x in seeds],
+                                                       rho=rho,
+                                                       k=n)
         if not sorted_contexts:
-            print(f"Did not find any contexts for {seeds}")
+            self._ReportUnknown(seeds)
+            return []
+        return self.matrices.MatrixMultiply('F_TO_I',
+                                            wtd_seeds=sorted_contexts,
+                                            rho=0,
+                                            k=k)
+
+    @Traced
+    def GetCooccurringItems(self, seed, k=None):
+        return self._Listed(self._GetCooccurringItems(seed, k=k), k)
+
+    @Traced
+    def GetCooccurringItemsPage(self, seed, page_size=PAGE_SIZE):
+        """The first page_size items of GetCooccurringItems, and a page token for NextPage."""
+        return self._Page('GetCooccurringItems', dict(seed=seed), page_size)
+
+    def _GetCooccurringItems(self, seed, k=None):
+        known_seeds = self._KnownSeeds([seed])
+        if known_seeds is None:
+            self._ReportUnknown(seed)
             return []
-        return MatrixMultiply(self.cursor, 'F_TO_I', 'feature',
-                              wtd_seeds=sorted_contexts[:n],
-                              rho=0)
-
-    def GetCooccurringItems(self, seed):
-        sorted_contexts = MatrixMultiply(self.cursor, 'I_TO_F', 'item',
-                                         wtd_seeds=((seed, 1.0),),
-                                         rho=0,
-                                         filterfn=restrict_to_cooc)
+        seed = known_seeds[0]
+        if self.index is not None:
+            indexed = self._Indexed(self.index.COOCCURRENCE, seed, k)
+            if indexed is not None:
+                return indexed
+        sorted_contexts = self.matrices.MatrixMultiply('I_TO_F_COOC',
+                                                       wtd_seeds=((seed, 1.0),),
+                                                       rho=0)
         if not sorted_contexts:
-            print(f"Did not find any contexts for '{seed}'")
+            self._ReportUnknown(seed)
             return []
-        return MatrixMultiply(self.cursor, 'F_TO_I', 'feature',
-                              wtd_seeds=sorted_contexts,
-                              rho=0)
+        return self.matrices.MatrixMultiply('F_TO_I',
+                                            wtd_seeds=sorted_contexts,
+                                            rho=0,
+                                            k=k)
+
+    @Traced
+    def ExpandCategoryBatch(self, seed_lists, rho, n, k=None):
+        """Same as ExpandCategory for each list of seeds, but rows are fetched once per batch."""
+        return [x[:] for x in self._ExpandCategoryBatch(seed_lists, rho, n, k=k)]
+
+    def _ExpandCategoryBatch(self, seed_lists, rho, n, k=None):
+        known_seed_lists = [self._KnownSeeds(seeds) for seeds in seed_lists]
+        matrices = self.matrices.Batch()
+        matrices.prefetch('I_TO_F_SYN', (s for seeds in known_seed_lists if seeds for s in seeds))
+        contexts_per_query = [matrices.MatrixMultiply('I_TO_F_SYN',
+                                                      wtd_seeds=[(x, 1) for x in seeds],
+                                                      rho=rho,
+                                                      k=n) if seeds else []
+                              for seeds in known_seed_lists]
+        matrices.prefetch('F_TO_I', (c for contexts in contexts_per_query for c, _ in contexts))
+        expansions = []
+        for seeds, sorted_contexts in zip(seed_lists, contexts_per_query):
+            if not sorted_contexts:
+                self._ReportUnknown(seeds)
+                expansions.append([])
+                continue
+            expansions.append(matrices.MatrixMultiply('F_TO_I',
+                                                      wtd_seeds=sorted_contexts,
+                                                      rho=0,
+                                                      k=k))
+        return expansions
+
+    @Traced
+    def GetCooccurringItemsBatch(self, seeds, k=None):
+        """Same as GetCooccurringItems for each seed, but rows are fetched once per batch."""
+        return [x[:] for x in self._GetCooccurringItemsBatch(seeds, k=k)]
 
-    def DoAnalogy(self, b, c, squash, semantic_n=100):
+    def _GetCooccurringItemsBatch(self, seeds, k=None):
+        known_seeds = [self._KnownItem(seed) for seed in seeds]
+        matrices = self.matrices.Batch()
+        matrices.prefetch('I_TO_F_COOC', (seed for seed in known_seeds if seed is not None))
+        contexts_per_query = [matrices.MatrixMultiply('I_TO_F_COOC',
+                                                      wtd_seeds=((seed, 1.0),),
+                                                      rho=0) if seed is not None else []
+                              for seed in known_seeds]
+        matrices.prefetch('F_TO_I', (c for contexts in contexts_per_query for c, _ in contexts))
+        cooccurring = []
+        for seed, sorted_contexts in zip(seeds, contexts_per_query):
+            if not sorted_contexts:
+                self._ReportUnknown(seed)
+                cooccurring.append([])
+                continue
+            cooccurring.append(matrices.MatrixMultiply('F_TO_I',
+                                                       wtd_seeds=sorted_contexts,
+                                                       rho=0,
+                                                       k=k))
+        return cooccurring
+
+    @Traced
+    def DoAnalogyBatch(self, b_c_pairs, squash, semantic_n=100, k=None):
+        """Same as DoAnalogy for each (b, c), computing each distinct b and c only once."""
+        bs = list(dict.fromkeys(b for b, _ in b_c_pairs))
+        cs = list(dict.fromkeys(c for _, c in b_c_pairs))
+        expansions, cooccurring = self._Concurrently(
+            lambda: self._ExpandCategoryBatch([[b, ] for b in bs], rho=1, n=semantic_n),
+            lambda: self._GetCooccurringItemsBatch(cs))
+        things_like = dict(zip(bs, expansions))
+        things_cooccuring_with = dict(zip(cs, cooccurring))
+        analogies = []
+        for b, c in b_c_pairs:
+            print(f"Looking for the '{b}' of the '{c}'")
+            analogies.append(self.matrices.MergeScores(things_like[b], things_cooccuring_with[c],
+                                                       squash=squash, k=k)[:])
+        return analogies
+
+    @Traced
+    def DoAnalogy(self, b, c, squash, semantic_n=100, k=None):
         print(f"Looking for the '{b}' of the '{c}'")
+        return self._Cached('DoAnalogy',
+                            lambda: self._Listed(self._DoAnalogy(b, c, squash, semantic_n, k), k),
+                            b=self._CacheName(b), c=self._CacheName(c), squash=float(squash),
+                            semantic_n=semantic_n, k=k)
+
+    @Traced
+    def DoAnalogyPage(self, b, c, squash, semantic_n=100, page_size=PAGE_SIZE):
+        """The first page_size items of DoAnalogy, and a page token for NextPage."""
+        return self._Page('DoAnalogy', dict(b=b, c=c, squash=squash, semantic_n=semantic_n), page_size)
+
+    @Traced
+    def NextPage(self, page_token, page_size=PAGE_SIZE):
+        """The page_size results after the page page_token came with, and a page token for the next ones.
+
+          The query is only run again if this process no longer has its results.
+        """
+        return self._Page(None, None, page_size, page_token=page_token)
+
+    def _DoAnalogy(self, b, c, squash, semantic_n, k):
+        if self.index is not None and semantic_n == self.index.n:
+            analogy = self._IndexedAnalogy(b, c, squash, k)
+            if analogy is not None:
+                return analogy
 
         # Since we have a single seed, the exact value of rho does not matter.
         # This is so because we multiply the weight sum by fraction ^ rho, and
         # fraction with a single seed can only ever be 0 or 1.
-        things_like_b = self.ExpandCategory(seeds=[b, ], rho=1, n=semantic_n)
-        things_cooccuring_with_c = self.GetCooccurringItems(seed=c)
-        return MergeScores(things_like_b, things_cooccuring_with_c, squash=squash)
+        things_like_b, things_cooccuring_with_c = self._Concurrently(
+            lambda: self._ExpandCategory(seeds=[b, ], rho=1, n=semantic_n),
+            lambda: self._GetCooccurringItems(seed=c))
+        return self.matrices.MergeScores(things_like_b, things_cooccuring_with_c,
+                                         squash=squash, k=k)
+
+    def _IndexedAnalogy(self, b, c, squash, k):
+        """DoAnalogy from the index alone, or None if the lists it holds can't decide the top k."""
+        things_like_b, b_complete = self.index.Get(self.index.EXPANSION, b)
+        things_cooccuring_with_c, c_complete = self.index.Get(self.index.COOCCURRENCE, c)
+        if things_like_b is None or things_cooccuring_with_c is None:
+            return None
+        return MergeTruncatedScores(things_like_b, b_complete, things_cooccuring_with_c, c_complete,
+                                    squash=squash, k=k)
+
+    @Traced
+    def NormalizeSeeds(self, seeds):
+        """Each seed as it is known: itself, or in lowercase with single spaces, or None if unknown."""
+        return [self._KnownItem(seed) for seed in seeds]
+
+    @Traced
+    def CompleteItems(self, prefix, k=10):
+        """Up to k known items starting with prefix, in lexicographic order."""
+        lo, hi = self.vocabulary.items.prefix_range(prefix.lower())
+        return self.vocabulary.items.names(range(lo, min(hi, lo + k)))
+
+    @Traced
+    def CompleteFeatures(self, prefix, k=10):
+        """Up to k features starting with prefix, in lexicographic order."""
+        lo, hi = self.vocabulary.features.prefix_range(prefix)
+        return self.vocabulary.features.names(range(lo, min(hi, lo + k)))
 
+    @Traced
+    def SuggestItems(self, item, k=10, max_distance=None):
+        """Up to k (item, edit distance) of known items within max_distance edits of item, closest first.
+
+          See category_builder_vocab.NgramIndex.suggest for the default max_distance.
+        """
+        return self.vocabulary.item_ngrams.suggest(vocab.normalize_name(item),
+                                                   max_distance=max_distance, limit=k)
+
+    @Traced
     def GetSyntacticFeaturesForItem(self, item):
-        syntactic_features = get_row(self.cursor, 'I_TO_F', 'item', item)
-        # Due to a bad design choice, there may be a single contextual feature here, with wt 100.
-        return dict((k, v) for (k, v) in syntactic_features.items() if k.startswith('S'))
+        return dict(self.matrices.get_row('I_TO_F_SYN', item))
 
+    @Traced
     def GetContextualFeaturesForItem(self, item):
-        return get_row(self.cursor, 'I_TO_F_C', 'item', item)
+        return dict(self.matrices.get_row('I_TO_F_C', item))
 
+    @Traced
     def GetItemsForFeature(self, feature):
-        return get_row(self.cursor, 'F_TO_I', 'feature', feature)
+        return dict(self.matrices.get_row('F_TO_I', feature))
+
+
+# The command line flags that say how the tools open their CategoryBuilder, for
+# add_builder_arguments, by name.
+BUILDER_ARGUMENTS = {
+    'backend': dict(default='sqlite', choices=BACKENDS, help="Storage of the matrices"),
+    'variant': dict(default='', help="Build options of the csr backend, "
+                                     "e.g. weights=uint8,f_to_i_top_k=500,i_to_f_top_k=200"),
+    'row_cache_mb': dict(default=0, type=int,
+                         help="Size of each table's decoded row cache (sqlite only)"),
+    'shards': dict(default=0, type=int, help="If > 0, run the second hop of large queries over "
+                                             "this many worker processes"),
+    'result_cache_mb': dict(default=0, type=int,
+                            help="If > 0, keep up to this many MB of results in cb_result_cache.db, "
+                                 "shared with other processes"),
+    'fast_open': dict(action='store_true', help="Open the matrices without checking that they "
+                                                "are built (they must be)"),
+    'hot_set': dict(default='', help="File of the rows to read ahead of the first queries, "
+                                     "written by --record_hot_set"),
+    'record_hot_set': dict(default='', help="File to add the rows that queries read to, "
+                                            "when done, for --hot_set"),
+    'shared_memory': dict(default='', help="Read the csr matrices from this block, made by "
+                                           "category_builder_shared.py"),
+    'server': dict(default='', help="URL of a running category_builder_server.py to query instead"),
+    'profile': dict(action='store_true', help="Print where the time of the queries went "
+                                              "(not with --server)"),
+}
+
+# The flags of the tools that make a few queries.
+QUERY_ARGUMENTS = ('backend', 'variant', 'shards', 'result_cache_mb', 'fast_open', 'hot_set',
+                   'record_hot_set', 'shared_memory', 'server', 'profile')
+
+
+def add_builder_arguments(parser, names=QUERY_ARGUMENTS):
+    """Adds the flags of BUILDER_ARGUMENTS in names to parser, for builder_from_args."""
+    for name in names:
+        parser.add_argument(f'--{name}', **BUILDER_ARGUMENTS[name])
+
+
+def builder_kwargs(args):
+    """The CategoryBuilder arguments the flags of add_builder_arguments in args ask for."""
+    kwargs = {}
+    for name in ('backend', 'variant', 'shards', 'profile', 'fast_open'):
+        if hasattr(args, name):
+            kwargs[name] = getattr(args, name)
+    for name in ('row_cache_mb', 'result_cache_mb'):
+        if hasattr(args, name):
+            kwargs[name.replace('_mb', '_bytes')] = getattr(args, name) * 1024 * 1024
+    if hasattr(args, 'hot_set'):
+        kwargs['hot_set'] = args.hot_set or None
+    if hasattr(args, 'record_hot_set'):
+        kwargs['record_hot_set'] = bool(args.record_hot_set)
+    if hasattr(args, 'shared_memory'):
+        kwargs['shared_memory'] = args.shared_memory or None
+    return kwargs
+
+
+def builder_from_args(args, data_dir='.'):
+    """A CategoryBuilder on the matrices in data_dir, opened as args say, or a client of --server."""
+    if getattr(args, 'server', ''):
+        from category_builder_client import CategoryBuilderClient
+        return CategoryBuilderClient(args.server)
+    return CategoryBuilder(data_dir=data_dir, **builder_kwargs(args))
+
+
+def close_builder(CB, args):
+    """Adds the rows CB read to --record_hot_set, if given, and closes it; clients are left as they are."""
+    if not isinstance(CB, CategoryBuilder):
+        return
+    if getattr(args, 'record_hot_set', ''):
+        CB.SaveHotSet(args.record_hot_set)
+    CB.close()
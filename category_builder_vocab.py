@@ -0,0 +1,240 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact vocabularies mapping items or features to dense integer ids.
+
+A vocabulary is a sorted list of names, stored as two memory-mapped files:
+the UTF-8 bytes of all names back to back, and the int64 offset of each name
+(plus a final one for the end). The id of a name is its position, and is found
+by binary search, so no Python object is kept per name.
+"""
+
+import mmap
+import os.path
+from array import array
+
+STRINGS_SUFFIX = '.strings'
+OFFSETS_SUFFIX = '.offsets'
+
+
+def write_vocabulary(path_prefix, names):
+    """Writes names, which must be sorted and distinct, as a vocabulary."""
+    offsets = array('q', [0])
+    with open(path_prefix + STRINGS_SUFFIX, 'wb') as f:
+        for name in names:
+            encoded = name.encode('utf-8')
+            f.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    with open(path_prefix + OFFSETS_SUFFIX, 'wb') as f:
+        offsets.tofile(f)
+
+
+def _map_file(path):
+    """Memory-maps a file read-only. Empty files can't be mapped, so are read as b''."""
+    if not os.path.getsize(path):
+        return b''
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class Vocabulary(object):
+    """Read-only access to a vocabulary written by write_vocabulary.
+
+      Names are ordered by code point, which is also the order of their UTF-8
+      bytes, so lookups compare bytes without decoding.
+    """
+
+    def __init__(self, path_prefix, map_file=None):
+        # map_file, if given, returns a file's contents instead of memory-mapping it,
+        # as a buffer whose slices are bytes, like an mmap's.
+        map_file = map_file or _map_file
+        self.strings = map_file(path_prefix + STRINGS_SUFFIX)
+        self.offsets = memoryview(map_file(path_prefix + OFFSETS_SUFFIX)).cast('B').cast('q')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def name_bytes(self, idx):
+        return self.strings[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx):
+        return self.name_bytes(idx).decode('utf-8')
+
+    def names(self, ids):
+        """The names of a sequence of ids, as a list."""
+        strings, offsets = self.strings, self.offsets
+        return [strings[offsets[i]:offsets[i + 1]].decode('utf-8') for i in ids]
+
+    def bisect_left(self, key, lo=0):
+        """Position of the first name whose UTF-8 bytes are not less than key."""
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name_bytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def id(self, name, default=-1):
+        """The id of name, or default if it isn't in the vocabulary."""
+        key = name.encode('utf-8')
+        idx = self.bisect_left(key)
+        if idx < len(self) and self.name_bytes(idx) == key:
+            return idx
+        return default
+
+    def prefix_range(self, prefix):
+        """The ids of names starting with prefix are range(*prefix_range(prefix))."""
+        key = prefix.encode('utf-8')
+        lo = self.bisect_left(key)
+        # The first name past the range is the first one not less than key with
+        # its last byte incremented (dropping trailing 0xff bytes, which can't be).
+        end = key.rstrip(b'\xff')
+        if not end:
+            return lo, len(self)
+        return lo, self.bisect_left(end[:-1] + bytes([end[-1] + 1]), lo=lo)
+
+    def NumBytes(self):
+        """Bytes held by the vocabulary: the names, and 8 per offset."""
+        return len(self.strings) + 8 * len(self.offsets)
+
+
+# Names are split into overlapping substrings of this many characters to find
+# those within a few edits of a misspelled one.
+NGRAM_SIZE = 3
+NGRAM_PAD = '\x02', '\x03'
+# Names this short are only matched to those one edit away.
+SHORT_NAME_LENGTH = 6
+GRAMS_SUFFIX = '.grams'
+POSTINGS_SUFFIX = '.postings'
+
+
+def normalize_name(name):
+    """The form items are stored in: lowercase, with single spaces between words."""
+    return ' '.join(name.lower().split())
+
+
+def name_ngrams(name):
+    """The distinct NGRAM_SIZE-character substrings of name, padded at both ends."""
+    padded = NGRAM_PAD[0] * (NGRAM_SIZE - 1) + name + NGRAM_PAD[1] * (NGRAM_SIZE - 1)
+    return set(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+
+
+def edit_distance(a, b, max_distance):
+    """The Levenshtein distance between a and b, or max_distance + 1 if it is larger."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (a_char != b_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+
+def write_ngram_index(path_prefix, vocab):
+    """Writes, for each n-gram of the names in vocab, the sorted ids of the names having it.
+
+      The n-grams are a vocabulary of their own, and the ids of gram i are
+      postings[offsets[i]:offsets[i + 1]].
+    """
+    postings = {}
+    for idx in range(len(vocab)):
+        for gram in name_ngrams(vocab[idx]):
+            postings.setdefault(gram, array('i')).append(idx)
+    grams = sorted(postings)
+    write_vocabulary(path_prefix + GRAMS_SUFFIX, grams)
+    offsets = array('q', [0])
+    with open(path_prefix + POSTINGS_SUFFIX + STRINGS_SUFFIX, 'wb') as f:
+        for gram in grams:
+            postings[gram].tofile(f)
+            offsets.append(offsets[-1] + len(postings[gram]))
+    with open(path_prefix + POSTINGS_SUFFIX + OFFSETS_SUFFIX, 'wb') as f:
+        offsets.tofile(f)
+
+
+class NgramIndex(object):
+    """Read-only access to the n-gram index of a vocabulary, written by write_ngram_index."""
+
+    def __init__(self, path_prefix, vocab):
+        self.vocab = vocab
+        self.grams = Vocabulary(path_prefix + GRAMS_SUFFIX)
+        self.postings = memoryview(_map_file(path_prefix + POSTINGS_SUFFIX + STRINGS_SUFFIX)).cast('B').cast('i')
+        self.offsets = memoryview(_map_file(path_prefix + POSTINGS_SUFFIX + OFFSETS_SUFFIX)).cast('B').cast('q')
+
+    def suggest(self, name, max_distance=None, limit=10):
+        """Up to limit (name, distance) of names within max_distance edits of name, closest first.
+
+          By default, max_distance is 1 for names of up to SHORT_NAME_LENGTH characters, and 2 otherwise.
+
+          An edit changes at most NGRAM_SIZE n-grams, so a match shares at least
+          min_shared of the n-grams of name, and so has one of its rarest
+          len(grams) - min_shared + 1: only names having those are compared. Very
+          short names need only share one n-gram, so names sharing none are missed.
+        """
+        if max_distance is None:
+            max_distance = 1 if len(name) <= SHORT_NAME_LENGTH else 2
+        grams = name_ngrams(name)
+        min_shared = max(1, len(grams) - NGRAM_SIZE * max_distance)
+        ranges = []
+        for gram in grams:
+            gram_id = self.grams.id(gram)
+            ranges.append((self.offsets[gram_id], self.offsets[gram_id + 1]) if gram_id >= 0 else (0, 0))
+        ranges.sort(key=lambda x: x[1] - x[0])
+        candidates = set()
+        for start, end in ranges[:len(grams) - min_shared + 1]:
+            candidates.update(self.postings[start:end])
+        suggestions = []
+        offsets = self.vocab.offsets
+        for idx in candidates:
+            # A name has at most as many characters as bytes, so this skips names too short without decoding them.
+            if offsets[idx + 1] - offsets[idx] < len(name) - max_distance:
+                continue
+            candidate = self.vocab[idx]
+            if abs(len(candidate) - len(name)) > max_distance:
+                continue
+            if len(grams & name_ngrams(candidate)) < min_shared:
+                continue
+            distance = edit_distance(name, candidate, max_distance)
+            if distance <= max_distance:
+                suggestions.append((candidate, distance))
+        suggestions.sort(key=lambda x: (x[1], x[0]))
+        return suggestions[:limit]
+
+    def NumBytes(self):
+        return self.grams.NumBytes() + 4 * len(self.postings) + 8 * len(self.offsets)
+
+
+def write_vocabulary_index(index_dir, items, features):
+    """Writes the sorted item and feature names given, and an n-gram index of the items."""
+    write_vocabulary(os.path.join(index_dir, 'items'), items)
+    write_vocabulary(os.path.join(index_dir, 'features'), features)
+    write_ngram_index(os.path.join(index_dir, 'items'), Vocabulary(os.path.join(index_dir, 'items')))
+
+
+class VocabularyIndex(object):
+    """The vocabularies written by write_vocabulary_index: exact, prefix and fuzzy lookups."""
+
+    def __init__(self, index_dir):
+        self.items = Vocabulary(os.path.join(index_dir, 'items'))
+        self.features = Vocabulary(os.path.join(index_dir, 'features'))
+        self.item_ngrams = NgramIndex(os.path.join(index_dir, 'items'), self.items)
+
+    def NumBytes(self):
+        return self.items.NumBytes() + self.features.NumBytes() + self.item_ngrams.NumBytes()
@@ -24,8 +24,11 @@ The example above is from this set:
 
 
 from collections import defaultdict
+import multiprocessing
+import os
 import random
-from eval_util import CleanString
+from eval_util import CleanString, InitWorker
+import eval_util
 import argparse
 import category_builder_util as util
 
@@ -45,26 +48,67 @@ def ReadData(filename):
   return out
 
 
-def GetAnalogy(CB, b, c, squash, semantic_n):
-  expansion = CB.DoAnalogy(b=b, c=c, squash=squash, semantic_n=semantic_n)[:50]
+# How many items of each analogy's results are examined.
+ANALOGY_SIZE = 50
+
+def GetAnalogy(CB, b, c, squash, semantic_n, analogy_size=ANALOGY_SIZE):
+  expansion = CB.DoAnalogy(b=b, c=c, squash=squash, semantic_n=semantic_n, k=analogy_size)
   return expansion
 
+def GetQuestionPairs(fourtuple, reverse):
+  if reverse:
+    pair_1 = {'lhs': fourtuple[1], 'rhs': fourtuple[0]}
+    pair_2 = {'lhs': fourtuple[3], 'rhs': fourtuple[2]}
+  else:
+    pair_1 = {'lhs': fourtuple[0], 'rhs': fourtuple[1]}
+    pair_2 = {'lhs': fourtuple[2], 'rhs': fourtuple[3]}
+  return pair_1, pair_2
+
+def GetAnalogyPartInWorker(task):
+  """One half of DoAnalogy, in a worker process: the expansion of b, or what co-occurs with c."""
+  kind, term, semantic_n = task
+  if kind == 'b':
+    return list(eval_util.worker_CB.ExpandCategory(seeds=[term, ], rho=1, n=semantic_n))
+  return list(eval_util.worker_CB.GetCooccurringItems(seed=term))
+
+def GetSharedAnalogies(CB, pool, b_c_pairs, squash, semantic_n, analogy_size=ANALOGY_SIZE):
+  """Returns the analogy for each (b, c), computing each distinct b and c only once.
+
+  This is done by CB.DoAnalogyBatch if there is no pool. Otherwise, the expansions
+  and co-occurrences are spread over the pool, and merged here.
+  """
+  if pool is None:
+    return dict(zip(b_c_pairs, CB.DoAnalogyBatch(b_c_pairs, squash=squash, semantic_n=semantic_n,
+                                                 k=analogy_size)))
+  bs = list(dict.fromkeys(b for b, _ in b_c_pairs))
+  cs = list(dict.fromkeys(c for _, c in b_c_pairs))
+  parts = pool.map(GetAnalogyPartInWorker,
+                   [('b', b, semantic_n) for b in bs] + [('c', c, semantic_n) for c in cs],
+                   chunksize=1)
+  things_like = dict(zip(bs, parts[:len(bs)]))
+  things_cooccuring_with = dict(zip(cs, parts[len(bs):]))
+  return dict(((b, c), util.MergeScores(things_like[b], things_cooccuring_with[c], squash=squash,
+                                        k=analogy_size))
+              for b, c in b_c_pairs)
+
 def EvaluateAnalogies(CB, catname, fourtuples, rho, n, squash, reverse,
-                      semantic_n):
+                      semantic_n, analogies=None, analogy_size=ANALOGY_SIZE):
+  """Prints how well analogies are solved, and returns how many are solved at the top.
+
+  Analogies are taken from analogies, keyed by (b, c), if given.
+  """
   effective_catname = catname
   if reverse:
     effective_catname = effective_catname + " REVERSE"
   print(f"\n\n=========  {effective_catname} ============\n\n")
   correct_at_pos = defaultdict(int)
   for tuple_number, fourtuple in enumerate(fourtuples):
-    if reverse:
-      pair_1 = {'lhs': fourtuple[1], 'rhs': fourtuple[0]}
-      pair_2 = {'lhs': fourtuple[3], 'rhs': fourtuple[2]}
+    pair_1, pair_2 = GetQuestionPairs(fourtuple, reverse)
+    if analogies is not None:
+      expansion = analogies[(pair_1["rhs"], pair_2["lhs"])]
     else:
-      pair_1 = {'lhs': fourtuple[0], 'rhs': fourtuple[1]}
-      pair_2 = {'lhs': fourtuple[2], 'rhs': fourtuple[3]}
-    expansion = GetAnalogy(CB, b=pair_1["rhs"], c=pair_2["lhs"], squash=squash,
-                           semantic_n=semantic_n)
+      expansion = GetAnalogy(CB, b=pair_1["rhs"], c=pair_2["lhs"], squash=squash,
+                             semantic_n=semantic_n, analogy_size=analogy_size)
     solved = False
     incorrect_seen = []
     for idx, item in enumerate(expansion):
@@ -93,6 +137,7 @@ def EvaluateAnalogies(CB, catname, fourtuples, rho, n, squash, reverse,
   print("=====================================")
   print("CORRECTNESS By Index for ", effective_catname, correct_at_pos)
   print(f"ACCURACY FOR {effective_catname}:\t {1.0 * correct_at_pos[1] / len(fourtuples)}")
+  return correct_at_pos[1]
 
 
 if __name__ == '__main__':
@@ -102,19 +147,48 @@ if __name__ == '__main__':
                       help="How many features to use")
   parser.add_argument('--squash', default=100.0, type=float, help="Squash for combining scores")
   parser.add_argument('--semantic_n', default=200, type=int, help="n for semantic expansion")
+  parser.add_argument('--analogy_size', default=ANALOGY_SIZE, type=int,
+                      help="How many results of each analogy to compute and examine")
+  util.add_builder_arguments(parser, ('backend', 'variant', 'server', 'profile'))
+  parser.add_argument('--jobs', default=0, type=int,
+                      help="If > 0, compute each distinct b and c once, over this many processes")
+  parser.add_argument('--random_seed', default=None, type=int,
+                      help="Seed for shuffling the questions, to make runs reproducible")
 
   parser.add_argument('filename', type=str, help='File containing eval data')
   flags = parser.parse_args()
 
-  CB = util.CategoryBuilder(data_dir='.')
+  pool = None
+  if flags.jobs > 1 and not flags.server:
+    # Workers only open the matrices, so build them first.
+    util.BuildMatrices('.', flags.backend, variant=flags.variant)
+    CB = None
+    pool = multiprocessing.Pool(flags.jobs, initializer=InitWorker,
+                                initargs=('.', flags.backend, flags.variant))
+  else:
+    CB = util.builder_from_args(flags)
 
+  random.seed(flags.random_seed)
   data = ReadData(flags.filename)
   for catname, fourtuples in data.items():
     random.shuffle(fourtuples)
     if catname.startswith('gram') and not catname.startswith('gram6'):
       print("SKIPPING ", catname)
       continue
+    analogies = None
+    if flags.jobs > 0:
+      b_c_pairs = [(pair_1["rhs"], pair_2["lhs"])
+                   for reverse in (True, False)
+                   for pair_1, pair_2 in (GetQuestionPairs(x, reverse) for x in fourtuples)]
+      analogies = GetSharedAnalogies(CB, pool, list(dict.fromkeys(b_c_pairs)),
+                                     squash=flags.squash, semantic_n=flags.semantic_n,
+                                     analogy_size=flags.analogy_size)
     EvaluateAnalogies(CB, catname, fourtuples, rho=flags.rho, n=flags.n, squash=flags.squash, reverse=True,
-                      semantic_n=flags.semantic_n)
+                      semantic_n=flags.semantic_n, analogies=analogies, analogy_size=flags.analogy_size)
     EvaluateAnalogies(CB, catname, fourtuples, rho=flags.rho, n=flags.n, squash=flags.squash, reverse=False,
-                      semantic_n=flags.semantic_n)
+                      semantic_n=flags.semantic_n, analogies=analogies, analogy_size=flags.analogy_size)
+  if pool is not None:
+    pool.close()
+  if CB is not None and getattr(CB, 'profiler', None):
+    print(CB.profiler.Report())
+  util.close_builder(CB, flags)
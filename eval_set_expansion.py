@@ -22,8 +22,10 @@ import shlex, subprocess
 import sys
 import random
 from subprocess import Popen, PIPE
-from eval_util import CleanString, GetExpansion, EvaluateOneList
+from eval_util import CleanString, GetExpansions, EvaluateOneList
 import argparse
+import os
+import category_builder_util as util
 
 class CategoryEvalMAP(object):
 
@@ -50,7 +52,22 @@ class CategoryEvalMAP(object):
           next_index = next_index + 1
 
 
-  def Eval(self, num_iterations, seeds_in_top_n, map_n, rho, n):
+  def Eval(self, num_iterations, seeds_in_top_n, map_n, rho, n, server=None, jobs=1,
+           random_seed=None, backend='sqlite', variant=None, profile=False):
+    """Returns the MAP score for one setting of rho and n."""
+    scores = self.EvalGrid(num_iterations, seeds_in_top_n, map_n, rhos=[rho], ns=[n], server=server,
+                           jobs=jobs, random_seed=random_seed, backend=backend, variant=variant,
+                           profile=profile)
+    return scores[(rho, n)]
+
+  def EvalGrid(self, num_iterations, seeds_in_top_n, map_n, rhos, ns, server=None, jobs=1,
+               random_seed=None, backend='sqlite', variant=None, profile=False):
+    """Returns MAP scores keyed by (rho, n), for every combination of rhos and ns.
+
+    The same seeds are used for every setting. They are drawn with random_seed, if given,
+    so that runs can be reproduced. All the expansions are computed in one pass, over
+    jobs processes (see GetExpansions, which also explains profile).
+    """
     effective_seeds = self.candidate_seeds
     if seeds_in_top_n > 0:
       effective_seeds = effective_seeds[:seeds_in_top_n]
@@ -58,7 +75,30 @@ class CategoryEvalMAP(object):
     if not synsets_to_seek:
       synsets_to_seek = len(effective_seeds)
     print(f"SEEDS TO SELECT FROM: {effective_seeds}")
-    
+
+    rng = random.Random(random_seed)
+    seed_lists = [rng.sample(effective_seeds, self.SEEDS_TO_USE) for _ in range(num_iterations)]
+    grid = [(rho, n) for rho in rhos for n in ns]
+    expansions = GetExpansions([(seeds, rho, n) for rho, n in grid for seeds in seed_lists],
+                               jobs=jobs, server=server, backend=backend, variant=variant,
+                               profile=profile)
+
+    scores = {}
+    for grid_index, (rho, n) in enumerate(grid):
+      if len(grid) > 1:
+        print(f"\n\n=========  rho={rho} n={n} ============")
+      start = grid_index * num_iterations
+      scores[(rho, n)] = self.Score(seed_lists, expansions[start:start + num_iterations],
+                                    synsets_to_seek)
+    if len(grid) > 1:
+      print("\n\nMAP score by setting:")
+      for (rho, n), score in scores.items():
+        print(f"\trho={rho}\tn={n}\t{100.0 * score: 5.3f}%")
+    return scores
+
+  def Score(self, seed_lists, expansions, synsets_to_seek):
+    """Prints the precision of each expansion, and returns their MAP score."""
+    num_iterations = len(seed_lists)
     # An intruder is a bad item in the expansion that comes before good ones.
     # Baddness is the fraction of sysnsets before which it occurs: for U.S states,
     # seeing "China" in the first position in the expansion has badness=1.0, but seeing
@@ -66,9 +106,7 @@ class CategoryEvalMAP(object):
     intrusions_by_badness = defaultdict(float)
 
     score_sum = 0.0
-    for itercount in range(num_iterations):
-      seeds = random.sample(effective_seeds, self.SEEDS_TO_USE)
-      expansion = GetExpansion(seeds, rho=rho, n=n)
+    for itercount, (seeds, expansion) in enumerate(zip(seed_lists, expansions)):
       score_here, intrusions = EvaluateOneList(self.item_to_index, expansion, synsets_to_seek)
       for intrusion, position, badness in intrusions:
         intrusions_by_badness[intrusion] += badness
@@ -83,6 +121,7 @@ class CategoryEvalMAP(object):
       print(f"\t{100.0 * badness / num_iterations:5.3f}%\t{intrusion}")
 
     print(f"\n\nMAP score: {100.0 * score_sum / num_iterations: 5.3f}%")
+    return score_sum / num_iterations
       
   
 
@@ -97,10 +136,26 @@ if __name__ == '__main__':
   parser.add_argument('--rho', default=3.0, type=float, help="The rho param")
   parser.add_argument('--n', default=100, type=int,
                       help="How many features to use")
+  parser.add_argument('--rho_grid', default='',
+                      help="Comma-separated values of rho to evaluate, instead of --rho")
+  parser.add_argument('--n_grid', default='',
+                      help="Comma-separated values of n to evaluate, instead of --n")
+  parser.add_argument('--jobs', default=os.cpu_count() or 1, type=int,
+                      help="How many processes to compute expansions with")
+  parser.add_argument('--random_seed', default=None, type=int,
+                      help="Seed for choosing the seeds, to make runs reproducible")
+  # With --profile, the queries run in this process, not over --jobs processes.
+  util.add_builder_arguments(parser, ('backend', 'variant', 'server', 'profile'))
   flags = parser.parse_args()
-  
-  eval_category = CategoryEvalMAP(flags.filename)
-  eval_category.Eval(num_iterations=flags.iterations,
-    	             seeds_in_top_n=flags.seeds_in_top_n,
-    	             map_n=flags.map_n, rho=flags.rho, n=flags.n)
+  if flags.profile and flags.server:
+    parser.error("--profile needs the queries to run in this process, not on --server")
 
+  eval_category = CategoryEvalMAP(flags.filename)
+  eval_category.EvalGrid(num_iterations=flags.iterations,
+                         seeds_in_top_n=flags.seeds_in_top_n,
+                         map_n=flags.map_n,
+                         rhos=[float(x) for x in flags.rho_grid.split(',')] if flags.rho_grid else [flags.rho],
+                         ns=[int(x) for x in flags.n_grid.split(',')] if flags.n_grid else [flags.n],
+                         server=flags.server,
+                         jobs=1 if flags.profile else flags.jobs, random_seed=flags.random_seed,
+                         backend=flags.backend, variant=flags.variant, profile=flags.profile)
@@ -13,10 +13,19 @@
 # limitations under the License.
 
 from collections import defaultdict
+import multiprocessing
 import shlex, subprocess
 import sys
 import random
 from subprocess import Popen, PIPE
+from category_builder_client import CategoryBuilderClient
+import category_builder_util as util
+
+# How many items of each expansion are evaluated.
+EXPANSION_SIZE = 500
+
+# The CategoryBuilder of a worker process, set by InitWorker.
+worker_CB = None
 
 def CleanString(inp):
   return inp.lower().replace('_', ' ')
@@ -25,7 +34,7 @@ def CleanString(inp):
 def GetExpansionCBGivenQuery(seeds, rho, n):
   arguments = [
     'python3', 'category_builder.py', '--cutpaste',
-    '--n', str(n), '--rho', str(rho), '--expansion_size', '500'
+    '--n', str(n), '--rho', str(rho), '--expansion_size', str(EXPANSION_SIZE)
   ]
   for seed in seeds:
     arguments.append('\'%s\'' % seed)
@@ -34,8 +43,52 @@ def GetExpansionCBGivenQuery(seeds, rho, n):
                                       universal_newlines=True).strip().split(', ')
   return expansion
 
-def GetExpansion(seeds, rho, n):
+def GetExpansionFromServer(server, seeds, rho, n):
+  items = CategoryBuilderClient(server).ExpandCategory(seeds=seeds, rho=rho, n=n, k=EXPANSION_SIZE)
+  return [item[0] for item in items]
+
+def GetExpansionInProcess(CB, seeds, rho, n):
+  modified_seeds = [CleanString(x) for x in seeds]
+  items = CB.ExpandCategory(seeds=modified_seeds, rho=rho, n=n, k=EXPANSION_SIZE)
+  return [item[0] for item in items]
+
+def InitWorker(data_dir, backend, variant=None):
+  global worker_CB
+  worker_CB = util.CategoryBuilder(data_dir=data_dir, backend=backend, variant=variant)
+
+def GetExpansionInWorker(query):
+  seeds, rho, n = query
+  return GetExpansionInProcess(worker_CB, seeds, rho, n)
+
+def GetExpansions(queries, jobs=1, server=None, data_dir='.', backend='sqlite', variant=None,
+                  profile=False):
+  """Returns the expansion for each (seeds, rho, n) in queries, in order.
+
+  Queries go to server if given (its URL). Otherwise they run in this process
+  if jobs is 1, or spread over a pool of jobs processes with a CategoryBuilder each.
+  With profile, queries run in this process print where their time went.
+  """
+  if server:
+    return [GetExpansion(seeds, rho=rho, n=n, server=server) for seeds, rho, n in queries]
+  if jobs <= 1:
+    CB = util.CategoryBuilder(data_dir=data_dir, backend=backend, variant=variant, profile=profile)
+    try:
+      return [GetExpansionInProcess(CB, seeds, rho, n) for seeds, rho, n in queries]
+    finally:
+      if profile:
+        print(CB.profiler.Report())
+      CB.close()
+  # Workers only open the matrices, so build them first.
+  util.BuildMatrices(data_dir, backend, variant=variant)
+  with multiprocessing.Pool(jobs, initializer=InitWorker,
+                            initargs=(data_dir, backend, variant)) as pool:
+    return pool.map(GetExpansionInWorker, queries, chunksize=1)
+
+def GetExpansion(seeds, rho, n, server=None):
+  """Expands via a running category_builder_server.py if server (its URL) is given."""
   modified_seeds = [x.lower().replace('_', ' ') for x in seeds]
+  if server:
+    return GetExpansionFromServer(server, modified_seeds, rho, n)
   return GetExpansionCBGivenQuery(modified_seeds, rho, n)
 
 def EvaluateOneList(item_to_index, expansion, synsets_to_seek):
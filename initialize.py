@@ -15,7 +15,50 @@
 # This file initializes Category Builder.
 # It produces two files totaling about 5 GB.
 
+import argparse
+import category_builder_index as cb_index
 import category_builder_util as util
 
 if __name__ == "__main__":
-    util.create_db(data_dir=".")
+    parser = argparse.ArgumentParser(description='Initialize Category Builder')
+    util.add_builder_arguments(parser, ('backend', 'variant'))
+    parser.add_argument('--jobs', default=0, type=int,
+                        help="If > 0, parse the inputs with this many processes and bulk-load (sqlite only), "
+                             "and precompute --single_seed_index with them")
+    parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                        help="Rebuild the sqlite database even if it exists")
+    parser.add_argument('--no_progress', dest='progress', action='store_false',
+                        help="Do not show progress bars (sqlite only)")
+    parser.add_argument('--transpose_memory_mb', default=util.TRANSPOSE_MEMORY_BYTES // (1024 * 1024),
+                        type=int, help="Memory for building I_TO_F_C before spilling to disk (sqlite only)")
+    parser.add_argument('--merge_delta', default='',
+                        help="Directory of delta inputs to merge into the existing sqlite database")
+    parser.add_argument('--delta_mode', default='add', choices=util.DELTA_MODES,
+                        help="Whether delta weights are added to stored ones, or replace them")
+    parser.add_argument('--single_seed_index', dest='single_seed_index', action='store_true',
+                        help="Also precompute single-seed expansions and co-occurring items, "
+                             "in parallel with --jobs processes; resumes if interrupted")
+    parser.add_argument('--index_n', default=100, type=int,
+                        help="The n of the precomputed expansions (semantic_n for analogies)")
+    parser.add_argument('--index_top_k', default=500, type=int,
+                        help="How many items to precompute for each seed")
+    parser.set_defaults(rebuild=False, progress=True, single_seed_index=False)
+    args = parser.parse_args()
+    if args.variant and args.backend != 'csr':
+        parser.error("--variant is only available with --backend=csr")
+    if args.merge_delta:
+        if args.backend != 'sqlite':
+            parser.error("--merge_delta is only available with --backend=sqlite")
+        util.merge_delta(data_dir=".", delta_dir=args.merge_delta, mode=args.delta_mode,
+                         progress=args.progress)
+    elif args.backend == 'sqlite':
+        util.create_db(data_dir=".", jobs=args.jobs, progress=args.progress, rebuild=args.rebuild,
+                       transpose_memory_bytes=args.transpose_memory_mb * 1024 * 1024)
+    else:
+        util.BuildMatrices(data_dir=".", backend=args.backend, variant=args.variant)
+    if args.backend == 'sqlite':
+        # As BuildMatrices does, so that --fast_open can start without building it.
+        util.build_vocabulary_index(data_dir=".", backend=args.backend)
+    if args.single_seed_index:
+        cb_index.build_index(data_dir=".", backend=args.backend, variant=args.variant, n=args.index_n,
+                             top_k=args.index_top_k, jobs=max(args.jobs, 1), progress=args.progress)
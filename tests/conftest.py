@@ -0,0 +1,182 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tiny synthetic inputs, and the matrices built from them, shared by the tests.
+
+Weights are small integers, so that many scores tie and the order of results
+depends on how ties are broken.
+"""
+
+import bz2
+import contextlib
+import csv
+import io
+import os
+import random
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import category_builder_util as util
+
+
+def synthetic_inputs(rng, num_items=150, num_syntactic=300, num_cooccurring=60):
+    """Returns (i_to_f, f_to_i), dicts from each row's key to a dict of its entries' weights.
+
+      As in the real data, an item's I_TO_F row holds its syntactic features, and
+      the co-occurrence feature ('C' and the item) of the most popular items.
+    """
+    items = [f'item{i}' for i in range(num_items)] + ['new york', 'a, "b"']
+    popularity = [1.0 / (i + 1) ** 0.7 for i in range(len(items))]
+    f_to_i = {}
+    for i in range(num_syntactic):
+        chosen = set(rng.choices(items, weights=popularity, k=rng.randint(2, 30)))
+        f_to_i[f'S{i}|x'] = dict((item, rng.randint(1, 20)) for item in chosen)
+    for owner in items[:num_cooccurring]:
+        chosen = set(rng.choices(items, weights=popularity, k=rng.randint(1, 25)))
+        f_to_i[f'C{owner}'] = dict((item, rng.randint(1, 20)) for item in chosen)
+    i_to_f = {}
+    for feature, row in f_to_i.items():
+        if feature.startswith('S'):
+            for item, wt in row.items():
+                i_to_f.setdefault(item, {})[feature] = wt
+    for owner in items[:num_cooccurring]:
+        i_to_f.setdefault(owner, {})[f'C{owner}'] = rng.randint(1, 20)
+    return i_to_f, f_to_i
+
+
+def write_input(path, rows):
+    """Writes rows as an input file: a CSV line per key, entries by decreasing weight."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for key, row in rows.items():
+        line = [key]
+        for entry, wt in sorted(row.items(), key=lambda pair: -pair[1]):
+            line += [entry, str(wt)]
+        writer.writerow(line)
+    with bz2.open(path, 'wb') as f:
+        f.write(out.getvalue().encode('utf-8'))
+
+
+def write_inputs(data_dir, i_to_f, f_to_i):
+    os.makedirs(data_dir, exist_ok=True)
+    write_input(os.path.join(data_dir, util.I_TO_F_INPUT), i_to_f)
+    write_input(os.path.join(data_dir, util.F_TO_I_INPUT), f_to_i)
+
+
+def copy_inputs(data_dir, new_dir):
+    """A new data directory with the inputs of data_dir, and nothing built."""
+    os.makedirs(new_dir)
+    for input_name in (util.I_TO_F_INPUT, util.F_TO_I_INPUT):
+        shutil.copy(os.path.join(data_dir, input_name), new_dir)
+    return str(new_dir)
+
+
+def read_tables(data_dir):
+    """Every row of every table of the sqlite database in data_dir, as lists of (entry, weight)."""
+    connection = sqlite3.connect(os.path.join(data_dir, util.SQLITE3_DB))
+    cursor = connection.cursor()
+    tables = {}
+    for table_name, field_name in util.KEY_FIELDS.items():
+        keys = [key for key, in cursor.execute(f'select {field_name} from {table_name}').fetchall()]
+        tables[table_name] = dict((key, list(util.get_row(cursor, table_name, field_name, key).items()))
+                                  for key in keys)
+    connection.close()
+    return tables
+
+
+def quiet():
+    """Hides what building and querying print."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def queries(items, k_values=(None, 1, 5)):
+    """(query, run) for each kind of query, for a few seeds taken from items; run(CB) answers it."""
+    rng = random.Random(1)
+    seed_lists = [[item] for item in items[:8]] + [rng.sample(items, 3) for _ in range(8)]
+    for k in k_values:
+        for seeds in seed_lists:
+            yield (('ExpandCategory', tuple(seeds), k),
+                   lambda CB, seeds=seeds, k=k: CB.ExpandCategory(seeds, rho=3.0, n=100, k=k))
+        for item in items[:12]:
+            yield (('GetCooccurringItems', item, k),
+                   lambda CB, item=item, k=k: CB.GetCooccurringItems(item, k=k))
+            yield (('DoAnalogy', item, k),
+                   lambda CB, item=item, k=k: CB.DoAnalogy(items[-1], item, squash=100.0, k=k))
+    yield ('ExpandCategory', 'unknown'), lambda CB: CB.ExpandCategory(['no such item'], rho=3.0, n=100)
+    yield ('GetItemsGivenWeightedContexts', lambda CB: CB.GetItemsGivenWeightedContexts(
+        [('S1|x', 1.0), ('S2|x', 0.5), ('Citem0', 2.0)]))
+
+
+def query_results(CB, items, k_values=(None, 1, 5)):
+    """The results of each of queries, by query."""
+    with quiet():
+        return dict((query, run(CB)) for query, run in queries(items, k_values))
+
+
+def by_rounded_rank(pair):
+    """by_rank, on scores rounded to 10 digits, so that scores equal but for rounding tie."""
+    return -float(f'{pair[1]:.10g}'), pair[0]
+
+
+def assert_same_results(expected, actual, rounded_ties=False):
+    """Checks that each query has the same items, in the same order, with the same scores.
+
+      With rounded_ties, scores summed in another order may differ in their last bits,
+      so items whose scores are equal but for that may be in either order.
+    """
+    assert expected.keys() == actual.keys()
+    for query, expected_results in expected.items():
+        actual_results = list(actual[query])
+        if rounded_ties:
+            expected_results = sorted(expected_results, key=by_rounded_rank)
+            actual_results = sorted(actual_results, key=by_rounded_rank)
+        assert [item for item, _ in actual_results] == [item for item, _ in expected_results], query
+        assert [score for _, score in actual_results] == pytest.approx(
+            [score for _, score in expected_results], rel=1e-6), query
+
+
+@pytest.fixture(scope='session')
+def inputs():
+    return synthetic_inputs(random.Random(0))
+
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory, inputs):
+    """A data directory with the matrices and vocabulary index of both backends built."""
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    write_inputs(data_dir, *inputs)
+    with quiet():
+        for backend in util.BACKENDS:
+            util.BuildMatrices(data_dir, backend)
+    return data_dir
+
+
+@pytest.fixture(scope='session')
+def items(inputs):
+    """The items of I_TO_F, those with a co-occurrence feature first."""
+    i_to_f, _ = inputs
+    return sorted(i_to_f, key=lambda item: f'C{item}' not in i_to_f[item])
+
+
+@pytest.fixture(scope='session')
+def baseline(data_dir, items):
+    """The results of the plain sqlite backend, without index, shards or caches."""
+    CB = util.CategoryBuilder(data_dir, use_index=False)
+    yield query_results(CB, items)
+    CB.close()
@@ -0,0 +1,167 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The ways of building the matrices give the same tables as the plain serial build."""
+
+import bz2
+import os
+import random
+import sqlite3
+
+import pytest
+
+import category_builder_util as util
+from conftest import copy_inputs, quiet, read_tables, write_inputs
+
+
+@pytest.fixture(scope='module')
+def serial_tables(data_dir):
+    return read_tables(data_dir)
+
+
+def test_parallel_build(data_dir, serial_tables, tmp_path):
+    build_dir = copy_inputs(data_dir, tmp_path / 'parallel')
+    with quiet():
+        util.create_db(build_dir, jobs=2, progress=False)
+    assert read_tables(build_dir) == serial_tables
+
+
+def test_spilled_transpose(data_dir, serial_tables, tmp_path):
+    build_dir = copy_inputs(data_dir, tmp_path / 'spilled')
+    with quiet():
+        util.create_db(build_dir, progress=False,
+                       transpose_memory_bytes=10 * util.TRANSPOSE_RECORD_BYTES)
+    assert read_tables(build_dir) == serial_tables
+
+
+def merged_rows(rows, delta_rows, mode):
+    merged = dict((key, dict(row)) for key, row in rows.items())
+    for key, delta_row in delta_rows.items():
+        row = merged.setdefault(key, {})
+        for entry, wt in delta_row.items():
+            row[entry] = row[entry] + wt if mode == 'add' and entry in row else wt
+    return merged
+
+
+@pytest.mark.parametrize('mode', util.DELTA_MODES)
+def test_merge_delta(inputs, tmp_path, mode):
+    i_to_f, f_to_i = inputs
+    rng = random.Random(2)
+    items = sorted(i_to_f)
+    delta_f_to_i = dict((feature, dict((item, rng.randint(1, 20)) for item in rng.sample(items, 4)))
+                        for feature in rng.sample(sorted(f_to_i), 20) + ['Snew|x', 'Citem0'])
+    delta_f_to_i['Snew|x']['new item'] = 3
+    delta_i_to_f = {}
+    for feature, row in delta_f_to_i.items():
+        if feature.startswith('S'):
+            for item, wt in row.items():
+                delta_i_to_f.setdefault(item, {})[feature] = wt
+
+    merged_dir = str(tmp_path / 'merged')
+    delta_dir = str(tmp_path / 'delta')
+    full_dir = str(tmp_path / 'full')
+    write_inputs(merged_dir, i_to_f, f_to_i)
+    write_inputs(delta_dir, delta_i_to_f, delta_f_to_i)
+    write_inputs(full_dir, merged_rows(i_to_f, delta_i_to_f, mode),
+                 merged_rows(f_to_i, delta_f_to_i, mode))
+    with quiet():
+        util.create_db(merged_dir, progress=False)
+        util.merge_delta(merged_dir, delta_dir, mode=mode, progress=False)
+        util.create_db(full_dir, progress=False)
+
+    merged_tables, full_tables = read_tables(merged_dir), read_tables(full_dir)
+    for table_name, full_rows in full_tables.items():
+        assert merged_tables[table_name].keys() == full_rows.keys(), table_name
+        for key, row in merged_tables[table_name].items():
+            # Merged rows are re-sorted, so only tied entries may be in another order.
+            assert dict(row) == dict(full_rows[key]), (table_name, key)
+            assert [wt for _, wt in row] == [wt for _, wt in full_rows[key]], (table_name, key)
+
+
+def test_csr_pruning_keeps_cooccurrences(data_dir, items, tmp_path):
+    build_dir = copy_inputs(data_dir, tmp_path / 'pruned')
+    with quiet():
+        full = util.CategoryBuilder(build_dir, backend='csr', use_index=False)
+        pruned = util.CategoryBuilder(build_dir, backend='csr', variant='i_to_f_top_k=2',
+                                      use_index=False)
+        for item in items[:20]:
+            assert len(pruned.GetSyntacticFeaturesForItem(item)) <= 2
+            cooccurring = full.GetCooccurringItems(item)
+            assert cooccurring and pruned.GetCooccurringItems(item) == cooccurring
+    full.close()
+    pruned.close()
+
+
+
+def drop_split_tables(data_dir):
+    """Makes the database in data_dir like one built before I_TO_F was split."""
+    connection = sqlite3.connect(os.path.join(data_dir, util.SQLITE3_DB))
+    for table_name in util.I_TO_F_SPLITS.values():
+        connection.execute(f'DROP TABLE {table_name}')
+    connection.commit()
+    connection.close()
+
+
+def test_old_database_is_split_by_initialize_only(data_dir, serial_tables, tmp_path):
+    build_dir = copy_inputs(data_dir, tmp_path / 'old')
+    with quiet():
+        util.create_db(build_dir, progress=False)
+    drop_split_tables(build_dir)
+    with pytest.raises(RuntimeError, match='initialize.py'):
+        util.CategoryBuilder(build_dir, use_index=False)
+    with quiet():
+        util.create_db(build_dir, progress=False)
+    assert read_tables(build_dir) == serial_tables
+
+
+def test_interrupted_split_is_redone(data_dir, serial_tables, tmp_path, monkeypatch):
+    build_dir = copy_inputs(data_dir, tmp_path / 'interrupted')
+    with quiet():
+        util.create_db(build_dir, progress=False)
+    drop_split_tables(build_dir)
+    split_by_feature_type = util.split_by_feature_type
+    calls = []
+
+    def interrupted(pieces):
+        calls.append(pieces)
+        if len(calls) > 20:
+            raise KeyboardInterrupt
+        return split_by_feature_type(pieces)
+
+    monkeypatch.setattr(util, 'split_by_feature_type', interrupted)
+    with quiet(), pytest.raises(KeyboardInterrupt):
+        util.create_db(build_dir, progress=False)
+    monkeypatch.setattr(util, 'split_by_feature_type', split_by_feature_type)
+    assert not util.is_split(os.path.join(build_dir, util.SQLITE3_DB))
+    with quiet():
+        util.create_db(build_dir, progress=False)
+    assert read_tables(build_dir) == serial_tables
+
+
+@pytest.mark.parametrize('mode', util.DELTA_MODES)
+def test_merge_delta_counts_repeated_entries_once(inputs, tmp_path, mode):
+    data_dir, delta_dir = str(tmp_path / 'data'), str(tmp_path / 'delta')
+    write_inputs(data_dir, *inputs)
+    os.makedirs(delta_dir)
+    # As with get_row, the first line for a key, and the first weight of an entry, count.
+    with bz2.open(os.path.join(delta_dir, util.F_TO_I_INPUT), 'wb') as f:
+        f.write(b'S1|x,item0,7,item0,9\nS1|x,item1,5\n')
+    with quiet():
+        util.create_db(data_dir, progress=False)
+        stored = read_tables(data_dir)['F_TO_I']['S1|x']
+        util.merge_delta(data_dir, delta_dir, mode=mode, progress=False)
+    merged = dict(read_tables(data_dir)['F_TO_I']['S1|x'])
+    old = dict(stored)
+    assert merged['item0'] == pytest.approx(0.07 + (old.get('item0', 0) if mode == 'add' else 0))
+    assert merged.get('item1') == old.get('item1')
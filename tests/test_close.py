@@ -0,0 +1,44 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CategoryBuilder.close releases everything the builder opened."""
+
+import multiprocessing
+import sqlite3
+
+import pytest
+
+import category_builder_hot_set as cb_hot_set
+import category_builder_index as cb_index
+import category_builder_util as util
+from conftest import copy_inputs, quiet
+
+
+def test_close(data_dir, items, tmp_path):
+    close_dir = copy_inputs(data_dir, tmp_path / 'close')
+    hot_set = str(tmp_path / 'hot.json')
+    with quiet():
+        cb_index.build_index(close_dir, n=100, top_k=3, jobs=1, progress=False)
+        cb_hot_set.save_hot_set(hot_set, {'I_TO_F_SYN': dict((item, 1) for item in items)})
+        CB = util.CategoryBuilder(close_dir, shards=2, result_cache_bytes=10 ** 6, hot_set=hot_set)
+        CB.DoAnalogy(items[0], items[1], squash=100.0, k=3)
+    connections = (CB.matrices.matrices.connections + CB.index.connections
+                   + CB.result_cache.connections)
+    assert connections and multiprocessing.active_children()
+    CB.close()
+    assert not CB.warming.is_alive()
+    assert not multiprocessing.active_children()
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('select 1')
@@ -0,0 +1,49 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Analogies computed once for all the questions are those asked one question at a time."""
+
+import multiprocessing
+
+import eval_analogy
+import eval_util
+import category_builder_util as util
+from conftest import quiet
+
+
+def test_shared_analogies(data_dir, items):
+    fourtuples = [[items[i], items[i + 1], items[i + 2], items[i + 3]] for i in range(0, 24, 2)]
+    b_c_pairs = list(dict.fromkeys(
+        (pair_1['rhs'], pair_2['lhs'])
+        for reverse in (True, False)
+        for pair_1, pair_2 in (eval_analogy.GetQuestionPairs(x, reverse) for x in fourtuples)))
+    CB = util.CategoryBuilder(data_dir, use_index=False)
+    with quiet():
+        asked = dict(((b, c), list(eval_analogy.GetAnalogy(CB, b, c, squash=100.0, semantic_n=100)))
+                     for b, c in b_c_pairs)
+        assert any(asked.values())
+        batched = eval_analogy.GetSharedAnalogies(CB, None, b_c_pairs, squash=100.0, semantic_n=100)
+        with multiprocessing.Pool(2, initializer=eval_util.InitWorker,
+                                  initargs=(data_dir, 'sqlite')) as pool:
+            pooled = eval_analogy.GetSharedAnalogies(None, pool, b_c_pairs, squash=100.0,
+                                                     semantic_n=100)
+        for analogies in (batched, pooled):
+            assert dict((pair, list(analogy)) for pair, analogy in analogies.items()) == asked
+            for reverse in (True, False):
+                assert eval_analogy.EvaluateAnalogies(
+                    None, 'synthetic', fourtuples, rho=3.0, n=100, squash=100.0, reverse=reverse,
+                    semantic_n=100, analogies=analogies) == eval_analogy.EvaluateAnalogies(
+                    CB, 'synthetic', fourtuples, rho=3.0, n=100, squash=100.0, reverse=reverse,
+                    semantic_n=100)
+    CB.close()
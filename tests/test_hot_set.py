@@ -0,0 +1,82 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opening fast, and warming up from a hot set, give the same results as a plain open."""
+
+import json
+
+import pytest
+
+import category_builder_hot_set as cb_hot_set
+import category_builder_util as util
+from conftest import assert_same_results, copy_inputs, query_results, quiet
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_fast_open(data_dir, items, baseline, backend):
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False, fast_open=True)
+    assert_same_results(baseline, query_results(CB, items))
+    CB.close()
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_fast_open_needs_built_matrices(data_dir, backend, tmp_path):
+    build_dir = copy_inputs(data_dir, tmp_path / 'unbuilt')
+    with pytest.raises(FileNotFoundError, match='without fast open'):
+        util.CategoryBuilder(build_dir, backend=backend, fast_open=True)
+
+
+def test_recorded_hot_set(data_dir, inputs, items, tmp_path):
+    path = str(tmp_path / 'hot_set.json')
+    for _ in range(2):
+        # Each process adds its counts to those already saved.
+        CB = util.CategoryBuilder(data_dir, use_index=False, record_hot_set=True)
+        with quiet():
+            CB.ExpandCategory(items[:2], rho=3.0, n=100)
+            CB.GetCooccurringItems(items[0])
+            CB.GetCooccurringItems(items[0])
+        CB.SaveHotSet(path)
+        CB.close()
+    with open(path) as f:
+        counts = json.load(f)
+    assert counts['I_TO_F_COOC'][items[0]] == 4
+    assert counts['I_TO_F_SYN'][items[0]] == counts['I_TO_F_SYN'][items[1]] == 2
+    i_to_f, _ = inputs
+    # The features multiplied: some syntactic ones of the seeds, and items[0]'s co-occurrence one.
+    assert f'C{items[0]}' in counts['F_TO_I']
+    assert set(counts['F_TO_I']) <= set(feature for item in items[:2] for feature in i_to_f[item])
+    hot_set = cb_hot_set.read_hot_set(path)
+    assert hot_set['I_TO_F_COOC'][0] == items[0]
+    for table_name, keys in hot_set.items():
+        assert [counts[table_name][key] for key in keys] == sorted(counts[table_name].values(),
+                                                                   reverse=True)
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_warmed_from_hot_set(data_dir, items, baseline, backend, tmp_path):
+    path = str(tmp_path / 'hot_set.json')
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False, record_hot_set=True)
+    query_results(CB, items)
+    CB.SaveHotSet(path)
+    CB.close()
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False, fast_open=True,
+                              hot_set=path, row_cache_bytes=10 ** 7)
+    CB.warming.join()
+    if backend == 'sqlite':
+        # The rows are decoded into the row cache, ahead of the queries.
+        hot_set = cb_hot_set.read_hot_set(path)
+        assert dict((table_name, stats['rows']) for table_name, stats in CB.RowCacheStats().items()
+                    if stats['rows']) == dict((table_name, len(keys)) for table_name, keys in hot_set.items())
+    assert_same_results(baseline, query_results(CB, items))
+    CB.close()
@@ -0,0 +1,80 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling records a trace of each query, without changing its results."""
+
+import threading
+
+import pytest
+
+import category_builder_util as util
+from conftest import assert_same_results, query_results, quiet
+
+
+def test_query_trace():
+    trace = util.QueryTrace('ExpandCategory')
+    trace.Lap('select', trace.Lap('parse', trace.start))
+    trace.rows_fetched['F_TO_I'] += 2
+    branch = util.QueryTrace('branch')
+    branch.seconds['select'] = 1.0
+    branch.rows_fetched['F_TO_I'] = 3
+    branch.postings['I_TO_F_COOC'] = 4
+    trace.Add(branch)
+    trace.Finish()
+    assert trace.seconds['select'] >= 1.0 and set(trace.seconds) == {'parse', 'select'}
+    assert trace.rows_fetched == {'F_TO_I': 5} and trace.postings == {'I_TO_F_COOC': 4}
+    report = trace.Report().splitlines()
+    assert report[0].startswith('Profile of ExpandCategory: ')
+    # Stages by decreasing time.
+    assert report[1].endswith('\tselect') and report[2].endswith('\tparse')
+    assert '\tF_TO_I: 5 rows fetched, 0 postings touched' in report[3]
+
+
+def test_profiler_aggregates_by_query_type():
+    profiler = util.Profiler()
+    for name in ('ExpandCategory', 'ExpandCategory', 'DoAnalogy'):
+        with profiler.Trace(name) as trace:
+            # Parts of a traced query record into its trace.
+            with profiler.Trace('GetCooccurringItems') as inner:
+                assert inner is trace
+            trace.seconds['sort'] += 0.5
+            trace.postings['F_TO_I'] += 10
+    assert profiler.LastTrace().name == 'DoAnalogy'
+    stats = profiler.Stats()
+    assert stats.keys() == {'ExpandCategory', 'DoAnalogy'}
+    assert stats['ExpandCategory']['queries'] == 2
+    assert stats['ExpandCategory']['stage_seconds'] == {'sort': 1.0}
+    assert stats['ExpandCategory']['postings'] == {'F_TO_I': 20}
+    assert 'ExpandCategory: 2 queries' in profiler.Report()
+    # Each thread has its own last trace.
+    last = []
+    thread = threading.Thread(target=lambda: last.append(profiler.LastTrace()))
+    thread.start()
+    thread.join()
+    assert last == [None]
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_profiled_queries(data_dir, items, baseline, backend):
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False, profile=True)
+    assert_same_results(baseline, query_results(CB, items))
+    stats = CB.profiler.Stats()
+    assert stats['ExpandCategory']['queries'] == 3 * 16 + 1
+    assert stats['DoAnalogy']['queries'] == stats['GetCooccurringItems']['queries'] == 3 * 12
+    assert stats['ExpandCategory']['rows_fetched']['F_TO_I'] > 0
+    with quiet():
+        CB.GetCooccurringItems(items[0], k=5)
+    trace = CB.profiler.LastTrace()
+    assert trace.name == 'GetCooccurringItems' and trace.total_seconds > 0
+    CB.close()
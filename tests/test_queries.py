@@ -0,0 +1,120 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Each way of answering queries gives the results of the plain sqlite backend, in the same order."""
+
+import pytest
+
+import category_builder_index as cb_index
+import category_builder_util as util
+from conftest import assert_same_results, copy_inputs, query_results, quiet
+
+
+def test_ties_are_broken_by_name(baseline):
+    for query, results in baseline.items():
+        results = list(results)
+        assert results == sorted(results, key=util.by_rank), query
+
+
+def test_lazy_results_read_as_lists(baseline):
+    for query, results in baseline.items():
+        k = query[-1] if len(query) == 3 else None
+        listed = list(results)
+        if k is None:
+            assert results == listed and results[:3] == listed[:3] and len(results) == len(listed)
+        else:
+            assert isinstance(results, list) and len(results) <= k
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_backends(data_dir, items, baseline, backend):
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False)
+    assert_same_results(baseline, query_results(CB, items))
+    CB.close()
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_shards(data_dir, items, baseline, backend):
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False, shards=2)
+    # The coordinator adds up the shards' partial sums, in another order than unsharded.
+    assert_same_results(baseline, query_results(CB, items), rounded_ties=True)
+    CB.close()
+
+
+def test_shared_memory(data_dir, items, baseline):
+    import category_builder_shared
+    block = category_builder_shared.create_shared_files(data_dir)
+    try:
+        CB = util.CategoryBuilder(data_dir, backend='csr', use_index=False, shared_memory=block.name)
+        assert_same_results(baseline, query_results(CB, items))
+        CB.close()
+    finally:
+        category_builder_shared.unlink_shared_files(block)
+
+
+@pytest.mark.parametrize('backend', util.BACKENDS)
+def test_single_seed_index(data_dir, items, baseline, backend, tmp_path):
+    index_dir = copy_inputs(data_dir, tmp_path / 'index')
+    with quiet():
+        # Fewer results than some queries ask for, so that those are computed instead.
+        cb_index.build_index(index_dir, backend=backend, n=100, top_k=3, jobs=2, progress=False)
+    CB = util.CategoryBuilder(index_dir, backend=backend)
+    assert CB.index is not None
+    assert_same_results(baseline, query_results(CB, items))
+    CB.close()
+
+
+def test_result_cache(data_dir, items, baseline, tmp_path):
+    cache_dir = copy_inputs(data_dir, tmp_path / 'cache')
+    CB = util.CategoryBuilder(cache_dir, use_index=False, result_cache_bytes=10 ** 7)
+    assert_same_results(baseline, query_results(CB, items))
+    assert CB.ResultCacheStats()['hits'] == 0
+    CB.close()
+    # Another CategoryBuilder reads what the first one stored.
+    CB = util.CategoryBuilder(cache_dir, use_index=False, result_cache_bytes=10 ** 7)
+    assert_same_results(baseline, query_results(CB, items))
+    assert CB.ResultCacheStats()['misses'] == 0
+    # Seeds are matched in any order, and however they are written.
+    with quiet():
+        expansion = CB.ExpandCategory(items[:2], rho=3.0, n=100)
+        hits = CB.ResultCacheStats()['hits']
+        assert CB.ExpandCategory([items[1].upper(), ' ' + items[0]], rho=3.0, n=100) == expansion
+    assert CB.ResultCacheStats()['hits'] == hits + 1
+    CB.close()
+
+
+def test_pages(data_dir, items, baseline):
+    CB = util.CategoryBuilder(data_dir, use_index=False)
+    with quiet():
+        page = CB.ExpandCategoryPage(items[:1], rho=3.0, n=100, page_size=4)
+        read = page['results']
+        while page['next_page_token'] is not None:
+            page = CB.NextPage(page['next_page_token'], page_size=4)
+            read += page['results']
+    assert read == list(baseline['ExpandCategory', tuple(items[:1]), None])
+    CB.close()
+
+
+def test_batches(data_dir, items, baseline):
+    CB = util.CategoryBuilder(data_dir, use_index=False)
+    with quiet():
+        expansions = CB.ExpandCategoryBatch([[item] for item in items[:8]], rho=3.0, n=100, k=5)
+        cooccurring = CB.GetCooccurringItemsBatch(items[:12], k=5)
+        analogies = CB.DoAnalogyBatch([(items[-1], item) for item in items[:12]], squash=100.0, k=5)
+    for item, expansion in zip(items[:8], expansions):
+        assert expansion == baseline['ExpandCategory', (item,), 5]
+    for item, cooc, analogy in zip(items[:12], cooccurring, analogies):
+        assert cooc == baseline['GetCooccurringItems', item, 5]
+        assert analogy == baseline['DoAnalogy', item, 5]
+    CB.close()
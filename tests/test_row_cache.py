@@ -0,0 +1,57 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The row cache keeps the most recently used rows that fit in its bytes, and counts what it does."""
+
+import category_builder_util as util
+from conftest import assert_same_results, query_results
+
+
+def rows(count):
+    """Rows of the same estimated size, by key."""
+    return dict((f'key{i}', {f'entry{i}': 1.0}) for i in range(count))
+
+
+def test_evicts_least_recently_used_past_max_bytes():
+    rows_by_key = rows(4)
+    row_bytes = util.EstimateRowBytes(rows_by_key['key0'])
+    cache = util.RowCache(3 * row_bytes)
+    for key in ('key0', 'key1', 'key2'):
+        cache.put(key, rows_by_key[key])
+    assert cache.get('key0') is rows_by_key['key0']
+    cache.put('key3', rows_by_key['key3'])
+    # key1 was used least recently, key0 having been read since it was put.
+    assert cache.get('key1') is None
+    assert [cache.get(key) for key in ('key0', 'key2', 'key3')] == [
+        rows_by_key['key0'], rows_by_key['key2'], rows_by_key['key3']]
+    assert cache.Stats() == {'hits': 4, 'misses': 1, 'hit_rate': 0.8, 'evictions': 1, 'rows': 3,
+                             'bytes': 3 * row_bytes, 'max_bytes': 3 * row_bytes}
+
+
+def test_rows_larger_than_the_cache_are_not_kept():
+    large = dict((f'entry{i}', 1.0) for i in range(100))
+    cache = util.RowCache(util.EstimateRowBytes(large) - 1)
+    cache.put('large', large)
+    assert cache.get('large') is None
+    assert cache.Stats()['bytes'] == 0 and cache.Stats()['evictions'] == 0
+
+
+def test_queries_with_row_cache(data_dir, items, baseline):
+    CB = util.CategoryBuilder(data_dir, use_index=False, row_cache_bytes=10 ** 5)
+    assert_same_results(baseline, query_results(CB, items))
+    stats = CB.RowCacheStats()
+    assert stats.keys() == util.KEY_FIELDS.keys()
+    assert sum(table['hits'] for table in stats.values()) > 0
+    assert all(table['bytes'] <= table['max_bytes'] for table in stats.values())
+    CB.close()
@@ -0,0 +1,99 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The server answers as CategoryBuilder does, with the status of what went wrong otherwise."""
+
+import http.client
+import json
+import threading
+
+import pytest
+
+import category_builder_client as cb_client
+import category_builder_server as cb_server
+from conftest import assert_same_results, query_results
+
+
+@pytest.fixture(scope='module')
+def server(data_dir):
+    server = cb_server.CategoryBuilderServer(('127.0.0.1', 0), data_dir=data_dir, query_threads=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    server.CB.close()
+
+
+def request(server, http_method, path, body=b''):
+    """The status and the JSON body of the answer to a request."""
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request(http_method, path, body=body)
+    response = connection.getresponse()
+    answer = response.status, json.load(response)
+    connection.close()
+    return answer
+
+
+def test_results(server, items, baseline):
+    client = cb_client.CategoryBuilderClient(f'http://127.0.0.1:{server.server_address[1]}')
+    assert_same_results(baseline, query_results(client, items))
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/ExpandCategory', b'not json'),
+    ('/ExpandCategory', b'["a list"]'),
+    ('/ExpandCategory', b'{"seeds": ["item0"], "rho": 3.0}'),
+    ('/ExpandCategory', b'{"seeds": ["item0"], "rho": 3.0, "n": 100, "colour": 1}'),
+    ('/ExpandCategory', b'{"seeds": "item0", "rho": 3.0, "n": 100}'),
+    ('/ExpandCategory', b'{"seeds": ["item0"], "rho": 3.0, "n": 100, "k": -1}'),
+    ('/DoAnalogyBatch', b'{"b_c_pairs": [["item0"]], "squash": 100.0}'),
+    ('/GetItemsGivenWeightedContexts', b'{"wtd_contexts": [["S1|x", "heavy"]]}'),
+    ('/NextPage', b'{"page_token": "not a token"}'),
+    ('/ExpandCategoryPage', b'{"seeds": ["item0"], "rho": 3.0, "n": 100, "page_size": 0}'),
+])
+def test_bad_requests(server, path, body):
+    status, answer = request(server, 'POST', path, body)
+    assert status == 400 and answer['error']
+
+
+def test_unknown_paths(server):
+    assert request(server, 'POST', '/close')[0] == 404
+    assert request(server, 'GET', '/ExpandCategory')[0] == 404
+
+
+def test_server_errors(server, monkeypatch):
+    def broken(seed, k=None):
+        raise TypeError('a bug')
+
+    # Errors of the server's own are not taken for bad arguments.
+    monkeypatch.setattr(server.CB, 'GetCooccurringItems', broken)
+    status, answer = request(server, 'POST', '/GetCooccurringItems', b'{"seed": "item0"}')
+    assert status == 500 and answer['error'] == 'TypeError: a bug'
+
+
+def test_latency_histogram(server, items):
+    before = request(server, 'GET', '/stats')[1]['latency'].get('CompleteItems', {'count': 0})
+    for item in items[:5]:
+        status, _ = request(server, 'POST', '/CompleteItems', json.dumps({'prefix': item}).encode())
+        assert status == 200
+    request(server, 'POST', '/CompleteItems', b'{"prefix": 1}')
+    status, stats = request(server, 'GET', '/stats')
+    histogram = stats['latency']['CompleteItems']
+    assert status == 200
+    assert histogram['count'] == before['count'] + 5
+    assert sum(histogram['buckets'].values()) == histogram['count']
+    assert list(histogram['buckets']) == ([f'<={ms}ms' for ms in cb_server.LATENCY_BUCKETS_MS] +
+                                          [f'>{cb_server.LATENCY_BUCKETS_MS[-1]}ms'])
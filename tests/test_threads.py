@@ -0,0 +1,39 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Threads sharing one CategoryBuilder get the results each query gets alone."""
+
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import category_builder_util as util
+from conftest import assert_same_results, queries, quiet
+
+
+@pytest.mark.parametrize('backend, row_cache_bytes', [('sqlite', 0), ('sqlite', 10 ** 5), ('csr', 0)])
+def test_threads_share_a_builder(data_dir, items, baseline, backend, row_cache_bytes):
+    CB = util.CategoryBuilder(data_dir, backend=backend, use_index=False,
+                              row_cache_bytes=row_cache_bytes)
+    # Each query is run several times, in a shuffled order, by threads taking turns unevenly.
+    shuffled = list(queries(items)) * 4
+    random.Random(2).shuffle(shuffled)
+    with quiet(), ThreadPoolExecutor(8) as executor:
+        # Results are read in the threads too, as lazily ranked ones rank as they are read.
+        futures = [(query, executor.submit(lambda run=run: list(run(CB)))) for query, run in shuffled]
+        results = [(query, future.result()) for query, future in futures]
+    for query, result in results:
+        assert_same_results({query: baseline[query]}, {query: result})
+    CB.close()
@@ -0,0 +1,81 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Completions, suggestions and normalized seeds agree with a scan of every known name."""
+
+import pytest
+
+import category_builder_util as util
+import category_builder_vocab as vocab
+from conftest import quiet
+
+
+@pytest.fixture(scope='module', params=util.BACKENDS)
+def CB(request, data_dir):
+    CB = util.CategoryBuilder(data_dir, backend=request.param, use_index=False)
+    yield CB
+    CB.close()
+
+
+@pytest.fixture(scope='module')
+def known_items(inputs):
+    i_to_f, f_to_i = inputs
+    return sorted(set(i_to_f) | set(item for row in f_to_i.values() for item in row))
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, a_char in enumerate(a, 1):
+        current = [i]
+        for j, b_char in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a_char != b_char)))
+        previous = current
+    return previous[-1]
+
+
+def test_normalize_seeds(CB):
+    with quiet():
+        assert CB.NormalizeSeeds(['item0', 'ITEM1', ' New   York ', 'a, "b"', 'no such item']) == [
+            'item0', 'item1', 'new york', 'a, "b"', None]
+
+
+@pytest.mark.parametrize('prefix', ['item1', 'ITEM2', 'new', 'item1000', ''])
+def test_complete_items(CB, known_items, prefix):
+    expected = [item for item in known_items if item.startswith(prefix.lower())]
+    with quiet():
+        assert CB.CompleteItems(prefix, k=5) == expected[:5]
+        assert CB.CompleteItems(prefix, k=1000) == expected
+
+
+@pytest.mark.parametrize('prefix', ['S1', 'Citem1', 'S', 's1'])
+def test_complete_features(CB, inputs, prefix):
+    _, f_to_i = inputs
+    expected = sorted(feature for feature in f_to_i if feature.startswith(prefix))
+    with quiet():
+        assert CB.CompleteFeatures(prefix, k=len(f_to_i)) == expected
+
+
+@pytest.mark.parametrize('item, max_distance', [
+    ('itme12', None), ('item12', None), ('Item 12', 2), ('new yrok', None), ('nwe', 1), ('zzzz', 1),
+])
+def test_suggest_items(CB, known_items, item, max_distance):
+    name = vocab.normalize_name(item)
+    within = max_distance
+    if max_distance is None:
+        within = 1 if len(name) <= vocab.SHORT_NAME_LENGTH else 2
+    expected = sorted(((known, levenshtein(name, known)) for known in known_items
+                       if levenshtein(name, known) <= within), key=lambda x: (x[1], x[0]))
+    with quiet():
+        assert CB.SuggestItems(item, k=len(known_items), max_distance=max_distance) == expected
+        assert CB.SuggestItems(item, k=3, max_distance=max_distance) == expected[:3]
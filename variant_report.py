@@ -0,0 +1,146 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares quantized and pruned csr variants for accuracy, speed and size.
+
+Each variant (see category_builder_csr.parse_variant) is built if needed, then
+evaluated in a process of its own: MAP on the set expansion files, accuracy on the
+analogy file, query latency, size on disk and peak RSS. Results are printed as a
+table and written as JSON to --output.
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import benchmark
+import category_builder_util as util
+import eval_analogy
+from eval_set_expansion import CategoryEvalMAP
+
+
+def EvaluateVariant(variant, flags):
+  """Returns the measurements of one variant, computed in this process."""
+  import category_builder_csr as csr
+  results = {'variant': variant, 'options': csr.parse_variant(variant)}
+  start = time.perf_counter()
+  util.BuildMatrices('.', 'csr', variant=variant)
+  results['build_seconds'] = time.perf_counter() - start
+  results['disk_mb'] = benchmark.DiskMb(csr.variant_dir_name(variant))
+  CB = util.CategoryBuilder(data_dir='.', backend='csr', variant=variant)
+
+  rng = random.Random(flags.random_seed)
+  quiet = contextlib.redirect_stdout(io.StringIO())
+  results['map'] = {}
+  seed_lists = []
+  for filename in flags.set_expansion_files.split(','):
+    evaluation = CategoryEvalMAP(filename)
+    seed_lists += [rng.sample(evaluation.candidate_seeds, evaluation.SEEDS_TO_USE) for _ in range(10)]
+    with quiet:
+      results['map'][os.path.basename(filename)] = evaluation.Eval(
+          num_iterations=flags.iterations, seeds_in_top_n=0, map_n=0, rho=flags.rho, n=flags.n,
+          jobs=flags.jobs, random_seed=flags.random_seed, backend='csr', variant=variant)
+
+  solved = asked = 0
+  b_c_pairs = []
+  with quiet:
+    for catname, fourtuples in eval_analogy.ReadData(flags.analogy_file).items():
+      if catname.startswith('gram') and not catname.startswith('gram6'):
+        continue
+      fourtuples = fourtuples[:flags.analogy_questions]
+      pairs = [(pair_1['rhs'], pair_2['lhs'])
+               for reverse in (True, False)
+               for pair_1, pair_2 in (eval_analogy.GetQuestionPairs(x, reverse) for x in fourtuples)]
+      b_c_pairs += pairs
+      analogies = eval_analogy.GetSharedAnalogies(CB, None, list(dict.fromkeys(pairs)),
+                                                  squash=100.0, semantic_n=200)
+      for reverse in (True, False):
+        solved += eval_analogy.EvaluateAnalogies(CB, catname, fourtuples, rho=flags.rho, n=flags.n,
+                                                 squash=100.0, reverse=reverse, semantic_n=200,
+                                                 analogies=analogies)
+        asked += len(fourtuples)
+  results['analogy_accuracy'] = solved / asked if asked else None
+
+  with quiet:
+    results['ExpandCategory'] = benchmark.TimeCalls(
+        lambda seeds: CB.ExpandCategory(seeds=seeds, rho=flags.rho, n=flags.n, k=flags.expansion_size),
+        [(seeds,) for seeds in seed_lists])
+    results['DoAnalogy'] = benchmark.TimeCalls(
+        lambda b, c: CB.DoAnalogy(b=b, c=c, squash=100.0, semantic_n=200, k=eval_analogy.ANALOGY_SIZE),
+        b_c_pairs[:len(seed_lists)])
+  results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  CB.close()
+  return results
+
+# The flags passed on to each variant's process.
+EVALUATION_FLAGS = ('set_expansion_files', 'analogy_file', 'analogy_questions', 'iterations', 'rho',
+                    'n', 'expansion_size', 'jobs', 'random_seed')
+
+def EvaluateInSubprocess(variant, flags):
+  """Runs EvaluateVariant in a fresh interpreter, so that its peak RSS is its own."""
+  argv = [f'--{name}={getattr(flags, name)}' for name in EVALUATION_FLAGS]
+  output = subprocess.check_output([sys.executable, __file__, f'--evaluate_variant={variant}'] + argv,
+                                   universal_newlines=True)
+  return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Category Builder Variant Report')
+  parser.add_argument('--variants', default='|weights=uint16|weights=uint8|f_to_i_top_k=1000|'
+                                           'weights=uint8,f_to_i_top_k=1000,i_to_f_top_k=500',
+                      help="'|'-separated csr variants to compare; an empty one is the default build")
+  parser.add_argument('--set_expansion_files',
+                      default=','.join(sorted(glob.glob('eval_data/cat_eval_data/*'))),
+                      help="Comma-separated set expansion eval files")
+  parser.add_argument('--analogy_file', default='eval_data/analogy_eval_data/questions-words.txt',
+                      help="Analogy eval file")
+  parser.add_argument('--analogy_questions', default=50, type=int,
+                      help="How many questions of each analogy category to ask")
+  parser.add_argument('--iterations', default=20, type=int, help="Set expansion trials per file")
+  parser.add_argument('--rho', default=3.0, type=float, help="The rho param")
+  parser.add_argument('--n', default=100, type=int, help="How many features to use")
+  parser.add_argument('--expansion_size', default=100, type=int,
+                      help="How many items each timed expansion returns")
+  parser.add_argument('--jobs', default=1, type=int, help="Processes for the set expansion eval")
+  parser.add_argument('--random_seed', default=0, type=int, help="Seed for choosing eval seeds")
+  parser.add_argument('--output', default='variant_report.json', help="Where to write the results")
+  parser.add_argument('--evaluate_variant', default=None, help=argparse.SUPPRESS)
+  flags = parser.parse_args()
+
+  if flags.evaluate_variant is not None:
+    with contextlib.redirect_stdout(sys.stderr):
+      results = EvaluateVariant(flags.evaluate_variant, flags)
+    print(json.dumps(results))
+    sys.exit(0)
+
+  report = [EvaluateInSubprocess(variant, flags) for variant in flags.variants.split('|')]
+  with open(flags.output, 'w') as f:
+    json.dump(report, f, indent=2)
+  print(f"{'variant':48} {'disk MB':>8} {'RSS MB':>8} {'MAP':>7} {'analogy':>8} "
+        f"{'expand p50':>11} {'analogy p50':>12}")
+  for results in report:
+    mean_map = sum(results['map'].values()) / len(results['map']) if results['map'] else 0.0
+    print(f"{results['variant'] or '(default)':48} {results['disk_mb']:8.1f} "
+          f"{results['peak_rss_mb']:8.1f} {100.0 * mean_map:6.2f}% "
+          f"{100.0 * (results['analogy_accuracy'] or 0.0):7.2f}% "
+          f"{results['ExpandCategory']['p50_ms']:9.2f}ms {results['DoAnalogy']['p50_ms']:10.2f}ms")
+  print(f"Results written to {flags.output}")